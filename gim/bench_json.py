@@ -0,0 +1,135 @@
+# Run it with `python -m gim.bench_json [PAGE.json ...]`
+
+"""
+Benchmark of the decoding of the pages of github lists by
+`gim.github._parse_json`: all the page at once, or streamed, the entries being
+decoded one by one when asked for (as when the objects of a page are saved).
+
+Pass the paths of pages recorded from github responses, or nothing to use a
+generated page of 100 issues. For each page and mode, the decoding time (best
+of some runs) and the increase of the peak RSS of the process (in a new process
+for each mode) are printed. The peak RSS is reset before decoding on linux, else
+the increase may be hidden by a previous peak.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from time import time
+
+from gim.github import _parse_json
+
+RUNS = 5
+
+
+def generate_page(count=100):
+    """Return the json of a page of `count` entries like github issues"""
+    user = {
+        'login': 'octocat',
+        'id': 1,
+        'avatar_url': 'https://avatars.githubusercontent.com/u/1?v=4',
+        'url': 'https://api.github.com/users/octocat',
+        'html_url': 'https://github.com/octocat',
+        'type': 'User',
+        'site_admin': False,
+    }
+    return json.dumps([{
+        'id': 1000 + number,
+        'number': number,
+        'url': 'https://api.github.com/repos/octocat/hello-world/issues/%d' % number,
+        'html_url': 'https://github.com/octocat/hello-world/issues/%d' % number,
+        'title': 'Issue number %d' % number,
+        'body': 'Some text describing the issue. ' * 60,
+        'state': 'open',
+        'locked': False,
+        'user': user,
+        'assignees': [user],
+        'labels': [{'id': label, 'name': 'label %d' % label, 'color': 'f29513', 'default': False}
+                   for label in range(3)],
+        'milestone': None,
+        'comments': number % 10,
+        'created_at': '2017-01-01T10:00:00Z',
+        'updated_at': '2017-01-02T10:00:00Z',
+        'closed_at': None,
+    } for number in range(1, count + 1)])
+
+
+def get_rss():
+    """Return the current and peak RSS of the process, in KB"""
+    try:
+        with open('/proc/self/status') as status:
+            values = dict(line.split(':', 1) for line in status)
+        return int(values['VmRSS'].split()[0]), int(values['VmHWM'].split()[0])
+    except (IOError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+def decode(content, stream):
+    """Decode the page and go through its entries, return their count"""
+    count = 0
+    if stream:
+        for entry in _parse_json(content, stream=True):
+            count += 1
+    else:
+        entries = _parse_json(content)
+        for entry in entries:
+            count += 1
+        del entries
+    return count
+
+
+def measure(path, stream):
+    """Return the count of entries, best decoding time and peak RSS increase (in KB)"""
+    with open(path) as page_file:
+        content = page_file.read()
+
+    reset_peak_rss()
+    base_rss = get_rss()[0]
+    durations = []
+    for run in range(RUNS):
+        start = time()
+        count = decode(content, stream)
+        durations.append(time() - start)
+        if not run:
+            rss = get_rss()[1] - base_rss
+
+    return count, min(durations), rss
+
+
+def main(paths):
+    generated = None
+    if not paths:
+        generated = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        generated.write(generate_page())
+        generated.close()
+        paths = [generated.name]
+
+    try:
+        for path in paths:
+            print '%s (%d KB)' % (path, os.path.getsize(path) / 1024)
+            for mode in ('full', 'stream'):
+                output = subprocess.check_output([sys.executable, '-m', 'gim.bench_json', '--measure', mode, path])
+                count, duration, rss = json.loads(output)
+                print '    %-6s: %d entries in %.1f ms, peak RSS +%d KB' % (mode, count, duration * 1000, rss)
+    finally:
+        if generated:
+            os.unlink(generated.name)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        print json.dumps(measure(sys.argv[3], sys.argv[2] == 'stream'))
+    else:
+        main(sys.argv[1:])
@@ -1,3 +1,5 @@
+default_app_config = 'gim.core.apps.CoreConfig'
+
 from threading import local
 
 from limpyd.contrib.database import PipelineDatabase
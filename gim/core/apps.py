@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+
+
+class CoreConfig(AppConfig):
+    name = 'gim.core'
+
+    def ready(self):
+        from .identity_map import invalidate_instance
+        from .utils import invalidate_payload_digest
+
+        post_save.connect(invalidate_instance, dispatch_uid='identity_map_invalidate_saved', weak=False)
+        post_delete.connect(invalidate_instance, dispatch_uid='identity_map_invalidate_deleted', weak=False)
+        post_save.connect(invalidate_payload_digest, dispatch_uid='payload_digest_invalidate_saved', weak=False)
+        post_delete.connect(invalidate_payload_digest, dispatch_uid='payload_digest_invalidate_deleted', weak=False)
@@ -0,0 +1,127 @@
+"""
+A "sync batch" allows to defer some side effects of the objects saved during
+a sync (publishing, jobs...), to run them only once per instance/job when the
+batch is flushed, instead of each time an object is saved.
+
+Usage:
+
+    with sync_batch():
+        # create/update many objects
+
+    # here all the deferred side effects are done
+
+"""
+
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import local
+
+from django.db import transaction
+
+logger = logging.getLogger('gim.log')
+
+thread_data = local()
+
+
+class SyncBatch(object):
+    """
+    Hold the deferred calls of a sync batch, to be run when flushed.
+    A key is used for each call to run it only once.
+    """
+
+    def __init__(self):
+        self.deferred = OrderedDict()
+        self.flush_wrappers = OrderedDict()
+
+    def defer(self, key, func, *args, **kwargs):
+        """
+        Defer the call of `func` with the given arguments until the batch is
+        flushed. If a call is already deferred with the same key, it is
+        replaced by this one (but keeps its place)
+        """
+        self.deferred[key] = (func, args, kwargs)
+
+    def get_deferred(self, key):
+        """Return the (func, args, kwargs) tuple deferred with the given key, or None"""
+        return self.deferred.get(key)
+
+    def wrap_flush(self, key, context_manager):
+        """
+        Ask to run the deferred calls inside the context manager returned by
+        the `context_manager` callable (only one by key)
+        """
+        self.flush_wrappers.setdefault(key, context_manager)
+
+    def backup(self):
+        """Return the current state of the batch, to be restored by `restore`"""
+        return OrderedDict(self.deferred), OrderedDict(self.flush_wrappers)
+
+    def restore(self, backup):
+        """Restore the batch to a state returned by `backup`"""
+        self.deferred, self.flush_wrappers = OrderedDict(backup[0]), OrderedDict(backup[1])
+
+    def flush(self):
+        """Run all the deferred calls, in the order they were added"""
+        deferred, self.deferred = self.deferred, OrderedDict()
+        wrappers, self.flush_wrappers = self.flush_wrappers, OrderedDict()
+        if deferred:
+            self._run(deferred.values(), wrappers.values())
+
+    def _run(self, calls, wrappers):
+        if wrappers:
+            with wrappers[0]():
+                return self._run(calls, wrappers[1:])
+
+        for func, args, kwargs in calls:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('Deferred call to %s failed', func)
+
+
+def get_sync_batch():
+    """Return the sync batch currently active for the current thread, or None"""
+    return getattr(thread_data, 'sync_batch', None)
+
+
+@contextmanager
+def sync_batch():
+    """
+    Context manager to activate a sync batch for the current thread. Deferred
+    calls are run when leaving it, or, if a transaction is active, only when
+    it is committed (they are discarded if it is rolled back). If a sync batch
+    is already active, it is used and will be flushed when leaving its own
+    context manager.
+    Code rolling back a transaction inside the context manager must restore
+    the batch (see `SyncBatch.backup`) to discard the calls deferred in it.
+    """
+    batch = get_sync_batch()
+    if batch is not None:
+        yield batch
+        return
+
+    batch = thread_data.sync_batch = SyncBatch()
+    try:
+        yield batch
+    finally:
+        # deactivate the batch first so deferred calls are not deferred again
+        thread_data.sync_batch = None
+        transaction.on_commit(batch.flush)
+
+
+def add_job(job_model, identifier, **kwargs):
+    """
+    Add a job of the given model. If a sync batch is active, the job is only
+    added when the batch is flushed, and only once for the same identifier,
+    with the arguments of all the calls merged (last ones win)
+    """
+    batch = get_sync_batch()
+    if batch is None:
+        return job_model.add_job(identifier, **kwargs)
+
+    key = ('add_job', job_model, str(identifier))
+    previous = batch.get_deferred(key)
+    if previous:
+        kwargs = dict(previous[2], **kwargs)
+    batch.defer(key, job_model.add_job, identifier, **kwargs)
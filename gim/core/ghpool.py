@@ -1,25 +1,483 @@
+import json
+import re
+import socket
+import urllib
+import urllib2
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha1
+from httplib import BadStatusLine, CannotSendRequest, HTTPSConnection, ResponseNotReady
+from StringIO import StringIO
+from threading import Lock, local
+from time import sleep, time
+from uuid import uuid4
+
 from dateutil import parser, tz
 
+from django.conf import settings
+
+from gim.core import get_main_limpyd_database
 from gim.github import GitHub, ApiError, ApiAuthError, ApiNotFoundError
 
 UTC = tz.gettz('UTC')
 
 
+class KeepAliveConnectionPool(object):
+    """
+    A pool of keep-alive https connections, one pool by thread, with at most
+    `max_per_host` idle connections kept for each host.
+    Connections idle for more than `idle_timeout` seconds are closed instead
+    of being reused, as github may have closed them on its side.
+    """
+
+    # errors meaning that a reused connection was closed by the other side
+    RECONNECT_ERRORS = (BadStatusLine, CannotSendRequest, ResponseNotReady, socket.error)
+    # errors raised before anything was sent, so safe to retry for any method
+    NOT_SENT_ERRORS = (CannotSendRequest, )
+    # methods that can be sent twice without side effects
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, max_per_host=4, idle_timeout=50):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._local = local()
+        self._stats_lock = Lock()
+        self.stats = {
+            'requests': 0,  # number of requests sent
+            'created': 0,  # number of new connections opened
+            'reused': 0,  # number of requests sent on an already opened connection
+            'reconnected': 0,  # number of reused connections that failed and were reopened
+            'evicted': 0,  # number of connections closed because idle for too long
+            'discarded': 0,  # number of connections closed because the pool was full
+        }
+
+    def incr_stat(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def get_stats(self):
+        """
+        Return a copy of the counters, with the number of idle connections
+        of the current thread
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['idle'] = sum(len(entries) for entries in self._get_idle().values())
+        return stats
+
+    def _get_idle(self):
+        """
+        Return the dict of idle connections for the current thread: for each
+        host, a list of (connection, last used time) tuples
+        """
+        if not hasattr(self._local, 'idle'):
+            self._local.idle = {}
+        return self._local.idle
+
+    def get_connection(self, host, timeout):
+        """
+        Return a tuple with an idle connection for the given host, or a new one,
+        and a boolean telling if the connection was reused
+        """
+        entries = self._get_idle().setdefault(host, [])
+        now = time()
+        while entries:
+            connection, last_used = entries.pop()
+            if now - last_used > self.idle_timeout:
+                connection.close()
+                self.incr_stat('evicted')
+                continue
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+        self.incr_stat('created')
+        return HTTPSConnection(host, timeout=timeout), False
+
+    def release_connection(self, host, connection):
+        """
+        Put back the given connection in the pool for the given host, or close
+        it if the pool is full
+        """
+        entries = self._get_idle().setdefault(host, [])
+        if len(entries) >= self.max_per_host:
+            connection.close()
+            self.incr_stat('discarded')
+        else:
+            entries.append((connection, time()))
+
+    def clear(self):
+        """
+        Close all idle connections of the current thread
+        """
+        for entries in self._get_idle().values():
+            for connection, last_used in entries:
+                connection.close()
+        self._get_idle().clear()
+
+    def urlopen(self, request):
+        """
+        Send the given urllib2 request on a pooled connection and return a
+        response object like the ones returned by urllib2 handlers.
+        The body is fully read to be able to give the connection back to the
+        pool.
+        A reused connection failing before getting the response (closed or
+        reset by github) is retried on a new connection, but only if the
+        method is idempotent or if the error proves nothing was sent, to never
+        send a POST or a PATCH twice.
+        """
+        host = request.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(request.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in request.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), value) for name, value in headers.items())
+
+        method = request.get_method()
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+
+        while True:
+            connection, reused = self.get_connection(host, request.timeout)
+            try:
+                connection.request(method, request.get_selector(), request.data, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except self.RECONNECT_ERRORS as e:
+                connection.close()
+                if reused and (idempotent or isinstance(e, self.NOT_SENT_ERRORS)):
+                    self.incr_stat('reconnected')
+                    continue
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+            break
+
+        self.incr_stat('requests')
+        if reused:
+            self.incr_stat('reused')
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release_connection(host, connection)
+
+        result = urllib.addinfourl(StringIO(content), response.msg, request.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+
+class ConnectionObjectsPool(object):
+    """
+    A thread-safe LRU of `Connection` objects, by key (token or username),
+    keeping at most `max_size` of them, and dropping the ones not used for
+    more than `idle_timeout` seconds.
+    """
+
+    def __init__(self, max_size=None, idle_timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        # key => (connection, last used time), the least recently used first
+        self.entries = OrderedDict()
+        self.stats = {
+            'hits': 0,  # number of connections found in the pool
+            'misses': 0,  # number of connections created
+            'evicted': 0,  # number of connections removed because the pool was full
+            'expired': 0,  # number of connections removed because idle for too long
+            'removed': 0,  # number of connections explicitly removed
+        }
+
+    def _remove_expired(self, now):
+        # must be called with the lock acquired
+        if not self.idle_timeout:
+            return
+        while self.entries:
+            key, (connection, last_used) = next(self.entries.iteritems())
+            if now - last_used <= self.idle_timeout:
+                break
+            del self.entries[key]
+            self.stats['expired'] += 1
+
+    def get(self, key, factory):
+        """
+        Return the connection for the given key, or a new one created by
+        calling `factory`
+        """
+        now = time()
+        with self.lock:
+            self._remove_expired(now)
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.stats['hits'] += 1
+                connection = entry[0]
+            else:
+                # creating a connection is cheap: no request is done
+                connection = factory()
+                self.stats['misses'] += 1
+
+            # (re)add it as the most recently used
+            self.entries[key] = connection, now
+            while self.max_size and len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+        return connection
+
+    def pop(self, key):
+        """Remove the connection for the given key, if any"""
+        with self.lock:
+            if self.entries.pop(key, None):
+                self.stats['removed'] += 1
+
+    def get_stats(self):
+        """Return a copy of the counters, with the current size of the pool"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.entries)
+        return stats
+
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+    """
+    An urllib2 handler using a KeepAliveConnectionPool to send https requests
+    """
+
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, request):
+        return self.pool.urlopen(request)
+
+
+class ResponseCache(object):
+    """
+    Store in redis the content of github responses having an etag, to let the
+    connection ask github with a `If-None-Match` header, and use the stored
+    content if github tells that it was not modified (304 responses do not
+    count in the rate limit)
+    Entries are stored by url (with query), Accept header and credentials (the
+    `Authorization` header), as the content may vary for each token. Nothing
+    is cached for connections without credentials, nor for pages of paginated
+    lists, that are rarely fetched again (and may be big and many).
+    It is also used to coalesce GET requests: if `coalesce_wait` is set, only
+    one caller at a time fetches an url (for a token), the other ones wait, at
+    most this number of seconds, for its response. If the response cannot be
+    shared (not cached, or error), the lock is replaced by a "failed" marker
+    for a few seconds, to let the waiting callers (and the next ones) do their
+    own request without waiting.
+    """
+
+    KEY_PREFIX = 'gim:gh-response-cache'
+    HEADERS_TO_KEEP = ('content-type', 'etag', 'last-modified')
+
+    # max duration of a fetch lock, in case the caller holding it died
+    FETCH_LOCK_TTL = 30
+
+    # value of the lock when the response of the fetch cannot be shared, and
+    # how long it is kept
+    FETCH_FAILED = 'failed'
+    FETCH_FAILED_TTL = 5
+
+    # delete the lock, or replace it by the `ARGV[2]` marker for `ARGV[3]`
+    # seconds, only if it's still the one we acquired
+    RELEASE_FETCH_LOCK_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            if ARGV[2] then
+                return redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+            end
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, ttl=None, max_size=None, coalesce_wait=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.coalesce_wait = coalesce_wait
+        self._redis = None
+
+    @property
+    def redis(self):
+        """
+        A connection to the limpyd redis database, but not decoding responses,
+        as the content is stored compressed
+        """
+        if self._redis is None:
+            connection = get_main_limpyd_database().connection
+            pool = connection.connection_pool
+            self._redis = connection.__class__(connection_pool=pool.__class__(
+                connection_class=pool.connection_class,
+                **dict(pool.connection_kwargs, decode_responses=False)
+            ))
+        return self._redis
+
+    def get_key(self, authorization, url, accept=None):
+        """
+        Return the key of the entry for the given url, for a connection with
+        the given `Authorization` header, or None if no authorization
+        """
+        if not authorization:
+            return None
+        base = u'\n'.join([authorization, accept or '', url]).encode('utf-8')
+        return '%s:%s' % (self.KEY_PREFIX, sha1(base).hexdigest())
+
+    def get(self, key):
+        """
+        Return the entry saved for the given key, as a dict with `etag`,
+        `headers` and `content`, or None if no entry
+        """
+        entry = self.redis.hgetall(key)
+        if not entry or not entry.get('etag'):
+            return None
+        try:
+            return {
+                'etag': entry['etag'],
+                'headers': json.loads(entry['headers']),
+                'content': zlib.decompress(entry['content']),
+                'fetched_at': float(entry.get('fetched_at') or 0),
+            }
+        except (KeyError, ValueError, zlib.error):
+            self.redis.delete(key)
+            return None
+
+    def can_cache(self, headers, content=None):
+        """Tell if a response with these headers (and content) can be saved"""
+        etag = headers.get('etag')
+        if not etag or '""' in etag:
+            return False
+        if headers.get('link'):
+            # a page of a paginated list
+            return False
+        if content is not None and self.max_size and len(content) > self.max_size:
+            return False
+        return True
+
+    def set(self, key, headers, content):
+        """
+        Save the content and some headers of a response for the given key, if
+        the response has an etag. Return True if it was saved.
+        """
+        if not self.can_cache(headers, content):
+            return False
+        pipeline = self.redis.pipeline()
+        pipeline.delete(key)
+        pipeline.hmset(key, {
+            'etag': headers['etag'],
+            'headers': json.dumps({k: v for k, v in headers.items() if k in self.HEADERS_TO_KEEP}),
+            'content': zlib.compress(content),
+            'fetched_at': time(),
+        })
+        if self.ttl:
+            pipeline.expire(key, self.ttl)
+        pipeline.execute()
+        return True
+
+    def touch(self, key):
+        """Mark the entry for the given key as just fetched (on a 304)"""
+        self.redis.hset(key, 'fetched_at', time())
+
+    def acquire_fetch_lock(self, key):
+        """
+        Try to get the lock to fetch the url for the given key. Return the
+        value of the lock if acquired, to release it, else None
+        """
+        value = '%s:%s' % (uuid4().hex, time())
+        if self.redis.set('%s:lock' % key, value, nx=True, ex=self.FETCH_LOCK_TTL):
+            return value
+        return None
+
+    def release_fetch_lock(self, key, value, failed=False):
+        """
+        Release the lock acquired to fetch the url for the given key. If
+        `failed`, nothing was saved for the waiting callers: tell them to not
+        wait anymore
+        """
+        args = [value]
+        if failed:
+            args += [self.FETCH_FAILED, self.FETCH_FAILED_TTL]
+        self.redis.eval(self.RELEASE_FETCH_LOCK_SCRIPT, 1, '%s:lock' % key, *args)
+
+    def wait_for_fetch(self, key):
+        """
+        Wait for the caller holding the lock to fetch the url for the given
+        key to release it, and return the entry it saved (or touched). Return
+        None if nothing was saved (without waiting if the fetch is marked as
+        failed) or if it took more than `coalesce_wait` seconds.
+        """
+        lock_key = '%s:lock' % key
+        lock_value = self.redis.get(lock_key)
+        if not lock_value or lock_value == self.FETCH_FAILED:
+            return None
+        locked_at = float(lock_value.split(':')[1])
+
+        started = time()
+        while True:
+            current_value = self.redis.get(lock_key)
+            if current_value != lock_value:
+                break
+            if time() - started > self.coalesce_wait:
+                return None
+            sleep(0.05)
+
+        if current_value == self.FETCH_FAILED:
+            return None
+
+        entry = self.get(key)
+        if entry and entry['fetched_at'] >= locked_at:
+            return entry
+        return None
+
+
 class Connection(GitHub):
     """
     A subclass of the default GitHub object to handle a pool of connections,
     one for each username
     """
     pool = {
-        'user-token': {},
-        'user-pwd': {},
+        'user-token': ConnectionObjectsPool(
+            max_size=settings.GITHUB_CONNECTIONS_POOL_MAX_SIZE,
+            idle_timeout=settings.GITHUB_CONNECTIONS_POOL_IDLE_TIMEOUT,
+        ),
+        'user-pwd': ConnectionObjectsPool(
+            max_size=settings.GITHUB_CONNECTIONS_POOL_MAX_SIZE,
+            idle_timeout=settings.GITHUB_CONNECTIONS_POOL_IDLE_TIMEOUT,
+        ),
     }
     ApiError = ApiError
     ApiAuthError = ApiAuthError
     ApiNotFoundError = ApiNotFoundError
 
-    @staticmethod
-    def parse_date(value):
+    # keep-alive https connections, shared by all Connection objects
+    http_pool = KeepAliveConnectionPool()
+
+    response_cache = ResponseCache(
+        ttl=settings.GITHUB_RESPONSE_CACHE_TTL,
+        max_size=settings.GITHUB_RESPONSE_CACHE_MAX_SIZE,
+        coalesce_wait=settings.GITHUB_COALESCE_REQUESTS_WAIT,
+    ) if settings.GITHUB_RESPONSE_CACHE_TTL else None
+
+    # the calls reserved by the job using this connection, consumed by its
+    # calls (see `gim.core.limpyd_models.CallsReservation`)
+    calls_reservation = None
+
+    # dates from the github api are in the "2011-04-14T16:00:49Z" format
+    ISO_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6})\d*)?Z?$')
+
+    @classmethod
+    def parse_date(cls, value):
+        match = cls.ISO_DATE_RE.match(value)
+        if match:
+            parts = match.groups()
+            try:
+                return datetime(*[int(part) for part in parts[:6]],
+                                microsecond=int(parts[6].ljust(6, '0')) if parts[6] else 0)
+            except ValueError:
+                pass
         return parser.parse(value).replace(tzinfo=None)
 
     @classmethod
@@ -44,12 +502,8 @@ class Connection(GitHub):
         else:
             raise Connection.ApiAuthError(u"Unable to start authentication (Wrong auth parameters)")
 
-        if pool_key not in pool:
-            # create a new valid connection
-            pool[pool_key] = cls(**auth)
-
         # return the old or new connection in the pool
-        return pool[pool_key]
+        return pool.get(pool_key, lambda: cls(**auth))
 
     def __init__(self, username=None, password=None, access_token=None, client_id=None, client_secret=None, redirect_uri=None, scope=None):
         """
@@ -65,20 +519,49 @@ class Connection(GitHub):
             self._connection_args['access_token'] = access_token
         super(Connection, self).__init__(username, password, access_token, client_id, client_secret, redirect_uri, scope)
 
+    def copy(self):
+        """
+        Return a new connection with the same auth information, not in the
+        pool. To be used by another thread, because the headers of the last
+        response (rate limit, scopes...) are saved on the connection to update
+        the token after each call.
+        """
+        connection = self.__class__(**self._connection_args)
+        if hasattr(self, '_tokens_pks_cache'):
+            connection._tokens_pks_cache = self._tokens_pks_cache
+        connection.calls_reservation = self.calls_reservation
+        return connection
+
+    def _build_opener(self):
+        """
+        Use the keep-alive connections pool instead of opening a new connection
+        for each request
+        """
+        return urllib2.build_opener(KeepAliveHTTPSHandler(self.http_pool))
+
+    @classmethod
+    def get_http_pool_stats(cls):
+        return cls.http_pool.get_stats()
+
+    @classmethod
+    def get_pool_stats(cls):
+        """Return the stats of the pools of Connection objects"""
+        return {name: pool.get_stats() for name, pool in cls.pool.items()}
+
     @classmethod
     def remove_token(cls, token):
-        cls.pool['user-token'].pop(token, None)
+        cls.pool['user-token'].pop(token)
 
     @classmethod
     def remove_username(cls, username):
-        cls.pool['user-pwd'].pop(username, None)
+        cls.pool['user-pwd'].pop(username)
 
-    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}):
+    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}, json_stream=False):
         api_error = None
         if response_headers is None:
             response_headers = {}
         try:
-            return super(Connection, self)._http(method, path, request_headers, response_headers, json_post, timeout, kw)
+            return super(Connection, self)._http(method, path, request_headers, response_headers, json_post, timeout, kw, json_stream)
         except ApiError, e:
             api_error = e
             raise
@@ -52,6 +52,61 @@ FRAGMENTS = {
         number
     """, set()),
 
+    'gitActor': ('GitActor', """
+        name
+        email
+        user {
+            %(SUBFRAGMENTS)s
+        }
+    """, {'user'}),
+
+    'commitBase': ('Commit', """
+        sha: oid
+        message
+        authored_date: authoredDate
+        committed_date: committedDate
+        additions
+        deletions
+        tree {
+            sha: oid
+        }
+        parents(first: 10) {
+            nodes {
+                sha: oid
+            }
+        }
+        comments {
+            total_count: totalCount
+        }
+        author {
+            ...gitActor
+        }
+        committer {
+            ...gitActor
+        }
+    """, {'gitActor'}),
+
+    'commitCommentsCount': ('Commit', """
+        sha: oid
+        comments {
+            total_count: totalCount
+        }
+    """, set()),
+
+    'pullRequestState': ('PullRequest', """
+        number
+        state
+        merged
+        merged_at: mergedAt
+        mergeable
+        merge_state_status: mergeStateStatus
+        updated_at: updatedAt
+        head_sha: headRefOid
+        commits {
+            total_count: totalCount
+        }
+    """, set()),
+
     'pullRequestRepository': ('PullRequest', """
         repository {
             idb64: id
@@ -261,11 +316,12 @@ def compose_variables(variables):
     return json.dumps(variables)
 
 
-def fetch_graphql(gh, query, variables=None, name=None, debug_context=None):
+def fetch_graphql(gh, query, variables=None, name=None, debug_context=None, request_headers=None):
     """Call the graphql endpoint for a query.
     `query` must be a string representing a query ready to pass,
     and `variables` could be a string ready to pass, or a dictionnary
-    that has to be converted"""
+    that has to be converted.
+    `request_headers` can be used to pass an "Accept" header for previews"""
 
     if variables is None:
         variables = {}
@@ -274,7 +330,7 @@ def fetch_graphql(gh, query, variables=None, name=None, debug_context=None):
         variables = compose_variables(variables)
 
     logger.info('Querying "%s" on GraphQL with %s (context: %s)', name, variables, debug_context)
-    result = gh.graphql.post(query=query, variables=variables)
+    result = gh.graphql.post(request_headers=request_headers, query=query, variables=variables)
 
     if result.get('errors'):
         for error in result.errors:
@@ -0,0 +1,199 @@
+"""
+A process-wide identity map, to keep the objects often found in github
+payloads (users, labels, milestones...) between jobs, instead of loading them
+again and again from the database.
+
+Objects are stored by model and github identifiers (the filters returned by
+`get_filters_from_identifiers`), in a LRU with a ttl. They are invalidated
+when saved or deleted, in the current process via signals, and in the other
+ones via a redis pub/sub channel, when the transaction is committed.
+Objects are not stored when loaded in a transaction, as it may be rolled back.
+Only models with `use_identity_map` set to True are concerned.
+"""
+
+import copy
+import logging
+import os
+from collections import OrderedDict
+from functools import partial
+from threading import Lock, Thread
+from time import sleep, time
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger('gim.log')
+
+
+class IdentityMap(object):
+
+    CHANNEL = 'gim:identity-map:invalidate'
+
+    # max number of pks sent in one invalidation message
+    PUBLISH_BATCH_SIZE = 500
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0, 'invalidated': 0}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # (model, key) => (obj, expire_at)
+            self.entries = OrderedDict()
+            # (model, pk) => set of keys, to invalidate all entries of an object
+            self.keys_by_pk = {}
+            self.pid = os.getpid()
+            self.token = uuid4().hex
+            self.listener = None
+
+    @property
+    def redis(self):
+        from gim.core import get_main_limpyd_database
+        return get_main_limpyd_database().connection
+
+    @staticmethod
+    def copy(obj):
+        """Return a copy of the given object, without its related objects caches"""
+        new_obj = copy.copy(obj)
+        new_obj._state = copy.copy(obj._state)
+        for key in new_obj.__dict__.keys():
+            if key.startswith('_') and key.endswith('_cache'):
+                del new_obj.__dict__[key]
+        return new_obj
+
+    @staticmethod
+    def get_key(filters):
+        return tuple(sorted(filters.items()))
+
+    def check_process(self):
+        """Reset the map if we are in a new process (after a fork), and
+        start listening for invalidations from other processes"""
+        if self.pid != os.getpid():
+            self.reset()
+        if self.listener is None:
+            with self.lock:
+                if self.listener is None:
+                    self.listener = Thread(target=self.listen, name='identity-map-listener')
+                    self.listener.daemon = True
+                    self.listener.start()
+
+    def get(self, model, filters):
+        """Return a copy of the object for the given model and filters, or None"""
+        self.check_process()
+        entry_key = (model, self.get_key(filters))
+        with self.lock:
+            try:
+                obj, expire_at = self.entries.pop(entry_key)
+            except KeyError:
+                self.stats['misses'] += 1
+                return None
+            if expire_at < time():
+                self._forget(entry_key, obj.pk)
+                self.stats['misses'] += 1
+                return None
+            # keep it as the most recently used
+            self.entries[entry_key] = obj, expire_at
+            self.stats['hits'] += 1
+        return self.copy(obj)
+
+    def set(self, model, filters, obj):
+        """Store a copy of the given object for the given model and filters"""
+        if not obj.pk:
+            return
+        self.check_process()
+        entry_key = (model, self.get_key(filters))
+        obj = self.copy(obj)
+        with self.lock:
+            self.entries.pop(entry_key, None)
+            self.entries[entry_key] = obj, time() + self.ttl
+            self.keys_by_pk.setdefault((model, obj.pk), set()).add(entry_key)
+            while len(self.entries) > self.max_size:
+                old_entry_key, (old_obj, expire_at) = self.entries.popitem(last=False)
+                self._forget(old_entry_key, old_obj.pk)
+                self.stats['evicted'] += 1
+
+    def _forget(self, entry_key, pk):
+        # must be called with the lock acquired
+        self.entries.pop(entry_key, None)
+        keys = self.keys_by_pk.get((entry_key[0], pk))
+        if keys:
+            keys.discard(entry_key)
+            if not keys:
+                del self.keys_by_pk[(entry_key[0], pk)]
+
+    def invalidate(self, model, pk, propagate=True, using=None):
+        """Remove the given object from the map (see `invalidate_many`)"""
+        self.invalidate_many(model, [pk], propagate, using)
+
+    def invalidate_many(self, model, pks, propagate=True, using=None):
+        """Remove the given objects from the map, and, if `propagate` is True,
+        from the maps of the other processes. In this case it is done (again)
+        when the current transaction, if any, is committed, because the old
+        version of the objects may be loaded and stored until then"""
+        pks = list(pks)
+        if not pks:
+            return
+        self._forget_pks(model, pks)
+        if propagate:
+            transaction.on_commit(partial(self._invalidate_committed, model, pks), using=using)
+
+    def _forget_pks(self, model, pks):
+        with self.lock:
+            for pk in pks:
+                for entry_key in self.keys_by_pk.pop((model, pk), ()):
+                    self.entries.pop(entry_key, None)
+                    self.stats['invalidated'] += 1
+
+    def _invalidate_committed(self, model, pks):
+        self._forget_pks(model, pks)
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for start in range(0, len(pks), self.PUBLISH_BATCH_SIZE):
+                pipeline.publish(self.CHANNEL, '%s|%s|%s' % (
+                    self.token, model._meta.label,
+                    ','.join(str(pk) for pk in pks[start:start + self.PUBLISH_BATCH_SIZE])
+                ))
+            pipeline.execute()
+        except Exception:
+            logger.exception('Cannot propagate invalidation of %d %s', len(pks), model._meta.label)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_pk.clear()
+
+    def listen(self):
+        """Invalidate objects saved/deleted by other processes. Run in a thread."""
+        from django.apps import apps
+
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                # we may have missed some invalidations
+                self.clear()
+                for message in pubsub.listen():
+                    token, label, pks = message['data'].split('|')
+                    if token == self.token:
+                        continue
+                    self.invalidate_many(apps.get_model(label), [int(pk) for pk in pks.split(',')],
+                                         propagate=False)
+            except Exception:
+                logger.exception('Identity map listener failed, restarting it')
+                sleep(1)
+
+
+identity_map = IdentityMap(
+    max_size=settings.IDENTITY_MAP_MAX_SIZE,
+    ttl=settings.IDENTITY_MAP_TTL,
+) if settings.IDENTITY_MAP_MAX_SIZE and settings.IDENTITY_MAP_TTL else None
+
+
+def invalidate_instance(sender, instance, **kwargs):
+    """Signal receiver to remove saved/deleted objects from the identity map"""
+    if identity_map and getattr(sender, 'use_identity_map', False) and instance.pk:
+        identity_map.invalidate(sender, instance.pk, using=kwargs.get('using'))
@@ -3,9 +3,12 @@ from contextlib import contextmanager
 import json
 import logging
 
-from random import choice, randint
+from random import choice, randint, uniform
+from threading import Lock
+from time import time
 
 from django.apps import apps
+from django.conf import settings
 
 from limpyd import model as lmodel, fields as lfields
 from limpyd.contrib.collection import ExtendedCollectionManager
@@ -20,6 +23,43 @@ from gim.github import ApiError, ApiNotFoundError
 maintenance_logger = logging.getLogger('gim.maintenance')
 
 
+class CallsReservation(object):
+    """
+    Calls reserved on a token by a job (see `Token.reserve_calls`), consumed
+    by each call done with the connection of the job (and its copies, used in
+    other threads), to not count them twice, in the reserved calls and in the
+    rate limit remaining of the token.
+    """
+
+    def __init__(self, token, count, for_graphql=False):
+        self.token = token
+        self.count = count  # reserved calls not consumed yet
+        self.for_graphql = for_graphql
+        self.calls = 0  # calls done with the connection
+        self.lock = Lock()
+
+    def use_call(self, gh, for_graphql):
+        """
+        Count the call just done with `gh`, if really done (github sent the
+        rate limit) on the reserved api, and return True if it consumed one of
+        the reserved calls, that must then be released
+        """
+        if for_graphql != self.for_graphql or gh.x_ratelimit_remaining == -1:
+            return False
+        with self.lock:
+            self.calls += 1
+            if self.count <= 0:
+                return False
+            self.count -= 1
+            return True
+
+    def take_remaining(self):
+        """Return the number of reserved calls not consumed, and forget them"""
+        with self.lock:
+            count, self.count = self.count, 0
+            return count
+
+
 class Token(lmodel.RedisModel):
 
     database = get_main_limpyd_database()
@@ -29,6 +69,7 @@ class Token(lmodel.RedisModel):
     token = lfields.InstanceHashField(unique=True)
 
     rate_limit_remaining = lfields.StringField()  # expirable field
+    rate_limit_reserved = lfields.StringField()  # calls reserved by running jobs, expires with rate_limit_remaining
     rate_limit_limit = lfields.InstanceHashField()  # how much by hour
     rate_limit_reset = lfields.InstanceHashField()  # same as ttl(rate_limit_remaining)
     rate_limit_score = lfields.InstanceHashField()  # based on remaining and reset, the higher, the better
@@ -43,6 +84,7 @@ class Token(lmodel.RedisModel):
     min_alerts = lfields.SortedSetField()  # will store all queries that receive a very low rate-limit-remaining
     can_access_graphql_api = lfields.InstanceHashField(indexable=True)  # if the user can access the githup graphql api
     graphql_rate_limit_remaining = lfields.StringField()  # expirable field
+    graphql_rate_limit_reserved = lfields.StringField()  # calls reserved by running jobs, expires with graphql_rate_limit_remaining
     graphql_rate_limit_limit = lfields.InstanceHashField()  # how much by hour
     graphql_rate_limit_reset = lfields.InstanceHashField()  # same as ttl(graphql_rate_limit_remaining)
     graphql_rate_limit_score = lfields.InstanceHashField()  # based on remaining and reset, the higher, the better
@@ -67,8 +109,216 @@ class Token(lmodel.RedisModel):
             self._user = GithubUser.objects.get(username=self.username.hget())
         return self._user
 
+    # how long (in seconds) the pks of the tokens of a connection are cached
+    TOKENS_PKS_CACHE_TTL = 60
+
+    # number of best tokens (by score) in which one is chosen
+    SCORE_INDEX_WINDOW = 10
+
+    # Lua function to add/remove a token in the sorted sets, by score, of the
+    # tokens that can be used (see `get_score_indexes_keys`), depending on its
+    # flags
+    SCORE_INDEXES_LUA = """
+        local function update_score_indexes(hash, pk, score_indexes)
+            local valid_scopes, available, graphql_available, graphql_access, score, graphql_score = unpack(
+                redis.call('HMGET', hash, 'valid_scopes', 'available', 'graphql_available',
+                           'can_access_graphql_api', 'rate_limit_score', 'graphql_rate_limit_score'))
+            local buckets = {
+                {score_indexes.rest, valid_scopes == '1', available == '1', score},
+                {score_indexes.graphql, valid_scopes == '1' and graphql_access == '1', graphql_available == '1', graphql_score},
+            }
+            for _, bucket in ipairs(buckets) do
+                local keys, usable, is_available, bucket_score = unpack(bucket)
+                bucket_score = tonumber(bucket_score) or 0
+                if usable then
+                    redis.call('ZADD', keys.all, bucket_score, pk)
+                else
+                    redis.call('ZREM', keys.all, pk)
+                end
+                if usable and is_available then
+                    redis.call('ZADD', keys.available, bucket_score, pk)
+                else
+                    redis.call('ZREM', keys.available, pk)
+                end
+            end
+        end
+    """
+
+    # Lua function to release `count` calls reserved in the `key` string
+    RELEASE_CALLS_LUA = """
+        local function release_calls(key, count)
+            local reserved = tonumber(redis.call('GET', key) or 0)
+            if reserved <= tonumber(count) then
+                redis.call('DEL', key)
+            else
+                redis.call('DECRBY', key, count)
+            end
+        end
+    """
+
+    # KEYS: the keys of the hashes of the tokens to update
+    # ARGV: the json of `get_score_indexes_keys`, then the pks of the tokens
+    UPDATE_SCORE_INDEXES_SCRIPT = SCORE_INDEXES_LUA + """
+        local score_indexes = cjson.decode(ARGV[1])
+        for i, hash in ipairs(KEYS) do
+            if redis.call('EXISTS', hash) == 1 then
+                update_score_indexes(hash, ARGV[i + 1], score_indexes)
+            end
+        end
+    """
+
+    # Return the pks and scores of the `ARGV[1]` best tokens in the score index
+    # `KEYS[1]`, only for the ones in the set `KEYS[2]` if given (the index of
+    # the tokens having a permission on a repository)
+    SELECT_FROM_SCORE_INDEX_SCRIPT = """
+        local window = tonumber(ARGV[1])
+        if not KEYS[2] then
+            return redis.call('ZREVRANGE', KEYS[1], 0, window - 1, 'WITHSCORES')
+        end
+        local candidates = {}
+        for _, pk in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+            local score = redis.call('ZSCORE', KEYS[1], pk)
+            if score then table.insert(candidates, {pk, score}) end
+        end
+        table.sort(candidates, function(a, b) return tonumber(a[2]) > tonumber(b[2]) end)
+        local result = {}
+        for i = 1, math.min(window, #candidates) do
+            table.insert(result, candidates[i][1])
+            table.insert(result, candidates[i][2])
+        end
+        return result
+    """
+
+    # Do all the work of `update_from_gh`, for all the tokens of a user, in one
+    # call. Indexes of indexable fields are updated like limpyd would do.
+    # KEYS: for each token, the keys of its hash, rate limit remaining (rest or
+    #       graphql), scopes, errors, unavailabilities and min_alerts, then
+    #       the key of the reserved calls to release, if any
+    # ARGV: the json spec prepared by `update_tokens_from_gh_with_script`
+    UPDATE_FROM_GH_SCRIPT = SCORE_INDEXES_LUA + RELEASE_CALLS_LUA + """
+        local spec = cjson.decode(ARGV[1])
+        local fields, indexes = spec.fields, spec.indexes
+
+        local function set_indexed(hash, pk, name, value)
+            local old = redis.call('HGET', hash, name)
+            if old == value then return end
+            if old then redis.call('SREM', indexes[name] .. ':' .. old, pk) end
+            redis.call('HSET', hash, name, value)
+            redis.call('SADD', indexes[name] .. ':' .. value, pk)
+        end
+
+        for i, token in ipairs(spec.tokens) do
+            local base = (i - 1) * 6
+            local hash, remaining, scopes = KEYS[base + 1], KEYS[base + 2], KEYS[base + 3]
+            local pk = token.pk
+
+            -- ignore tokens deleted since their pks were cached
+            if redis.call('EXISTS', hash) == 1 then
+
+                if spec.username then set_indexed(hash, pk, 'username', spec.username) end
+                redis.call('HSET', hash, 'last_call', spec.now)
+
+                if spec.scopes then
+                    for _, scope in ipairs(redis.call('SMEMBERS', scopes)) do
+                        redis.call('SREM', indexes.scopes .. ':' .. scope, pk)
+                    end
+                    redis.call('DEL', scopes)
+                    for _, scope in ipairs(spec.scopes) do
+                        redis.call('SADD', scopes, scope)
+                        redis.call('SADD', indexes.scopes .. ':' .. scope, pk)
+                    end
+                    set_indexed(hash, pk, 'valid_scopes', spec.valid_scopes)
+                end
+
+                if spec.remaining then
+                    redis.call('SET', remaining, spec.remaining)
+                    if spec.expire_at then
+                        redis.call('EXPIREAT', remaining, spec.expire_at)
+                    else
+                        redis.call('EXPIRE', remaining, spec.expire)
+                    end
+                    redis.call('HSET', hash, fields.reset, spec.reset)
+                    redis.call('HSET', hash, fields.limit, spec.limit)
+                end
+
+                if spec.available then set_indexed(hash, pk, fields.available, spec.available) end
+
+                -- same as `set_compute_score`
+                local remaining_calls = tonumber(redis.call('GET', remaining) or 0)
+                local remaining_seconds = redis.call('TTL', remaining)
+                if remaining_seconds == 0 then remaining_seconds = -2 end
+                if remaining_seconds == -1 then remaining_seconds = spec.max_expected end
+                local score = (remaining_calls - spec.default_limit) / remaining_seconds
+                redis.call('HSET', hash, fields.score, tostring(score * token.factor))
+
+                if redis.call('HGET', hash, 'token') == spec.access_token then
+                    redis.call('HSET', hash, spec.last_call_field, spec.now)
+                    if spec.log then
+                        if spec.log.error then
+                            redis.call('ZADD', KEYS[base + 4], spec.log.when, spec.log.data)
+                        end
+                        if spec.log.unavailability then
+                            redis.call('ZADD', KEYS[base + 5], spec.log.when, spec.log.data)
+                        end
+                        if spec.log.min_alert then
+                            redis.call('ZADD', KEYS[base + 6], spec.log.when, spec.log.data)
+                        end
+                    end
+                end
+
+                if spec.score_indexes then update_score_indexes(hash, pk, spec.score_indexes) end
+
+            end
+        end
+
+        if spec.release_reserved then release_calls(KEYS[#KEYS], spec.release_reserved) end
+    """
+
+    # Reserve `ARGV[1]` calls in `KEYS[2]` if the remaining calls in `KEYS[1]`,
+    # minus the ones already reserved, are enough to keep at least `ARGV[2]`
+    # calls. The reservations expire with the remaining calls (when the rate
+    # limit is reset).
+    # Return {1, 0} if reserved, else {0, seconds before the reset}
+    RESERVE_CALLS_SCRIPT = """
+        local remaining = redis.call('GET', KEYS[1])
+        local ttl = redis.call('TTL', KEYS[1])
+        if remaining then
+            local reserved = tonumber(redis.call('GET', KEYS[2]) or 0)
+            if tonumber(remaining) - reserved - tonumber(ARGV[1]) < tonumber(ARGV[2]) then
+                return {0, ttl}
+            end
+        end
+        redis.call('INCRBY', KEYS[2], ARGV[1])
+        if ttl > 0 then
+            redis.call('EXPIRE', KEYS[2], ttl)
+        else
+            redis.call('EXPIRE', KEYS[2], 3600)
+        end
+        return {1, 0}
+    """
+
+    # Release `ARGV[1]` calls reserved in `KEYS[1]`
+    RELEASE_CALLS_SCRIPT = RELEASE_CALLS_LUA + """
+        release_calls(KEYS[1], ARGV[1])
+    """
+
+    _scripts = {}
+
     @classmethod
-    def update_tokens_from_gh(cls, gh, *args, **kwargs):
+    def update_tokens_from_gh(cls, gh, api_error, method, path, request_headers, response_headers, kw):
+        args = (api_error, method, path, request_headers, response_headers, kw)
+
+        # the call consumes one of the calls reserved by the job using `gh`
+        reservation = getattr(gh, 'calls_reservation', None)
+        if reservation is not None and not reservation.use_call(gh, path == '/graphql'):
+            reservation = None
+
+        if settings.GITHUB_TOKENS_UPDATE_SCRIPT:
+            return cls.update_tokens_from_gh_with_script(gh, *args, release_reservation=reservation)
+
+        if reservation is not None:
+            reservation.token.release_calls(1, reservation.for_graphql)
+
         access_token = gh._connection_args.get('access_token')
         if not access_token:
             return
@@ -78,7 +328,219 @@ class Token(lmodel.RedisModel):
             return
         tokens = Token.collection(username=username).instances()
         for token in tokens:
-            token.update_from_gh(gh, *args, **kwargs)
+            token.update_from_gh(gh, *args)
+
+    @classmethod
+    def get_tokens_pks_for_gh(cls, gh):
+        """
+        Return the pks of all the tokens of the user owning the token used by
+        the given connection. They are cached in the connection for
+        `TOKENS_PKS_CACHE_TTL` seconds
+        """
+        cache = getattr(gh, '_tokens_pks_cache', None)
+        if cache and cache[0] > time():
+            return cache[1]
+
+        pks = []
+        access_token = gh._connection_args.get('access_token')
+        if access_token:
+            token_pks = list(cls.collection(token=access_token))
+            if token_pks:
+                username = cls.lazy_connect(token_pks[0]).username.hget()
+                pks = list(cls.collection(username=username)) if username else token_pks
+
+        gh._tokens_pks_cache = (time() + cls.TOKENS_PKS_CACHE_TTL, pks)
+        return pks
+
+    @classmethod
+    def get_script(cls, name):
+        """Return the redis script object for the lua script in the given attribute"""
+        if name not in cls._scripts:
+            cls._scripts[name] = cls.get_connection().register_script(getattr(cls, name))
+        return cls._scripts[name]
+
+    @classmethod
+    def get_score_indexes_keys(cls):
+        """
+        Return the keys of the sorted sets, by score, of the tokens with valid
+        scopes (and graphql access for graphql), for all of them ("all") or
+        only the ones marked as available ("available")
+        """
+        return {
+            api: {
+                'all': cls.make_key(cls._name, 'score-index', api, 'all'),
+                'available': cls.make_key(cls._name, 'score-index', api, 'available'),
+            }
+            for api in ('rest', 'graphql')
+        }
+
+    @classmethod
+    def update_score_indexes_for_pks(cls, pks):
+        """Update the score indexes for the tokens with the given pks"""
+        if not settings.GITHUB_TOKENS_SCORE_INDEX or not pks:
+            return
+        cls.get_script('UPDATE_SCORE_INDEXES_SCRIPT')(
+            keys=[cls.lazy_connect(pk).key for pk in pks],
+            args=[json.dumps(cls.get_score_indexes_keys())] + [str(pk) for pk in pks],
+            client=cls.get_connection()
+        )
+
+    def update_score_indexes(self):
+        """Update the score indexes for the current token"""
+        self.update_score_indexes_for_pks([self.pk.get()])
+
+    def delete(self):
+        pk = self.pk.get()
+        result = super(Token, self).delete()
+        keys = [key for api_keys in self.get_score_indexes_keys().values() for key in api_keys.values()]
+        pipeline = self.connection.pipeline()
+        for key in keys:
+            pipeline.zrem(key, pk)
+        pipeline.execute()
+        return result
+
+    @classmethod
+    def update_tokens_from_gh_with_script(cls, gh, api_error, method, path, request_headers, response_headers, kw,
+                                          release_reservation=None):
+        """
+        Do the same as `update_from_gh` for all the tokens of the user owning
+        the token used by `gh`, but in only one call to redis, using a lua
+        script. One call of `release_reservation` is released at the same time.
+        """
+        pks = cls.get_tokens_pks_for_gh(gh)
+        if not pks:
+            if release_reservation is not None:
+                release_reservation.token.release_calls(1, release_reservation.for_graphql)
+            return
+
+        is_graphql = path == '/graphql'
+
+        if is_graphql:
+            fields_prefix = 'graphql_'
+            default_limit = cls.GRAPHQL_LIMIT
+            max_expected = cls.GRAPHQL_MAX_EXPECTED
+            min_alert_limit = cls.GRAPHQL_MIN_ALERT
+        else:
+            fields_prefix = ''
+            default_limit = cls.LIMIT
+            max_expected = cls.MAX_EXPECTED
+            min_alert_limit = cls.MIN_ALERT
+
+        now = datetime.utcnow()
+
+        spec = {
+            'access_token': gh._connection_args.get('access_token'),
+            'now': str(now),
+            'default_limit': default_limit,
+            'max_expected': max_expected,
+            'fields': {
+                'available': fields_prefix + 'available',
+                'limit': fields_prefix + 'rate_limit_limit',
+                'reset': fields_prefix + 'rate_limit_reset',
+                'score': fields_prefix + 'rate_limit_score',
+            },
+            'indexes': {
+                name: cls.make_key(cls._name, name)
+                for name in ('username', 'valid_scopes', 'scopes', 'available', 'graphql_available')
+            },
+            'tokens': [],
+        }
+
+        username = gh._connection_args.get('username')
+        if username:
+            spec['username'] = username
+
+        available = None
+        log_unavailability = False
+        is_min_alert = False
+
+        is_error = False
+        if api_error:
+            is_error = True
+            if hasattr(api_error, 'code'):
+                if api_error.code == 304 or (200 <= api_error.code < 300):
+                    is_error = False
+
+        spec['last_call_field'] = 'last_call_ko' if is_error else 'last_call_ok'
+
+        # reset scopes (only if we have the header)
+        if gh.x_oauth_scopes is not None:
+            spec['scopes'] = list(gh.x_oauth_scopes)
+            spec['valid_scopes'] = str(int(bool(gh.x_oauth_scopes)))
+            if not gh.x_oauth_scopes or 'repo' not in gh.x_oauth_scopes:
+                available = '0'
+                log_unavailability = True
+
+        if gh.x_ratelimit_remaining != -1:
+            # add rate limit remaining, clear it after reset time
+            spec['remaining'] = str(gh.x_ratelimit_remaining)
+            if gh.x_ratelimit_reset != -1:
+                spec['expire_at'] = gh.x_ratelimit_reset
+                spec['reset'] = str(gh.x_ratelimit_reset)
+            else:
+                spec['expire'] = 3600
+                spec['reset'] = str(datetime_to_score(datetime.utcnow()+timedelta(seconds=3600)))
+
+            # if to few requests remaining, consider it as not available for public queries
+            spec['limit'] = str(max_expected if gh.x_ratelimit_limit == -1 else gh.x_ratelimit_limit)
+            if not gh.x_ratelimit_remaining or gh.x_ratelimit_remaining < default_limit:
+                available = '0'
+                log_unavailability = True
+            else:
+                available = '1'
+
+            is_min_alert = gh.x_ratelimit_remaining <= min_alert_limit
+
+        if available is not None:
+            spec['available'] = available
+
+        if is_error or log_unavailability or is_min_alert:
+            json_data = {
+                'request': {
+                    'path': path,
+                    'method': method,
+                    'headers': request_headers,
+                    'args': kw,
+                },
+                'response': {
+                    'headers': response_headers,
+                },
+            }
+            if api_error:
+                if hasattr(api_error, 'code'):
+                    json_data['response']['code'] = api_error.code
+                if api_error.response and api_error.response.json:
+                    json_data['response']['content'] = api_error.response.json
+
+            spec['log'] = {
+                'when': datetime_to_score(now),
+                'data': json.dumps(json_data),
+                'error': is_error,
+                'unavailability': log_unavailability,
+                'min_alert': is_min_alert,
+            }
+
+        keys = []
+        for pk in pks:
+            token = cls.lazy_connect(pk)
+            remaining_field = token.graphql_rate_limit_remaining if is_graphql else token.rate_limit_remaining
+            keys.extend([token.key, remaining_field.key, token.scopes.key,
+                         token.errors.key, token.unavailabilities.key, token.min_alerts.key])
+            spec['tokens'].append({
+                'pk': str(pk),
+                'factor': (110 - randint(0, 20)) / 100.0,  # +- 10% on the score
+            })
+
+        if settings.GITHUB_TOKENS_SCORE_INDEX:
+            spec['score_indexes'] = cls.get_score_indexes_keys()
+
+        if release_reservation is not None:
+            token = release_reservation.token
+            keys.append((token.graphql_rate_limit_reserved if release_reservation.for_graphql
+                         else token.rate_limit_reserved).key)
+            spec['release_reserved'] = 1
+
+        cls.get_script('UPDATE_FROM_GH_SCRIPT')(keys=keys, args=[json.dumps(spec)], client=cls.get_connection())
 
     def update_from_gh(self, gh, api_error, method, path, request_headers, response_headers, kw):
         """
@@ -165,6 +627,7 @@ class Token(lmodel.RedisModel):
             is_min_alert = gh.x_ratelimit_remaining <= min_alert_limit
 
         self.set_compute_score(is_graphql)
+        self.update_score_indexes()
 
         if is_for_token:
             if is_error:
@@ -235,10 +698,13 @@ class Token(lmodel.RedisModel):
         if expired and self.valid_scopes.hget() == '1':
             available_field.hset(1)
 
+        self.update_score_indexes()
+
         return True
 
     @classmethod
     def reset_all_flags(cls):
+        # `reset_flags` also updates the score indexes, so they are rebuilt here
         for token in cls.collection().instances():
             token.reset_flags()
             token.reset_flags(True)
@@ -262,6 +728,31 @@ class Token(lmodel.RedisModel):
         score = (remaining_calls - default_limit) / float(remaining_seconds)
         rate_limit_score_field.hset(score * (110 - randint(0, 20)) / 100)  # +- 10%
 
+    def reserve_calls(self, count, for_graphql=False, min_remaining=0):
+        """
+        Try to reserve `count` calls on the rate limit of this token, to avoid
+        many jobs running in parallel using more calls than what remains.
+        The reservation is refused if, with it, less than `min_remaining` calls
+        would be left.
+        Return a tuple with a boolean telling if the reservation was done, and,
+        if not, the number of seconds before the rate limit is reset
+        """
+        if for_graphql:
+            remaining_field, reserved_field = self.graphql_rate_limit_remaining, self.graphql_rate_limit_reserved
+        else:
+            remaining_field, reserved_field = self.rate_limit_remaining, self.rate_limit_reserved
+
+        reserved, delay = self.get_script('RESERVE_CALLS_SCRIPT')(
+            keys=[remaining_field.key, reserved_field.key], args=[count, min_remaining], client=self.connection)
+        return bool(reserved), delay
+
+    def release_calls(self, count, for_graphql=False):
+        """Release `count` calls reserved by `reserve_calls`"""
+        if not count:
+            return
+        reserved_field = self.graphql_rate_limit_reserved if for_graphql else self.rate_limit_reserved
+        self.get_script('RELEASE_CALLS_SCRIPT')(keys=[reserved_field.key], args=[count], client=self.connection)
+
     def get_remaining_seconds(self, for_graphql=False):
         """
         Return the time before the reset of the rate limiting
@@ -292,8 +783,43 @@ class Token(lmodel.RedisModel):
             if repos_pull:
                 token.repos_pull.sadd(*repos_pull)
 
+    @classmethod
+    def get_one_from_score_index(cls, available=True, for_graphql=False, repository_pk=None, permission=None):
+        """
+        Return one of the best tokens by score, using the score indexes, and
+        only the ones with the given permission on the given repository if
+        asked. The choice is random, weighted by the scores, to spread the
+        load. Return None if no token was found.
+        """
+        keys = [cls.get_score_indexes_keys()['graphql' if for_graphql else 'rest']['available' if available else 'all']]
+        if repository_pk and permission in ('admin', 'push', 'pull'):
+            keys.append(cls.make_key(cls._name, 'repos_%s' % permission, repository_pk))
+
+        result = cls.get_script('SELECT_FROM_SCORE_INDEX_SCRIPT')(
+            keys=keys, args=[cls.SCORE_INDEX_WINDOW], client=cls.get_connection())
+        if not result:
+            return None
+
+        pks = result[::2]
+        weights = [max(float(score), 0) for score in result[1::2]]
+        total = sum(weights)
+        if not total:
+            return cls.lazy_connect(choice(pks))
+
+        pick = uniform(0, total)
+        for pk, weight in zip(pks, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+        return cls.lazy_connect(pk)
+
     @classmethod
     def get_one_for_repository(cls, repository_pk, permission, available=True, sort_by='-rate_limit_score', for_graphql=False):
+        if settings.GITHUB_TOKENS_SCORE_INDEX and sort_by == '-rate_limit_score':
+            token = cls.get_one_from_score_index(available, for_graphql, repository_pk, permission)
+            if token:
+                return token
+
         collection = cls.collection(valid_scopes=1)
         if available:
             if for_graphql:
@@ -377,6 +903,11 @@ class Token(lmodel.RedisModel):
 
     @classmethod
     def get_one(cls, available=True, sort_by='-rate_limit_score', for_graphql=False):
+        if settings.GITHUB_TOKENS_SCORE_INDEX and sort_by == '-rate_limit_score':
+            token = cls.get_one_from_score_index(available, for_graphql)
+            if token:
+                return token
+
         collection = cls.collection(valid_scopes=1)
         if available:
             if for_graphql:
@@ -435,9 +966,11 @@ class Token(lmodel.RedisModel):
             self.gh.graphql.post(query="query{ viewer { login }}")
         except ApiError:
             self.can_access_graphql_api.hset(0)
+            self.update_score_indexes()
             return False
         else:
             self.can_access_graphql_api.hset(1)
+            self.update_score_indexes()
             return True
 
     @classmethod
@@ -649,6 +1182,27 @@ class DeletedInstance(lmodel.RedisModel):
     def exist_for_instance(cls, instance):
         return cls.exist_for_model_and_id(instance.__class__, instance.github_id)
 
+    @classmethod
+    def exist_for_models_and_ids(cls, pairs):
+        """Return the set of (model, github_id) pairs of the given ones that were deleted
+
+        All the checks are done in one pipeline to do only one call to redis.
+
+        """
+        pairs = list(set(pairs))
+        if not pairs:
+            return set()
+
+        field = cls.get_field('ident')
+        with cls.database.pipeline(transaction=False) as pipeline:
+            for model, github_id in pairs:
+                cls.database.connection.exists(
+                    field.index_key(cls.get_ident_for_model_and_id(model, github_id))
+                )
+            result = pipeline.execute()
+
+        return {pair for pair, exists in zip(pairs, result) if exists}
+
     @classmethod
     def create_for_model_and_id(cls, model, github_id):
         instance, created = cls.get_or_connect(ident=cls.get_ident_for_model_and_id(model, github_id))
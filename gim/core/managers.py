@@ -4,19 +4,27 @@ import re
 import subprocess
 from collections import Counter, OrderedDict
 from datetime import datetime
+from functools import partial
+from itertools import chain
+from operator import or_
 from tempfile import NamedTemporaryFile
 from time import sleep
+from types import GeneratorType
 from uuid import uuid4
 
+from django.conf import settings
 from django.contrib.auth.models import UserManager
 from django.contrib.contenttypes.models import ContentType
-from django.db import models, IntegrityError
+from django.db import connections, models, transaction, IntegrityError
 from django.db.models import FieldDoesNotExist
 from django.db.models import Max, Q
+from django.db.models.signals import post_save
 
+from .batch import get_sync_batch
 from .ghpool import Connection, ApiError
 from .diffutils import get_encoded_hunks_from_patch
-from .utils import queryset_iterator, SavedObjects
+from .identity_map import identity_map
+from .utils import queryset_iterator, PayloadDigests, SavedObjects
 
 MODE_CREATE = {'create'}
 MODE_UPDATE = {'update'}
@@ -91,7 +99,9 @@ class GithubObjectManager(BaseManager):
                         fetched_at_field='fetched_at',
                         etag_field='etag',
                         force_update=False,
-                        saved_objects=None):
+                        saved_objects=None,
+                        json_stream=False,
+                        bulk=False):
         """
         Trying to get data for the model related to this manager, by using
         identifiers to generate the API call. gh is the connection to use.
@@ -99,6 +109,9 @@ class GithubObjectManager(BaseManager):
         with the value of the field defined by github_date_field greater (only
         if you got a list from github, and we assume that the list is ordered by
         this field, descending)
+        If json_stream is True, a list got from github is decoded entry by
+        entry while creating/updating objects.
+        The bulk argument is passed to create_or_update_from_list.
         """
 
         if saved_objects is None:
@@ -112,12 +125,14 @@ class GithubObjectManager(BaseManager):
             identifiers=identifiers,
             parameters=parameters,
             request_headers=request_headers,
-            response_headers=response_headers
+            response_headers=response_headers,
+            json_stream=json_stream,
         )
-        if isinstance(data, list):
+        if isinstance(data, (list, GeneratorType)):
             result = self.create_or_update_from_list(data, modes, defaults,
                         min_date=min_date, fetched_at_field=fetched_at_field,
-                        saved_objects=saved_objects, force_update=force_update)
+                        saved_objects=saved_objects, force_update=force_update,
+                        bulk=bulk)
         else:
             etag = response_headers.get('etag') or None
             if etag and '""' in etag:
@@ -136,10 +151,12 @@ class GithubObjectManager(BaseManager):
         return result
 
     def get_data_from_github(self, gh, identifiers, parameters=None,
-                             request_headers=None, response_headers=None):
+                             request_headers=None, response_headers=None,
+                             json_stream=False):
         """
         Use the gh connection to get an object from github using the given
-        identifiers
+        identifiers. If json_stream is True and the result is a list, a
+        generator decoding the entries one by one is returned instead.
         """
         gh_callable = self.get_github_callable(gh, identifiers)
         if not parameters:
@@ -150,6 +167,7 @@ class GithubObjectManager(BaseManager):
             try:
                 return gh_callable.get(request_headers=request_headers,
                                        response_headers=response_headers,
+                                       json_stream=json_stream,
                                        **parameters)
             except ApiError, e:
                 if e.response and e.response['code'] == 502:
@@ -168,21 +186,53 @@ class GithubObjectManager(BaseManager):
 
     def create_or_update_from_list(self, data, modes=MODE_ALL, defaults=None,
                                 min_date=None, fetched_at_field='fetched_at',
-                                saved_objects=None, force_update=False):
-        """
-        Take a list of json objects, call create_or_update for each one, and
-        return the list of touched objects. Objects that cannot be created are
-        not returned.
+                                saved_objects=None, force_update=False, bulk=False,
+                                errors=None):
+        """
+        Take a list (or any iterable) of json objects, call create_or_update
+        for each one, and return the list of touched objects. Objects that
+        cannot be created are not returned.
+        If bulk is True, and if the manager allows it (see `can_bulk_update`),
+        use `bulk_create_or_update_from_list` to reduce the number of queries.
+        If `errors` is a list, each object is created/updated in its own
+        savepoint, and integrity errors are appended to this list instead of
+        being raised (not compatible with bulk)
         """
         if saved_objects is None:
             saved_objects = SavedObjects()
 
+        if bulk and errors is None and self.can_bulk_update():
+            return self.bulk_create_or_update_from_list(data, modes, defaults,
+                                                        min_date=min_date,
+                                                        fetched_at_field=fetched_at_field,
+                                                        saved_objects=saved_objects,
+                                                        force_update=force_update)
+
+        batch = get_sync_batch() if errors is not None else None
+
         objs = []
         for entry in data:
-            obj = self.create_or_update_from_dict(entry, modes, defaults,
-                                                  fetched_at_field= fetched_at_field,
-                                                  saved_objects=saved_objects,
-                                                  force_update=force_update)
+            if errors is not None:
+                # to restore the state of the sync if the savepoint is rolled back
+                saved_objects_backup = saved_objects.backup()
+                batch_backup = batch.backup() if batch else None
+                try:
+                    with transaction.atomic(using=self.db):
+                        obj = self.create_or_update_from_dict(entry, modes, defaults,
+                                                              fetched_at_field=fetched_at_field,
+                                                              saved_objects=saved_objects,
+                                                              force_update=force_update)
+                except IntegrityError as e:
+                    saved_objects.restore(saved_objects_backup)
+                    if batch:
+                        batch.restore(batch_backup)
+                    errors.append(e)
+                    continue
+            else:
+                obj = self.create_or_update_from_dict(entry, modes, defaults,
+                                                      fetched_at_field= fetched_at_field,
+                                                      saved_objects=saved_objects,
+                                                      force_update=force_update)
             if obj:
                 objs.append(obj)
                 if min_date and obj.github_date_field:
@@ -191,6 +241,329 @@ class GithubObjectManager(BaseManager):
                         break
         return objs
 
+    def atomic_create_or_update_from_list(self, data, modes=MODE_ALL, defaults=None,
+                                          min_date=None, fetched_at_field='fetched_at',
+                                          saved_objects=None, force_update=False, bulk=False):
+        """
+        Call `create_or_update_from_list` in only one transaction.
+        If an integrity error occurs, this transaction is rolled back and all
+        the objects are created/updated again, in one transaction too, but with
+        a savepoint for each one, to save all the other ones. An integrity
+        error is then raised, so the list is not considered as fetched (the
+        failing objects were passed to `save_prepared_object`, that manages
+        the dual users/repositories).
+        """
+        if saved_objects is None:
+            saved_objects = SavedObjects()
+
+        # keep the entries read by the first try, to read them again if
+        # needed, without reading the other ones now (`data` may be lazy)
+        data = iter(data)
+        read_entries = []
+
+        def read_data():
+            for entry in data:
+                read_entries.append(entry)
+                yield entry
+
+        # to restore the state of the sync before the rollback
+        saved_objects_backup = saved_objects.backup()
+        batch = get_sync_batch()
+        batch_backup = batch.backup() if batch else None
+
+        try:
+            with transaction.atomic(using=self.db):
+                return self.create_or_update_from_list(read_data(), modes, defaults,
+                                                       min_date=min_date,
+                                                       fetched_at_field=fetched_at_field,
+                                                       saved_objects=saved_objects,
+                                                       force_update=force_update,
+                                                       bulk=bulk)
+        except Exception as e:
+            # nothing was saved, so the side effects must not be done
+            saved_objects.restore(saved_objects_backup)
+            if batch:
+                batch.restore(batch_backup)
+            if not isinstance(e, IntegrityError):
+                raise
+            logger.warning('Integrity error when saving a list of objects of the %s kind, '
+                           'saving them again one by one', self.model.__name__)
+
+        errors = []
+        with transaction.atomic(using=self.db):
+            objs = self.create_or_update_from_list(chain(read_entries, read_data()),
+                                                   modes, defaults,
+                                                   min_date=min_date,
+                                                   fetched_at_field=fetched_at_field,
+                                                   saved_objects=saved_objects,
+                                                   force_update=force_update,
+                                                   errors=errors)
+
+        if errors:
+            raise IntegrityError('%d object(s) of the %s kind could not be saved, first error: %s'
+                                 % (len(errors), self.model.__name__, errors[0]))
+
+        return objs
+
+    def can_bulk_update(self):
+        """
+        Tell if `bulk_create_or_update_from_list` can be used for this manager:
+        it's not the case if `create_or_update_from_dict` is overridden,
+        because the bulk version would then skip the specific behavior.
+        """
+        return getattr(self.create_or_update_from_dict, '__func__', None) is \
+               GithubObjectManager.create_or_update_from_dict.__func__
+
+    def can_bulk_save(self):
+        """
+        Tell if objects of this manager can be saved with `bulk_create` and
+        `update` instead of calling `save` for each one: it's only possible if
+        the model doesn't have its own `save` method (or is not inherited from
+        a concrete model), and if the database sets the ids of objects created
+        by `bulk_create` (PostgreSQL does)
+        """
+        return self.model.save.__func__ is models.Model.save.__func__ \
+               and not self.model._meta.parents \
+               and connections[self.db].features.can_return_ids_from_bulk_insert
+
+    def bulk_create_or_update_from_list(self, data, modes=MODE_ALL, defaults=None,
+                                        min_date=None, fetched_at_field='fetched_at',
+                                        saved_objects=None, force_update=False):
+        """
+        Do the same thing as `create_or_update_from_list` but with a lot less
+        queries:
+        - all embedded fk/m2m objects are created/updated in bulk first, one
+          list by field (see `create_or_update_related_from_list`)
+        - locally deleted objects are checked with one call to redis
+        - all existing objects are fetched in one query
+        - existing objects for which the payload is the same as the one used
+          for their last bulk update (see `PayloadDigests`) are not updated,
+          except their "fetched_at" field, in one query
+        - objects to create are inserted in one query if the model doesn't
+          have its own `save` method (see `can_bulk_save`), else one by one
+        - same for objects to update
+        - m2m relations are updated for all objects at once (see
+          `bulk_update_related_field`)
+        - the "FETCHED" status of all objects is set in one query at the end
+          (or one by one if the model has its own `save` method)
+        The `post_save` signal is sent for each object, as if `save` was called.
+        The `min_date` check is done with the fetched values, before touching
+        the database, so all the entries until this date are read first.
+        """
+        if saved_objects is None:
+            saved_objects = SavedObjects()
+
+        # only read entries until the first one older than min_date (included)
+        if min_date and self.model.github_date_field:
+            date_field = self.model.github_date_field[0]
+            date_key = next((key for key, field_name in self.model.github_matching.iteritems()
+                             if field_name == date_field), date_field)
+            entries = []
+            for entry in data:
+                entries.append(entry)
+                entry_date = entry.get(date_key)
+                if entry_date and Connection.parse_date(entry_date) < min_date:
+                    break
+            data = entries
+        else:
+            data = list(data)
+
+        # compute the digests of the payloads before they are altered
+        payload_digests = None
+        if settings.GITHUB_PAYLOAD_DIGESTS and not force_update:
+            payload_digests = PayloadDigests(self.model)
+            extra = PayloadDigests.serialize([defaults, fetched_at_field])
+            digests = [PayloadDigests.compute(entry, extra) for entry in data]
+        else:
+            digests = [None] * len(data)
+
+        # create/update related objects in bulk
+        self.create_or_update_related_from_list(data, defaults, saved_objects)
+
+        # get the fields of all entries
+        entries = []
+        for entry, digest in zip(data, digests):
+            fields = self.get_object_fields_from_dict(entry, defaults, saved_objects)
+            if not fields:
+                continue
+            entries.append((fields, self.get_filters_from_identifiers(fields), digest))
+
+        # ignore locally deleted ones
+        deleted = self.get_locally_deleted([fields for fields, filters, digest in entries
+                                            if not self._get_saved_object(saved_objects, filters)])
+        if deleted:
+            entries = [(fields, filters, digest) for fields, filters, digest in entries
+                       if fields['simple'].get('github_id') not in deleted]
+
+        if not entries:
+            return []
+
+        # load all existing objects in one query
+        existing = self.get_from_filters_list([filters for fields, filters, digest in entries
+                                               if not self._get_saved_object(saved_objects, filters)])
+
+        # and the digests of the payloads used for their last update
+        stored_digests = {}
+        if payload_digests and existing and 'update' in modes:
+            stored_digests = payload_digests.get_many(obj.pk for obj in existing.values())
+
+        # prepare all objects, in memory
+        prepared = []
+        page_objects = {}
+        unchanged = []
+        for fields, filters, digest in entries:
+            key = self.get_key_from_filters(filters)
+            obj = self._get_saved_object(saved_objects, filters)
+            already_saved = obj is not None
+            if obj is None:
+                obj = page_objects.get(key)
+                already_saved = obj is not None
+            if obj is None:
+                obj = existing.get(key)
+                if obj is not None:
+                    saved_objects.set_object(self.model, filters, obj)
+                    # nothing to update if we already got the same payload
+                    if digest and stored_digests.get(obj.pk) == digest \
+                            and obj.github_status == obj.GITHUB_STATUS_CHOICES.FETCHED:
+                        page_objects[key] = obj
+                        unchanged.append((obj, filters))
+                        prepared.append((obj, fields, filters, digest, True, [], None))
+                        continue
+            obj, already_saved, updated_fields, save_params = self.prepare_object_from_fields(
+                fields, obj, already_saved, modes, fetched_at_field=fetched_at_field,
+                saved_objects=saved_objects, force_update=force_update)
+            if not obj:
+                continue
+            if save_params is not None:
+                page_objects[key] = obj
+            prepared.append((obj, fields, filters, digest, already_saved, updated_fields, save_params))
+
+        # only touch the fetched date of unchanged objects
+        if unchanged:
+            now = datetime.utcnow()
+            self.filter(pk__in=[obj.pk for obj, filters in unchanged]).update(**{fetched_at_field: now})
+            self.invalidate_identity_map(obj for obj, filters in unchanged)
+            for obj, filters in unchanged:
+                setattr(obj, fetched_at_field, now)
+                self.set_in_identity_map(filters, obj)
+
+        # save the objects
+        to_create = []
+        to_update = []
+        for obj, fields, filters, digest, already_saved, updated_fields, save_params in prepared:
+            if save_params is None:
+                continue
+            if save_params.get('force_insert'):
+                if self.can_bulk_save():
+                    to_create.append(obj)
+                else:
+                    self.save_prepared_object(obj, save_params)
+            elif self.can_bulk_save():
+                to_update.append((obj, updated_fields))
+            else:
+                self.save_prepared_object(obj, save_params)
+
+        self.bulk_create_prepared_objects(to_create)
+        self.bulk_update_prepared_objects(to_update)
+
+        # save lists now that we have objects
+        related_ids = OrderedDict()
+        for obj, fields, filters, digest, already_saved, updated_fields, save_params in prepared:
+            self.save_many_fields(obj, fields, already_saved, saved_objects, filters, related_ids)
+        for field_name, objs_ids in related_ids.iteritems():
+            self.model.bulk_update_related_field(field_name, objs_ids)
+
+        to_set_fetched = []
+        for obj, fields, filters, digest, already_saved, updated_fields, save_params in prepared:
+            if self.needs_fetched_status(obj, already_saved):
+                obj.github_status = obj.GITHUB_STATUS_CHOICES.FETCHED
+                to_set_fetched.append((obj, list(set(updated_fields).union({'github_status'}))))
+
+        if to_set_fetched and self.can_bulk_save():
+            self.filter(pk__in=[obj.pk for obj, update_fields in to_set_fetched]).update(
+                github_status=self.model.GITHUB_STATUS_CHOICES.FETCHED)
+            for obj, update_fields in to_set_fetched:
+                self.send_post_save(obj, update_fields=update_fields)
+        else:
+            # the `save` method of the model may do more than saving fields
+            for obj, update_fields in to_set_fetched:
+                obj.save(update_fields=update_fields)
+
+        # keep the digests of the payloads of the saved objects, when really saved
+        if payload_digests:
+            saved_digests = {
+                obj.pk: digest
+                for obj, fields, filters, digest, already_saved, updated_fields, save_params in prepared
+                if save_params is not None and obj.github_status == obj.GITHUB_STATUS_CHOICES.FETCHED
+            }
+            if saved_digests:
+                transaction.on_commit(partial(payload_digests.set_many, saved_digests), using=self.db)
+
+        return [obj for obj, fields, filters, digest, already_saved, updated_fields, save_params in prepared]
+
+    def bulk_create_prepared_objects(self, objs):
+        """
+        Insert all the given objects, prepared by `prepare_object_from_fields`,
+        in one query. If it fails because of an integrity error, save them one
+        by one to manage it
+        """
+        if not objs:
+            return
+
+        try:
+            with transaction.atomic(using=self.db):
+                self.bulk_create(objs)
+        except IntegrityError:
+            for obj in objs:
+                self.save_prepared_object(obj, {'force_insert': True})
+        else:
+            for obj in objs:
+                self.send_post_save(obj, created=True)
+
+    def bulk_update_prepared_objects(self, objs):
+        """
+        Update all the given objects, prepared by `prepare_object_from_fields`,
+        in one query. `objs` is a list of tuples with the object and the list
+        of fields to update. If it fails because of an integrity error, save
+        them one by one to manage it
+        """
+        if not objs:
+            return
+
+        cases = {}
+        for obj, updated_fields in objs:
+            for field_name in updated_fields:
+                field = self.model._meta.get_field(field_name)
+                cases.setdefault(field, []).append(models.When(
+                    pk=obj.pk,
+                    then=models.Value(getattr(obj, field.attname),
+                                      output_field=field.target_field if field.is_relation else field)
+                ))
+
+        try:
+            with transaction.atomic(using=self.db):
+                self.filter(pk__in=[obj.pk for obj, updated_fields in objs]).update(**{
+                    field.name: models.Case(*whens, default=models.F(field.attname))
+                    for field, whens in cases.iteritems()
+                })
+        except IntegrityError:
+            for obj, updated_fields in objs:
+                self.save_prepared_object(obj, {'force_update': True, 'update_fields': updated_fields})
+        else:
+            for obj, updated_fields in objs:
+                self.send_post_save(obj, update_fields=updated_fields)
+
+    def send_post_save(self, obj, created=False, update_fields=None):
+        """
+        Send the `post_save` signal for an object saved without calling its
+        `save` method
+        """
+        obj._state.adding = False
+        obj._state.db = self.db
+        post_save.send(sender=self.model, instance=obj, created=created,
+                       update_fields=frozenset(update_fields) if update_fields else None,
+                       raw=False, using=self.db)
+
     def get_filters_from_identifiers(self, fields, identifiers=None):
         """
         Return the filters to use as argument to a Queryset to retrieve an
@@ -207,6 +580,33 @@ class GithubObjectManager(BaseManager):
                 filters[field] = fields['simple'][lookup]
         return filters
 
+    @property
+    def identity_map(self):
+        """
+        Return the process-wide identity map if the model uses it, else None
+        """
+        if getattr(self.model, 'use_identity_map', False):
+            return identity_map
+        return None
+
+    def invalidate_identity_map(self, objs):
+        """
+        Remove the given objects from the identity map, in all processes. To
+        be called after updating them with `update`, as the `post_save` signal
+        doing it is not sent (unless sent by `send_post_save`)
+        """
+        if self.identity_map:
+            self.identity_map.invalidate_many(self.model, (obj.pk for obj in objs), using=self.db)
+
+    def set_in_identity_map(self, filters, obj):
+        """
+        Store the given object in the identity map, if the model uses it, but
+        not in a transaction, as it may be rolled back, and other processes
+        would not see the object before the commit
+        """
+        if self.identity_map and not connections[self.db].in_atomic_block:
+            self.identity_map.set(self.model, filters, obj)
+
     def get_from_identifiers(self, fields, identifiers=None, saved_objects=None):
         """
         Try to load an existing object from the given fields, using the
@@ -229,12 +629,65 @@ class GithubObjectManager(BaseManager):
             return saved_objects.get_object(self.model, filters), True
         except KeyError:
             pass
+
+        obj = self.identity_map.get(self.model, filters) if self.identity_map else None
+        if obj is None:
+            try:
+                obj = self.get(**filters)
+            except self.model.DoesNotExist:
+                return None, False
+            self.set_in_identity_map(filters, obj)
+
+        saved_objects.set_object(self.model, filters, obj)
+        return obj, False
+
+    def get_key_from_filters(self, filters):
+        """
+        Return a hashable version of the given filters, to be used as a key
+        """
+        return tuple(sorted(filters.items()))
+
+    def _get_saved_object(self, saved_objects, filters):
         try:
-            obj = self.get(**filters)
-            saved_objects.set_object(self.model, filters, obj)
-            return obj, False
-        except self.model.DoesNotExist:
-            return None, False
+            return saved_objects.get_object(self.model, filters)
+        except KeyError:
+            return None
+
+    def get_from_filters_list(self, filters_list):
+        """
+        Load, in one query, all existing objects matching the given filters,
+        as returned by get_filters_from_identifiers (so all with the same keys)
+        Return a dict with, as key, the result of get_key_from_filters for each
+        filters matching an object, and this object as value.
+        """
+        if not filters_list:
+            return {}
+
+        result = {}
+        if self.identity_map:
+            missing_filters_list = []
+            for filters in filters_list:
+                obj = self.identity_map.get(self.model, filters)
+                if obj is None:
+                    missing_filters_list.append(filters)
+                else:
+                    result[self.get_key_from_filters(filters)] = obj
+            filters_list = missing_filters_list
+            if not filters_list:
+                return result
+
+        names = sorted(filters_list[0].keys())
+        condition = reduce(or_, [Q(**filters) for filters in filters_list])
+        pks = {
+            tuple(zip(names, row[1:])): row[0]
+            for row in self.filter(condition).values_list('pk', *names)
+        }
+        objs = self.in_bulk(pks.values())
+        for key, pk in pks.iteritems():
+            if pk in objs:
+                result[key] = objs[pk]
+                self.set_in_identity_map(dict(key), objs[pk])
+        return result
 
     def create_or_update_from_dict(self, data, modes=MODE_ALL, defaults=None,
                             fetched_at_field='fetched_at', etag_field='etag',
@@ -252,153 +705,216 @@ class GithubObjectManager(BaseManager):
         if saved_objects is None:
             saved_objects = SavedObjects()
 
-        def _create_or_update(obj=None):
+        # no need to check more if already saved during this sync
+        obj = self._get_saved_object(saved_objects, self.get_filters_from_identifiers(fields))
+        already_saved = obj is not None
+
+        if not already_saved:
             # abort if locally deleted
-            from gim.core.limpyd_models import DeletedInstance
-            from gim.core.models.base import GithubObjectWithId
-            if issubclass(self.model, GithubObjectWithId):
-                github_id = fields.get('simple', {}).get('github_id')
-                if github_id and DeletedInstance.exist_for_model_and_id(self.model, github_id):
-                    return None, False, []
+            if self.is_locally_deleted(fields):
+                return None
 
             # get or create a new object
-            to_create = False
-            if obj:
-                already_saved = False
-            else:
-                obj, already_saved = self.get_from_identifiers(fields, saved_objects=saved_objects)
-            if not obj:
-                if 'create' not in modes:
-                    return None, False, []
-                to_create = True
-                obj = self.model()
-                obj.is_new = True  # may serve later
-            else:
-                if 'update' not in modes:
-                    return None, False, []
-                # don't update object waiting to be updated or deleted
-                if not ignore_github_status and obj.github_status in obj.GITHUB_STATUS_CHOICES.ALL_WAITING:
-                    if not already_saved:
-                        saved_objects.set_object(self.model, self.get_filters_from_identifiers(fields), obj)
-                    return obj, True, []
-                # don't update object with old data
-                if not force_update:
-                    updated_at = getattr(obj, 'updated_at', None)
-                    if updated_at:
-                        new_updated_at = fields['simple'].get('updated_at')
-                        if new_updated_at and new_updated_at < updated_at:
-                            if not already_saved:
-                                saved_objects.set_object(self.model, self.get_filters_from_identifiers(fields), obj)
-                            return obj, True, []
-                if already_saved:
-                    return obj, True, []
-
-            updated_fields = []
-
-            # store simple fields if needed
-            if fields['simple']:
-                for field, value in fields['simple'].iteritems():
-                    if not hasattr(obj, field):
-                        # Ignore fields not in model
-                        continue
-                    if getattr(obj, field) == value:
-                        # Ignore not-updated fields
-                        continue
-                    updated_fields.append(field)
-                    setattr(obj, field, value)
-
-            # store FKs if needed
-            if fields['fk']:
-                for field, value in fields['fk'].iteritems():
-                    pk_field = '%s_id' % field
-                    if not hasattr(obj, pk_field):
-                        # Ignore fields not in model
-                        continue
-                    pk_value = value.id if value else None
-                    if pk_value is None and not obj._meta.get_field(field).null:
-                        # do not set None FKs if not allowed
-                        continue
-                    if getattr(obj, pk_field) == pk_value:
-                        # Ignore not-updated fields
-                        continue
-                    updated_fields.append(field)
-                    setattr(obj, field, value)
-                    # fill the django cache for FKs
-                    if value and not isinstance(value, (int, long, basestring)):
-                        setattr(obj, '_%s_cache' % field, value)
-
-            # always update these the date it was fetched
-            setattr(obj, fetched_at_field, datetime.utcnow())
-
-            # and a status if changed
-            wanted_status = obj.GITHUB_STATUS_CHOICES.FETCHED
-            if updated_fields:
-                wanted_status = obj.GITHUB_STATUS_CHOICES.SAVING
-            else:
-                for field, values in fields['many'].iteritems():
-                    if not isinstance(values, dict):
-                        wanted_status = obj.GITHUB_STATUS_CHOICES.SAVING
-                        break
+            obj, already_saved = self.get_from_identifiers(fields, saved_objects=saved_objects)
 
-            new_status = obj.github_status != wanted_status
-            obj.github_status = wanted_status
+        obj, already_saved, updated_fields, save_params = self.prepare_object_from_fields(
+            fields, obj, already_saved, modes, fetched_at_field, etag_field, saved_objects,
+            force_update, etag, ignore_github_status)
 
-            # force update or insert to avoid a exists() call in db
-            if to_create:
-                save_params = {'force_insert': True}
-            else:
-                updated_fields.append(fetched_at_field)
-                if new_status:
-                    updated_fields.append('github_status')
-                if etag and hasattr(obj, etag_field) and getattr(obj, etag_field) != etag:
-                    setattr(obj, etag_field, etag)
-                    updated_fields.append(etag_field)
-                save_params = {
-                    'force_update': True,
-                    # only save updated fields
-                    'update_fields': updated_fields,
-                }
+        if not obj:
+            return None
 
-            try:
-                obj.save(**save_params)
-            except IntegrityError as e:
-
-                # If it's because of a user or repository, manage it
-                from .models import GithubUser, Repository
-
-                if isinstance(obj, GithubUser):
-                    from .tasks.githubuser import ManageDualUser
-                    ManageDualUser.add_job(obj.username, new_github_id=obj.github_id)
-                if isinstance(obj, Repository):
-                    from .tasks.repository import ManageDualRepository
-                    ManageDualRepository.add_job(
-                        '%s/%s' % (obj.owner_id, obj.name),
-                        new_github_id=obj.github_id
-                    )
+        if save_params is not None:
+            self.save_prepared_object(obj, save_params)
 
-                # Log and raise the error, with useful data
-                message = 'Integrity error [%s] when saving object %s: %s'
-                vars_obj = {
-                    k: v for k, v in vars(obj).items()
-                    if k != '_state' and not (k.startswith('_') and k.endswith('_cache'))
-                }
-                args = (e, obj.model_name, vars_obj)
-                logger.error(message, *args)
-                raise IntegrityError(message % args)
+        # finally save lists now that we have an object
+        self.save_many_fields(obj, fields, already_saved, saved_objects)
 
-            return obj, False, updated_fields
+        if self.needs_fetched_status(obj, already_saved, ignore_github_status):
+            obj.github_status = obj.GITHUB_STATUS_CHOICES.FETCHED
+            # We pass the same updated fields as before as they may be used by the signals
+            obj.save(update_fields=list(set(updated_fields).union({'github_status'})))
+
+        return obj
+
+    def is_locally_deleted(self, fields):
+        """
+        Tell if the object defined by the given fields was deleted locally
+        """
+        from gim.core.limpyd_models import DeletedInstance
+        from gim.core.models.base import GithubObjectWithId
+        if issubclass(self.model, GithubObjectWithId):
+            github_id = fields.get('simple', {}).get('github_id')
+            if github_id and DeletedInstance.exist_for_model_and_id(self.model, github_id):
+                return True
+        return False
 
-        obj, already_saved, updated_fields = _create_or_update()
+    def get_locally_deleted(self, fields_list):
+        """
+        Return the set of github ids of the objects defined by the given list
+        of fields that were deleted locally, with only one call to redis
+        """
+        from gim.core.limpyd_models import DeletedInstance
+        from gim.core.models.base import GithubObjectWithId
+        if not issubclass(self.model, GithubObjectWithId):
+            return set()
+        github_ids = [fields.get('simple', {}).get('github_id') for fields in fields_list]
+        return {github_id for model, github_id in DeletedInstance.exist_for_models_and_ids(
+            [(self.model, github_id) for github_id in github_ids if github_id]
+        )}
 
+    def prepare_object_from_fields(self, fields, obj, already_saved, modes=MODE_ALL,
+                                   fetched_at_field='fetched_at', etag_field='etag',
+                                   saved_objects=None, force_update=False, etag=None,
+                                   ignore_github_status=False):
+        """
+        Update the given object (or a new one if None) with the given fields,
+        but without saving it.
+        Return a tuple with the object (None if it cannot be created or
+        updated), a boolean telling if the object was already saved, the list
+        of updated fields, and the parameters to pass to `save_prepared_object`
+        (None if there is nothing to save)
+        """
+        if saved_objects is None:
+            saved_objects = SavedObjects()
+
+        to_create = False
         if not obj:
-            return None
+            if 'create' not in modes:
+                return None, False, [], None
+            to_create = True
+            obj = self.model()
+            obj.is_new = True  # may serve later
+        else:
+            if 'update' not in modes:
+                return None, False, [], None
+            # don't update object waiting to be updated or deleted
+            if not ignore_github_status and obj.github_status in obj.GITHUB_STATUS_CHOICES.ALL_WAITING:
+                if not already_saved:
+                    saved_objects.set_object(self.model, self.get_filters_from_identifiers(fields), obj)
+                return obj, True, [], None
+            # don't update object with old data
+            if not force_update:
+                updated_at = getattr(obj, 'updated_at', None)
+                if updated_at:
+                    new_updated_at = fields['simple'].get('updated_at')
+                    if new_updated_at and new_updated_at < updated_at:
+                        if not already_saved:
+                            saved_objects.set_object(self.model, self.get_filters_from_identifiers(fields), obj)
+                        return obj, True, [], None
+            if already_saved:
+                return obj, True, [], None
+
+        updated_fields = []
+
+        # store simple fields if needed
+        if fields['simple']:
+            for field, value in fields['simple'].iteritems():
+                if not hasattr(obj, field):
+                    # Ignore fields not in model
+                    continue
+                if getattr(obj, field) == value:
+                    # Ignore not-updated fields
+                    continue
+                updated_fields.append(field)
+                setattr(obj, field, value)
+
+        # store FKs if needed
+        if fields['fk']:
+            for field, value in fields['fk'].iteritems():
+                pk_field = '%s_id' % field
+                if not hasattr(obj, pk_field):
+                    # Ignore fields not in model
+                    continue
+                pk_value = value.id if value else None
+                if pk_value is None and not obj._meta.get_field(field).null:
+                    # do not set None FKs if not allowed
+                    continue
+                if getattr(obj, pk_field) == pk_value:
+                    # Ignore not-updated fields
+                    continue
+                updated_fields.append(field)
+                setattr(obj, field, value)
+                # fill the django cache for FKs
+                if value and not isinstance(value, (int, long, basestring)):
+                    setattr(obj, '_%s_cache' % field, value)
+
+        # always update these the date it was fetched
+        setattr(obj, fetched_at_field, datetime.utcnow())
+
+        # and a status if changed
+        wanted_status = obj.GITHUB_STATUS_CHOICES.FETCHED
+        if updated_fields:
+            wanted_status = obj.GITHUB_STATUS_CHOICES.SAVING
+        else:
+            for field, values in fields['many'].iteritems():
+                if not isinstance(values, dict):
+                    wanted_status = obj.GITHUB_STATUS_CHOICES.SAVING
+                    break
 
-        continue_update = not already_saved \
-                          or getattr(obj, 'is_new', False) \
-                          or ignore_github_status \
-                          or obj.github_status not in obj.GITHUB_STATUS_CHOICES.ALL_WAITING
+        new_status = obj.github_status != wanted_status
+        obj.github_status = wanted_status
 
-        # finally save lists now that we have an object
+        # force update or insert to avoid a exists() call in db
+        if to_create:
+            save_params = {'force_insert': True}
+        else:
+            updated_fields.append(fetched_at_field)
+            if new_status:
+                updated_fields.append('github_status')
+            if etag and hasattr(obj, etag_field) and getattr(obj, etag_field) != etag:
+                setattr(obj, etag_field, etag)
+                updated_fields.append(etag_field)
+            save_params = {
+                'force_update': True,
+                # only save updated fields
+                'update_fields': updated_fields,
+            }
+
+        return obj, False, updated_fields, save_params
+
+    def save_prepared_object(self, obj, save_params):
+        """
+        Save an object prepared by `prepare_object_from_fields`, managing
+        integrity errors
+        """
+        try:
+            obj.save(**save_params)
+        except IntegrityError as e:
+
+            # If it's because of a user or repository, manage it
+            from .models import GithubUser, Repository
+
+            if isinstance(obj, GithubUser):
+                from .tasks.githubuser import ManageDualUser
+                ManageDualUser.add_job(obj.username, new_github_id=obj.github_id)
+            if isinstance(obj, Repository):
+                from .tasks.repository import ManageDualRepository
+                ManageDualRepository.add_job(
+                    '%s/%s' % (obj.owner_id, obj.name),
+                    new_github_id=obj.github_id
+                )
+
+            # Log and raise the error, with useful data
+            message = 'Integrity error [%s] when saving object %s: %s'
+            vars_obj = {
+                k: v for k, v in vars(obj).items()
+                if k != '_state' and not (k.startswith('_') and k.endswith('_cache'))
+            }
+            args = (e, obj.model_name, vars_obj)
+            logger.error(message, *args)
+            raise IntegrityError(message % args)
+
+    def save_many_fields(self, obj, fields, already_saved, saved_objects, filters=None,
+                         related_ids=None):
+        """
+        Save the "many" fields of an object created/updated from fields, and
+        then save the object in the saved_objects cache.
+        If `related_ids` is given, the relations are not updated but, for each
+        field, a tuple with the object and the ids to link to it is added to
+        the `related_ids` dict (a list by field name), to be passed to
+        `bulk_update_related_field`
+        """
         for field, values in fields['many'].iteritems():
             if isinstance(values, dict):
                 # we have info for how to create/update fields
@@ -421,18 +937,26 @@ class GithubObjectManager(BaseManager):
                 )
 
             if not already_saved:
-                obj.update_related_field(field, [o.id for o in values])
+                if related_ids is None:
+                    obj.update_related_field(field, [o.id for o in values])
+                else:
+                    related_ids.setdefault(field, []).append((obj, [o.id for o in values]))
 
         if not already_saved:
             # save object in the cache
-            saved_objects.set_object(self.model, self.get_filters_from_identifiers(fields), obj)
+            saved_objects.set_object(self.model, filters or self.get_filters_from_identifiers(fields), obj)
 
-        if continue_update and obj.github_status != obj.GITHUB_STATUS_CHOICES.FETCHED:
-            obj.github_status = obj.GITHUB_STATUS_CHOICES.FETCHED
-            # We pass the same updated fields as before as they may be used by the signals
-            obj.save(update_fields=list(set(updated_fields).union({'github_status'})))
+    def needs_fetched_status(self, obj, already_saved, ignore_github_status=False):
+        """
+        Tell if the status of an object created/updated from fields must be
+        set to FETCHED now that all is saved
+        """
+        continue_update = not already_saved \
+                          or getattr(obj, 'is_new', False) \
+                          or ignore_github_status \
+                          or obj.github_status not in obj.GITHUB_STATUS_CHOICES.ALL_WAITING
 
-        return obj
+        return continue_update and obj.github_status != obj.GITHUB_STATUS_CHOICES.FETCHED
 
     def get_object_fields_from_dict(self, data, defaults=None, saved_objects=None):
         """
@@ -454,10 +978,8 @@ class GithubObjectManager(BaseManager):
 
         # reduce data to keep only wanted fields
         for key in data.keys():
-            if key.startswith('_') or \
-                key.endswith('etag') or \
-                key.endswith('fetched_at') or \
-                key in self.model.github_ignore:
+            conversion = self.get_field_conversion(key)
+            if conversion and conversion[0] == 'ignore':
                 del data[key]
 
         if saved_objects is None:
@@ -472,73 +994,42 @@ class GithubObjectManager(BaseManager):
         # run for each field in the dict
         for key, value in data.iteritems():
 
-            # maybe we use a different field name on our side
-            field_name = self.get_matching_field(key)
-
-            try:
-                # get information about the field
-                field = self.model._meta.get_field(field_name)
-            except models.FieldDoesNotExist:
+            conversion = self.get_field_conversion(key)
+            if not conversion:
                 # there is not field for the given key, we pass to the next key
                 continue
-            else:
-                is_field_direct = not field.auto_created or field.concrete
-                is_field_m2m = field.is_relation and field.many_to_many
-
-            # work depending of the field type
-            # TODO: manage OneToOneField, not yet used in our models
-            if is_field_m2m or not is_field_direct or isinstance(field, models.ForeignKey):
-                # we have many objects to create: m2m
-                # or we have an external object to create: fk
+
+            kind, field_name, field = conversion
+
+            if kind == 'simple':
+                fields['simple'][field_name] = value
+
+            elif kind == 'date':
+                # all github datetime are utc, so we can remove the timezome
+                fields['simple'][field_name] = Connection.parse_date(value) if value else None
+
+            elif kind == 'many':
                 if value:
-                    model = field.related_model
-                    defaults_related = {}
-
-                    if defaults and 'related' in defaults:
-                        if field_name in defaults['related']:
-                            defaults_related = defaults['related'][field_name]
-                        elif field_name in defaults['related'].get('*', {}):
-                            defaults_related = defaults['related']['*'][field_name]
-                        if '*' in defaults['related'] and '*' not in defaults_related:
-                            defaults_related.update(defaults['related']['*'])
-
-                    if is_field_m2m or not is_field_direct:  # not sure: a list for a "not direct ?" (a through ?)
-                        # fields['many'][field_name] = model.objects\
-                        #     .create_or_update_from_list(data=value,
-                        #                                 defaults=defaults_related,
-                        #                                 saved_objects=saved_objects)
-
-                        # pass info to create objects later instead of creating
-                        # them now as the model may need the current object to
-                        # be fully created (a CommitFile need the Commit)
-                        fields['many'][field_name] = {
-                            'model': model,
-                            'related_name': field.field.name if hasattr(field, 'field') else None,
-                            'data': value,
-                            'defaults': defaults_related,
-                        }
-                    else:
-                        fields['fk'][field_name] = model.objects\
-                            .create_or_update_from_dict(data=value,
-                                                        defaults=defaults_related,
-                                                        saved_objects=saved_objects)
+                    # pass info to create objects later instead of creating
+                    # them now as the model may need the current object to
+                    # be fully created (a CommitFile need the Commit)
+                    fields['many'][field_name] = {
+                        'model': field.related_model,
+                        'related_name': field.field.name if hasattr(field, 'field') else None,
+                        'data': value,
+                        'defaults': self.get_related_defaults(defaults, field_name),
+                    }
                 else:
-                    if is_field_m2m or not is_field_direct:
-                        fields['many'][field_name] = []
-                    else:
-                        fields['fk'][field_name] = None
+                    fields['many'][field_name] = []
 
-            elif isinstance(field, models.DateTimeField):
-                # we need to convert a datetimefield
+            else:  # fk
                 if value:
-                    # all github datetime are utc, so we can remove the timezome
-                    fields['simple'][field_name] = Connection.parse_date(value)
+                    fields['fk'][field_name] = field.related_model.objects\
+                        .create_or_update_from_dict(data=value,
+                                                    defaults=self.get_related_defaults(defaults, field_name),
+                                                    saved_objects=saved_objects)
                 else:
-                    fields['simple'][field_name] = None
-
-            else:
-                # it's a simple field
-                fields['simple'][field_name] = value
+                    fields['fk'][field_name] = None
 
         # add default fields
         if defaults:
@@ -551,6 +1042,128 @@ class GithubObjectManager(BaseManager):
 
         return fields
 
+    def get_field_conversion(self, key):
+        """
+        Return how to convert the value of the given key of a json object from
+        the github api, as a tuple with the kind of conversion, the name of the
+        model field, and this field. The kind of conversion can be:
+            - 'ignore' if the key must be removed from the data
+            - 'simple' for a simple value to use as is
+            - 'date' for a date to parse
+            - 'fk' for an object to create/update
+            - 'many' for a list of objects to create/update later
+        Return None if there is no field in the model for this key.
+        It is computed only once for each key, and then cached.
+        """
+        try:
+            return self._fields_conversions[key]
+        except AttributeError:
+            self._fields_conversions = {}
+        except KeyError:
+            pass
+
+        conversion = self._fields_conversions[key] = self.compute_field_conversion(key)
+        return conversion
+
+    def compute_field_conversion(self, key):
+        """
+        Compute the value to be returned by `get_field_conversion` for the
+        given key
+        """
+        if key.startswith('_') or \
+            key.endswith('etag') or \
+            key.endswith('fetched_at') or \
+            key in self.model.github_ignore:
+            return 'ignore', None, None
+
+        # maybe we use a different field name on our side
+        field_name = self.get_matching_field(key)
+
+        try:
+            # get information about the field
+            field = self.model._meta.get_field(field_name)
+        except models.FieldDoesNotExist:
+            return None
+
+        is_field_direct = not field.auto_created or field.concrete
+        is_field_m2m = field.is_relation and field.many_to_many
+
+        # work depending of the field type
+        # TODO: manage OneToOneField, not yet used in our models
+        if is_field_m2m or not is_field_direct:  # not sure: a list for a "not direct ?" (a through ?)
+            # we have many objects to create: m2m
+            kind = 'many'
+        elif isinstance(field, models.ForeignKey):
+            # we have an external object to create: fk
+            kind = 'fk'
+        elif isinstance(field, models.DateTimeField):
+            # we need to convert a datetimefield
+            kind = 'date'
+        else:
+            # it's a simple field
+            kind = 'simple'
+
+        return kind, field_name, field
+
+    def get_related_defaults(self, defaults, field_name):
+        """
+        Return the "defaults" dict to use to create/update the objects related
+        to the given field, from the "related" entry of the given defaults.
+        """
+        defaults_related = {}
+
+        if defaults and 'related' in defaults:
+            if field_name in defaults['related']:
+                defaults_related = defaults['related'][field_name]
+            elif field_name in defaults['related'].get('*', {}):
+                defaults_related = defaults['related']['*'][field_name]
+            if '*' in defaults['related'] and '*' not in defaults_related:
+                defaults_related.update(defaults['related']['*'])
+
+        return defaults_related
+
+    def create_or_update_related_from_list(self, data, defaults=None, saved_objects=None):
+        """
+        Taking a list of json objects, collect, for each fk and m2m field, all
+        related objects embedded in these json objects (users, milestone,
+        labels...), and create/update them in bulk, one list by field, before
+        creating/updating the main objects.
+        As the created/updated objects are stored in saved_objects, they will
+        then be retrieved from it when the main objects will be processed.
+        """
+        if saved_objects is None:
+            saved_objects = SavedObjects()
+
+        related = OrderedDict()
+        for entry in data:
+            for key, value in entry.iteritems():
+                if not value:
+                    continue
+                conversion = self.get_field_conversion(key)
+                if not conversion:
+                    continue
+                kind, field_name, field = conversion
+                if kind == 'many':
+                    if field.auto_created and not field.concrete:
+                        # related objects may need the main object to be created
+                        continue
+                    if isinstance(value, list):
+                        related.setdefault(field_name, (field, []))[1].extend(value)
+                elif kind == 'fk':
+                    if isinstance(value, dict):
+                        related.setdefault(field_name, (field, []))[1].append(value)
+
+        for field_name, (field, values) in related.iteritems():
+            if not field.related_model.objects.can_bulk_update():
+                # will be created/updated one by one with the main objects
+                continue
+            field.related_model.objects.create_or_update_from_list(
+                data=values,
+                defaults=self.get_related_defaults(defaults, field_name),
+                saved_objects=saved_objects,
+                bulk=True,
+            )
+
 
 class WithRepositoryManager(GithubObjectManager):
     """
@@ -1092,6 +1705,12 @@ class CommitManager(WithRepositoryManager):
 
         # We got commits from the list of commits of a PR, so we don't have files and comments
         if obj and not only_commits and (not obj.files_fetched_at or not obj.commit_comments_fetched_at):
+            if settings.GITHUB_BATCH_COMMITS:
+                # fetched with many other ones by a `FetchPendingCommits` job
+                from gim.core.models import Repository
+                Repository.add_pending_commits(obj.repository_id, [obj.sha])
+                return obj
+
             kwargs = {}
             if not obj.files_fetched_at:
                 kwargs['force_fetch'] = 1
@@ -5,16 +5,28 @@ __all__ = [
     'REVIEW_STATES'
 ]
 
+import logging
+import sys
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 from itertools import product
 from math import ceil
+from operator import or_
+from multiprocessing.pool import ThreadPool
+from Queue import Full, Queue
+from threading import Event, Thread
+from time import time
+from types import GeneratorType
 from urlparse import urlsplit, parse_qs
 
-from django.db import models, DatabaseError
+from django.conf import settings
+from django.db import models, router, DatabaseError
+from django.db.models.signals import m2m_changed
 from django.utils.functional import cached_property
 
 from extended_choices import Choices
 
+from gim.core.batch import sync_batch
 from gim.core.limpyd_models import DeletedInstance
 from ..ghpool import (
     ApiError,
@@ -27,6 +39,8 @@ from ..utils import SavedObjects
 
 from . import django_m2m_descriptor_hack  # replace clear+add by remove+add
 
+logger = logging.getLogger('gim.log')
+
 
 class MinDateRaised(Exception):
     pass
@@ -108,6 +122,9 @@ class GithubObject(models.Model):
 
     delete_missing_after_fetch = True
 
+    # keep objects in the process-wide identity map (see gim.core.identity_map)
+    use_identity_map = False
+
     class Meta:
         abstract = True
         app_label = 'core'
@@ -187,7 +204,7 @@ class GithubObject(models.Model):
                     parameters=None, remove_missing=True, force_fetch=False,
                     meta_base_name=None, modes=MODE_ALL, max_pages=None,
                     filter_queryset=None, github_api_version=None,
-                    do_remove_if_max_pages_raised=False):
+                    do_remove_if_max_pages_raised=False, parallel_pages=None):
         """
         Fetch data from github for the given m2m or related field.
         If defined, "vary" is a dict of list of parameters to fetch. For each
@@ -202,6 +219,12 @@ class GithubObject(models.Model):
         base, simply pass it to the `meta_base_name` argument.
         Mode must be a tuple containing none, one or both of "create" and
         "update". If None is passed, the default is both values.
+        If `parallel_pages` is set, and github tells us which page is the last
+        one, the next pages are fetched with at most this number of requests at
+        the same time, but they are still saved one after the other, in order.
+        Else, if `parallel_pages` and `settings.GITHUB_PIPELINED_FETCH` are
+        set, the next pages are fetched in a thread, one after the other, while
+        the previous ones are saved.
         """
         field = self._meta.get_field(field_name)
         model = field.related_model
@@ -260,16 +283,23 @@ class GithubObject(models.Model):
                     github_format=model.github_format,
                     version=github_api_version or model.github_api_version)
 
-        def fetch_page_and_next(objs, parameters, min_date):
+        # filled with the number of the last page if github gives it
+        pagination = {}
+
+        def fetch_page_and_next(objs, parameters, min_date, prefetched=None):
             """
             Fetch a page of objects with the given parameters, and if github
             tell us there is a "next" page, tell caller to continue fetching by
             returning the parameters for the next page as first return argument
             (or None if no next page).
             Return the etag header of the page as second argument
+            If `prefetched` is given, the page was already fetched (see
+            `prefetch_page`), so we only create/update the objects.
 
             """
-            if not first_response_headers:
+            if prefetched is not None:
+                data, response_headers, exc_info = prefetched
+            elif not first_response_headers:
                 response_headers = first_response_headers
             else:
                 response_headers = {}
@@ -279,18 +309,34 @@ class GithubObject(models.Model):
             page_objs = []
 
             try:
-                page_objs = model.objects.get_from_github(
-                    gh=gh,
-                    identifiers=identifiers,
-                    modes=modes,
-                    defaults=defaults,
-                    parameters=parameters,
-                    request_headers=request_headers,
-                    response_headers=response_headers,
-                    min_date=min_date,
-                    force_update=force_fetch,
-                    saved_objects=saved_objects,
-                )
+                if prefetched is None:
+                    data = model.objects.get_data_from_github(
+                        gh=gh,
+                        identifiers=identifiers,
+                        parameters=parameters,
+                        request_headers=request_headers,
+                        response_headers=response_headers,
+                        json_stream=True,
+                    )
+                elif exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                # side effects of saved objects are done once for the whole page
+                with sync_batch():
+                    if settings.GITHUB_ATOMIC_PAGES:
+                        # and the whole page is saved in one transaction
+                        create_or_update_from_list = model.objects.atomic_create_or_update_from_list
+                    else:
+                        create_or_update_from_list = model.objects.create_or_update_from_list
+                    page_objs = create_or_update_from_list(
+                        data,
+                        modes=modes,
+                        defaults=defaults,
+                        min_date=min_date,
+                        saved_objects=saved_objects,
+                        force_update=force_fetch,
+                        bulk=settings.GITHUB_BULK_SAVE,
+                    )
 
             except ApiNotFoundError:
                 # no data for this list (issues may be no activated, for example)
@@ -330,8 +376,22 @@ class GithubObject(models.Model):
                     raise MinDateRaised(etag)
 
             # if we have a next page, got fetch it
+            return get_next_page_parameters(parameters, response_headers, len(objs), pagination), etag, last_page_ok
+
+        def get_next_page_parameters(parameters, response_headers, count, pagination):
+            """
+            Return the parameters to fetch the page following the one fetched
+            with the given parameters and that returned the given headers, or
+            None if there is no next page. `count` is the number of entries
+            fetched until now. If github tells us which page is the last one,
+            its number is saved in the `pagination` dict.
+            """
             if 'link' in response_headers:
                 links = parse_header_links(response_headers['link'])
+                if 'last' in links and 'url' in links['last']:
+                    last_page = parse_qs(urlsplit(links['last']['url']).query).get('page')
+                    if last_page:
+                        pagination['last_page'] = int(last_page[0])
                 if 'next' in links and 'url' in links['next']:
                     next_page_parameters = parameters.copy()
                     next_page_parameters.update(
@@ -342,20 +402,145 @@ class GithubObject(models.Model):
                             )
                     )
                     # params for next page
-                    return next_page_parameters, etag, last_page_ok
+                    return next_page_parameters
 
             # manage model without pagination activated on the github side
             # but only if we receivend enough data to let us think we may have
             # more than one page
-            elif len(objs) >= parameters.get('per_page'):  # == should suffice but...
+            elif count >= parameters.get('per_page'):  # == should suffice but...
                 # simply increment the page number
                 next_page_parameters = parameters.copy()
                 next_page_parameters['page'] = int(parameters.get('page', 1)) + 1
                 # params for next page
-                return next_page_parameters, etag, last_page_ok
+                return next_page_parameters
 
             # no more page, stop
-            return None, etag, last_page_ok
+            return None
+
+        def prefetch_page(parameters, request_headers, decode=False):
+            """
+            Fetch a page without creating/updating objects (done later by
+            `fetch_page_and_next`). Used in threads so it must not use the
+            database, nor `gh` that is not thread-safe, so a copy is used.
+            Return a tuple with the data, the response headers, and the
+            exception info if an exception was raised.
+            If `decode` is True, all the entries of the page are decoded now.
+            """
+            response_headers = {}
+            try:
+                data = model.objects.get_data_from_github(
+                    gh=gh.copy(),
+                    identifiers=identifiers,
+                    parameters=parameters,
+                    request_headers=request_headers,
+                    response_headers=response_headers,
+                    json_stream=True,
+                )
+                if decode and isinstance(data, GeneratorType):
+                    data = list(data)
+            except Exception:
+                return None, response_headers, sys.exc_info()
+            return data, response_headers, None
+
+        def prefetch_pages(next_page_parameters, max_count):
+            """
+            Fetch, with `parallel_pages` threads, all the pages from the one
+            defined by `next_page_parameters` to the last one, but at most
+            `max_count` pages if set, and yield for each one, in order, its
+            parameters and the result of `prefetch_page`.
+            At most two pages by thread are fetched in advance.
+            """
+            first_page = int(next_page_parameters['page'])
+            last_page = pagination['last_page']
+            if max_count:
+                last_page = min(last_page, first_page + max_count - 1)
+
+            pool = ThreadPool(parallel_pages)
+            pending = deque()
+            try:
+                for page_number in xrange(first_page, last_page + 1):
+                    page_parameters = dict(next_page_parameters, page=page_number)
+                    pending.append((page_parameters, pool.apply_async(
+                        prefetch_page, (page_parameters, dict(request_headers)))))
+                    if len(pending) >= parallel_pages * 2:
+                        page_parameters, result = pending.popleft()
+                        yield page_parameters, result.get()
+                while pending:
+                    page_parameters, result = pending.popleft()
+                    yield page_parameters, result.get()
+            finally:
+                pool.terminate()
+
+        def pipeline_pages(next_page_parameters, max_count, count, request_headers):
+            """
+            Fetch, in a thread, the pages one after the other, from the one
+            defined by `next_page_parameters` and following the "next" links,
+            but at most `max_count` pages if set, and yield for each one, in
+            order, its parameters and the result of `prefetch_page`, so a page
+            can be saved while the next ones are fetched. `count` is the number
+            of entries fetched until now.
+            At most `settings.GITHUB_PIPELINE_QUEUE_SIZE` pages are fetched in
+            advance, and the thread stops fetching when the generator is closed.
+            """
+            pages = Queue(maxsize=settings.GITHUB_PIPELINE_QUEUE_SIZE)
+            stopped = Event()
+            timings = {'fetch': 0, 'wait': 0, 'persist': 0}
+
+            def put(item):
+                # wait for the persist stage to make room, unless it stopped
+                while not stopped.is_set():
+                    try:
+                        pages.put(item, timeout=1)
+                    except Full:
+                        continue
+                    return True
+                return False
+
+            def fetch_pages(parameters, count):
+                # not the `pagination` dict of the main thread, that we may
+                # update after it stopped waiting for us
+                thread_pagination = {}
+                fetched = 0
+                try:
+                    while parameters is not None and not stopped.is_set():
+                        start = time()
+                        data, response_headers, exc_info = prefetch_page(
+                            parameters, request_headers, decode=True)
+                        timings['fetch'] += time() - start
+                        if not put((parameters, (data, response_headers, exc_info))):
+                            return
+                        fetched += 1
+                        if exc_info or not data or (max_count and fetched >= max_count):
+                            return
+                        count += len(data)
+                        parameters = get_next_page_parameters(
+                            parameters, response_headers, count, thread_pagination)
+                finally:
+                    # tell the persist stage we are done
+                    put(None)
+
+            fetcher = Thread(target=fetch_pages, args=(next_page_parameters, count))
+            fetcher.daemon = True
+            fetcher.start()
+            pages_count = 0
+            try:
+                while True:
+                    start = time()
+                    item = pages.get()
+                    timings['wait'] += time() - start
+                    if item is None:
+                        return
+                    pages_count += 1
+                    start = time()
+                    yield item
+                    timings['persist'] += time() - start
+            finally:
+                # stop the fetch stage if we stopped before the end
+                stopped.set()
+                logger.info('[%s] %s.%s: %d pipelined pages, fetch: %.2fs, '
+                            'persist: %.2fs, waiting for fetch: %.2fs',
+                            self, self._meta.model_name, field_name, pages_count,
+                            timings['fetch'], timings['persist'], timings['wait'])
 
         if not vary:
             # no varying parameter, fetch with an empty set of parameters, with
@@ -410,6 +595,9 @@ class GithubObject(models.Model):
                         github_format=model.github_format,
                         version=github_api_version or model.github_api_version)
 
+            prefetched_pages = None
+            pagination.clear()
+
             try:
                 # fetch all available pages
                 page = int(parameters.get('page', 0))
@@ -417,8 +605,15 @@ class GithubObject(models.Model):
                 page_parameters = parameters_combination.copy()
                 while True:
                     page += 1
+                    prefetched = None
+                    if prefetched_pages is not None:
+                        try:
+                            page_parameters, prefetched = next(prefetched_pages)
+                        except StopIteration:
+                            # more pages than expected: continue one by one
+                            prefetched_pages = None
                     page_parameters, page_etag, last_page_ok = \
-                        fetch_page_and_next(objs, page_parameters, min_date)
+                        fetch_page_and_next(objs, page_parameters, min_date, prefetched)
                     pages_total += 1
                     if page == 1 or model.github_reverse_order:
                         etags[etag_field] = page_etag
@@ -437,6 +632,22 @@ class GithubObject(models.Model):
                         max_pages_raised = True
                         break
 
+                    if (parallel_pages and prefetched_pages is None and pages_total == 1
+                            and pagination.get('last_page') and 'page' in page_parameters
+                            and not model.github_reverse_order):
+                        prefetched_pages = prefetch_pages(
+                            page_parameters,
+                            max_pages - pages_total if max_pages else None
+                        )
+                    elif (parallel_pages and settings.GITHUB_PIPELINED_FETCH
+                            and prefetched_pages is None and pages_total == 1):
+                        prefetched_pages = pipeline_pages(
+                            page_parameters,
+                            max_pages - pages_total if max_pages else None,
+                            len(objs),
+                            dict(request_headers),
+                        )
+
             except MinDateRaised, e:
                 etags[etag_field] = e.args[0]
                 cache_hit = True
@@ -449,6 +660,11 @@ class GithubObject(models.Model):
                 else:
                     raise
 
+            finally:
+                if prefetched_pages is not None:
+                    # stop fetching pages in advance if we stopped before the end
+                    prefetched_pages.close()
+
             # at least we fetched something
             something_fetched = True
 
@@ -619,6 +835,86 @@ class GithubObject(models.Model):
         # return count of added and removed data
         return count
 
+    @classmethod
+    def bulk_update_related_field(cls, field_name, objs_ids):
+        """
+        Do the same as `update_related_field`, with default arguments, for many
+        objects at once. `objs_ids` is a list of tuples with an object and
+        the list of ids to link to it.
+        For m2m fields with an auto-created through model, the existing links
+        of all objects are loaded in one query, and then the links to remove
+        are deleted in one query, and the ones to add created in one query.
+        The `m2m_changed` signals are still sent for each object, like when
+        using `remove` and `add`.
+        For other fields, `update_related_field` is called for each object.
+        """
+        if not objs_ids:
+            return
+
+        field = cls._meta.get_field(field_name)
+        if not isinstance(field, models.ManyToManyField) or not field.remote_field.through._meta.auto_created:
+            for obj, ids in objs_ids:
+                obj.update_related_field(field_name, ids)
+            return
+
+        through = field.remote_field.through
+        source_field = '%s_id' % field.m2m_field_name()
+        target_field = '%s_id' % field.m2m_reverse_field_name()
+        db = router.db_for_write(through)
+
+        # guess which relations to add and which to delete
+        existing_ids = defaultdict(set)
+        for source_id, target_id in through.objects.filter(**{
+            '%s__in' % source_field: [obj.pk for obj, ids in objs_ids]
+        }).values_list(source_field, target_field):
+            existing_ids[source_id].add(target_id)
+
+        to_remove, to_add = [], []
+        for obj, ids in objs_ids:
+            fetched_ids = set(ids or [])
+            if existing_ids[obj.pk] - fetched_ids:
+                to_remove.append((obj, existing_ids[obj.pk] - fetched_ids))
+            if fetched_ids - existing_ids[obj.pk]:
+                to_add.append((obj, fetched_ids - existing_ids[obj.pk]))
+
+        def send_signal(action, objs_pk_sets):
+            for obj, pk_set in objs_pk_sets:
+                m2m_changed.send(sender=through, action=action, instance=obj,
+                                 reverse=False, model=field.related_model,
+                                 pk_set=pk_set, using=db)
+
+        # if some relations are not here, remove them
+        if to_remove:
+            send_signal('pre_remove', to_remove)
+            through.objects.filter(reduce(or_, [
+                models.Q(**{source_field: obj.pk, '%s__in' % target_field: pk_set})
+                for obj, pk_set in to_remove
+            ])).delete()
+            send_signal('post_remove', to_remove)
+
+        # if we have new relations, add them
+        if to_add:
+            send_signal('pre_add', to_add)
+            through.objects.bulk_create([
+                through(**{source_field: obj.pk, target_field: target_id})
+                for obj, pk_set in to_add
+                for target_id in pk_set
+            ])
+            send_signal('post_add', to_add)
+
+        # can we save a fetch date ?
+        fetched_at_field = '%s_fetched_at' % field_name
+        try:
+            cls._meta.get_field(fetched_at_field)
+        except models.FieldDoesNotExist:
+            pass
+        else:
+            now = datetime.utcnow()
+            cls.objects.filter(pk__in=[obj.pk for obj, ids in objs_ids]).update(**{fetched_at_field: now})
+            cls.objects.invalidate_identity_map(obj for obj, ids in objs_ids)
+            for obj, ids in objs_ids:
+                setattr(obj, fetched_at_field, now)
+
     def dist_delete(self, gh, github_api_version=None):
         """
         Delete the object on the github side, then delete it on our side.
@@ -9,9 +9,13 @@ __all__ = [
 ]
 
 from collections import OrderedDict
+from copy import copy
 from datetime import datetime
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import re
 
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core import validators
@@ -31,6 +35,8 @@ from gim.core.graphql_utils import (
     GITHUB_TYPES,
 )
 
+from ..ghpool import Connection
+
 from ..managers import (
     IssueEventManager,
     IssueManager,
@@ -38,7 +44,7 @@ from ..managers import (
     WithRepositoryManager,
 )
 
-from ..utils import JSONField
+from ..utils import JSONField, in_pool_thread
 
 from .base import (
     GithubObject,
@@ -233,6 +239,51 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
         return self.fetch(gh=gh, defaults=defaults, force_fetch=force_fetch,
                                     parameters=parameters, meta_base_name='pr')
 
+    GRAPHQL_MERGEABLE = {
+        'MERGEABLE': True,
+        'CONFLICTING': False,
+    }
+
+    def update_from_graphql_pr_state(self, data):
+        """
+        Update the merge status of the pull request with the data fetched by
+        `Repository.fetch_prs_state_with_graphql`, and return True, but only if
+        nothing else changed since the last fetch of the pull request.
+        If something did, return False, to tell that the pull request must be
+        fetched with the REST api.
+        """
+        if not self.pr_fetched_at or not self.updated_at or self.pr_fetched_at < self.updated_at:
+            return False
+
+        updated_at = data.get('updated_at')
+        if not updated_at or Connection.parse_date(updated_at) > self.updated_at:
+            return False
+
+        if (data.get('state') == 'OPEN') != (self.state == 'open'):
+            return False
+
+        if data.get('head_sha') != self.head_sha:
+            return False
+
+        if (data.get('commits') or {}).get('total_count') != self.nb_commits:
+            return False
+
+        merged_at = data.get('merged_at')
+        values = {
+            'merged': bool(data.get('merged')),
+            'merged_at': Connection.parse_date(merged_at) if merged_at else None,
+            'mergeable': self.GRAPHQL_MERGEABLE.get(data.get('mergeable')),
+            'mergeable_state': (data.get('merge_state_status') or 'unknown').lower(),
+        }
+
+        update_fields = [name for name, value in values.items() if getattr(self, name) != value]
+        if update_fields:
+            for name in update_fields:
+                setattr(self, name, values[name])
+            self.save(update_fields=update_fields)
+
+        return True
+
     def fetch_events(self, gh, force_fetch=True, parameters=None):
         """
         force_fetch is forced to True because for an issue events are in the
@@ -383,6 +434,10 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
         super(Issue, self).fetch_all(gh, force_fetch=force_fetch)
         # self.fetch_labels(gh, force_fetch=force_fetch)  # already retrieved via self.fetch
 
+        if settings.ISSUE_FETCH_PARALLEL_REQUESTS > 1:
+            return self.fetch_all_related_in_parallel(gh, force_fetch,
+                                                      settings.ISSUE_FETCH_PARALLEL_REQUESTS)
+
         if self.is_pull_request:
             # fetch commits first because they may be used as references in comments
             self.fetch_commits(gh, force_fetch=force_fetch)
@@ -404,6 +459,66 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
             if base_branch:
                 base_branch.fetch(gh, force_fetch=force_fetch)
 
+    def fetch_all_related_in_parallel(self, gh, force_fetch, max_threads):
+        """
+        Do the same fetches as `fetch_all` (without the issue itself), but at
+        the same time, with at most `max_threads` threads. Some dependencies are
+        kept:
+        - comments, pr comments and the pull request are fetched after the
+          commits because they may be used as references in comments, and the
+          head commit must be there when the head sha is updated
+        - the head commit statuses and the base branch are fetched after the
+          pull request
+        Each thread works on its own copy of the issue, saving only its own
+        fields, and of `gh`, that is not thread-safe. The issue is reloaded at
+        the end.
+        """
+        def fetch_pr_and_related(issue, gh):
+            issue.fetch_pr(gh, force_fetch=force_fetch)
+            # may be done by the `FetchCommitBySha` jobs but it's faster this way
+            issue.fetch_head_commit_statuses(gh, force_fetch, force_head_commit=True)
+            base_branch = issue.pr_base_branch
+            if base_branch:
+                base_branch.fetch(gh, force_fetch=force_fetch)
+
+        def prepare(func, **kwargs):
+            return partial(func, copy(self), gh.copy(), **kwargs)
+
+        # Force fetch of events and comments because of reverse order
+        first_fetches = [prepare(Issue.fetch_events, force_fetch=True)]
+        after_commits_fetches = [prepare(Issue.fetch_comments, force_fetch=True)]
+        if self.is_pull_request:
+            first_fetches += [
+                prepare(Issue.fetch_commits, force_fetch=force_fetch),
+                prepare(Issue.fetch_files, force_fetch=force_fetch),
+            ]
+            after_commits_fetches += [
+                prepare(fetch_pr_and_related),
+                prepare(Issue.fetch_pr_comments, force_fetch=force_fetch),
+            ]
+
+        call = in_pool_thread(lambda func: func())
+
+        pool = ThreadPool(max_threads)
+        try:
+            results = [pool.apply_async(call, (func, )) for func in first_fetches]
+            if self.is_pull_request:
+                commits_result = results[1]
+                commits_result.wait()
+                if not commits_result.successful():
+                    # stop here, as `fetch_all` would do
+                    after_commits_fetches = []
+            results += [pool.apply_async(call, (func, )) for func in after_commits_fetches]
+            # wait for all fetches before raising the first error, if any
+            for result in results:
+                result.wait()
+        finally:
+            pool.terminate()
+            # get what was saved by all the threads
+            self.refresh_from_db()
+        for result in results:
+            result.get()
+
     def get_head_commit(self, force=False):
         if not hasattr(self, '_head_commits'):
             self._head_commits = {}
@@ -413,14 +528,18 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
             try:
                 self._head_commits[self.head_sha] = self.repository.commits.get(sha=self.head_sha)
             except Commit.DoesNotExist:
-                from gim.core.tasks.commit import FetchCommitBySha
-                FetchCommitBySha.add_job('%s#%s' % (self.repository_id, self.head_sha))
+                if settings.GITHUB_BATCH_COMMITS:
+                    from gim.core.models import Repository
+                    Repository.add_pending_commits(self.repository_id, [self.head_sha])
+                else:
+                    from gim.core.tasks.commit import FetchCommitBySha
+                    FetchCommitBySha.add_job('%s#%s' % (self.repository_id, self.head_sha))
                 self._head_commits[self.head_sha] = None
 
         return self._head_commits[self.head_sha]
 
-    def fetch_head_commit_statuses(self, gh, force_fetch=None):
-        head_commit = self.get_head_commit()
+    def fetch_head_commit_statuses(self, gh, force_fetch=None, force_head_commit=False):
+        head_commit = self.get_head_commit(force=force_head_commit)
         if not head_commit:
             return
 
@@ -1092,6 +1211,7 @@ class Label(WithRepositoryMixin, GithubObjectWithId):
         'url': 'api_url'
     })
     github_ignore = GithubObjectWithId.github_ignore + ('api_url', 'label_type', 'typed_name', 'order', 'default')
+    use_identity_map = True
     github_edit_fields = {
         'create': ('color', 'name', ),
         'update': ('color', 'name', )
@@ -1174,6 +1294,7 @@ class Milestone(WithRepositoryMixin, GithubObjectWithId):
 
     github_ignore = GithubObjectWithId.github_ignore + ('url', 'labels_url',
                                 'updated_at', 'closed_issues', 'open_issues', )
+    use_identity_map = True
     github_edit_fields = {
         'create': ('title', 'state', 'description', 'due_on', ),
         'update': ('title', 'state', 'description', 'due_on', )
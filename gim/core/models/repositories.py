@@ -5,7 +5,9 @@ __all__ = [
 ]
 
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
 from django.db import models
 from django.utils.functional import cached_property
 
@@ -21,7 +23,9 @@ from gim.core.graphql_utils import (
     GraphQLGithubInternalError,
 )
 
-from .. import GITHUB_HOST
+from .. import GITHUB_HOST, get_main_limpyd_database
+
+from ..batch import get_sync_batch, sync_batch
 
 from ..ghpool import (
     ApiError,
@@ -30,6 +34,8 @@ from ..ghpool import (
 
 from ..limpyd_models import Token
 
+from ..utils import in_pool_thread
+
 from ..managers import (
     MODE_ALL,
     MODE_UPDATE,
@@ -249,7 +255,8 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_issues(self, gh, force_fetch=False, state=None, parameters=None,
-                                        parameters_prs=None, max_pages=None):
+                                        parameters_prs=None, max_pages=None,
+                                        parallel_pages=None):
         from .issues import Issue
 
         if state:
@@ -279,7 +286,8 @@ class Repository(GithubObjectWithId):
                                         parameters=final_issues_parameters,
                                         remove_missing=remove_missing,
                                         force_fetch=force_fetch,
-                                        max_pages=max_pages)
+                                        max_pages=max_pages,
+                                        parallel_pages=parallel_pages)
 
         # now fetch pull requests to have more informations for them (only
         # ones that already exist as an issue, not the new ones)
@@ -305,7 +313,8 @@ class Repository(GithubObjectWithId):
                             force_fetch=force_fetch,
                             meta_base_name='prs',
                             modes=MODE_UPDATE if self.has_issues else MODE_ALL,
-                            max_pages=max_pages)
+                            max_pages=max_pages,
+                            parallel_pages=parallel_pages)
 
         count += pr_count
 
@@ -403,12 +412,16 @@ class Repository(GithubObjectWithId):
             )
         )
 
-        def action(gh, pr):
+        def action(gh, pr, graphql_data=None):
+            if graphql_data is not None and pr.update_from_graphql_pr_state(graphql_data):
+                # only the merge status may have changed, no need for more
+                return
             pr.fetch_pr(gh, force_fetch=True)
             pr.fetch_commits(gh)
             pr.fetch_files(gh)
 
-        return self._fetch_some_prs(filter, action, gh=gh, limit=limit)
+        return self._fetch_some_prs(filter, action, gh=gh, limit=limit,
+                                    use_graphql=settings.GITHUB_GRAPHQL_PRS_STATE)
 
     def fetch_prs_commits_parents(self, gh, limit=20):
 
@@ -426,14 +439,26 @@ class Repository(GithubObjectWithId):
                         deleted=True, commit__deleted=False, commit__parents__isnull=True
                 ).select_related('commit')[:100]
 
+                # get the parents of all the commits at once if we can
+                graphql_data = self.fetch_commits_with_graphql(
+                    gh, [issue_commit.commit.sha for issue_commit in issue_commits]
+                ) if settings.GITHUB_BATCH_COMMITS else {}
+
                 for issue_commit in issue_commits:
                     more_data['nb_commits'] += 1
                     commit = issue_commit.commit
                     commit.fetched_at = datetime.utcnow()
-                    try:
-                        # commit.fetch(gh, force_fetch=True, only_commits=True)
-                        data = gh.repos(self.owner.username)(self.name).commits(commit.sha).get()
-                    except ApiNotFoundError:
+                    if commit.sha in graphql_data:
+                        data = graphql_data[commit.sha]
+                        if data:
+                            data = self.get_commit_data_from_graphql(data)
+                    else:
+                        try:
+                            # commit.fetch(gh, force_fetch=True, only_commits=True)
+                            data = gh.repos(self.owner.username)(self.name).commits(commit.sha).get()
+                        except ApiNotFoundError:
+                            data = None
+                    if data is None:
                         # the commit doesn't exist anymore !
                         commit.deleted = True
                         commit.save(update_fields=['fetched_at', 'deleted'])
@@ -473,10 +498,11 @@ class Repository(GithubObjectWithId):
                 filter = filter.filter(updated_at__lt=start_date)
             return filter
 
-        def action(gh, pr):
+        def action(gh, pr, graphql_data=None):
             mergeable = pr.mergeable
             mergeable_state = pr.mergeable_state
-            pr.fetch_pr(gh, force_fetch=False)
+            if graphql_data is None or not pr.update_from_graphql_pr_state(graphql_data):
+                pr.fetch_pr(gh, force_fetch=False)
             if pr.mergeable != mergeable or pr.mergeable_state != mergeable_state:
                 action.updated += 1
             if not action.last_date or pr.updated_at < action.last_date:
@@ -485,15 +511,90 @@ class Repository(GithubObjectWithId):
         action.last_date = None
 
         count, deleted, errors, todo = self._fetch_some_prs(get_filter(start_date),
-                                                        action, gh=gh, limit=limit)
+                                                        action, gh=gh, limit=limit,
+                                                        use_graphql=settings.GITHUB_GRAPHQL_PRS_STATE)
 
         todo = get_filter((action.last_date-timedelta(seconds=1)) if action.last_date else None).count()
 
         return count, action.updated, deleted, errors, todo, action.last_date
 
-    def _fetch_some_prs(self, filter, action, gh, limit=20):
+    GRAPHQL_FETCH_PRS_STATE = compose_query("""
+        query RepositoryPullRequestsState {
+            %s
+        }
+    """, 'pullRequestState')
+
+    GRAPHQL_FETCH_PRS_STATE_PR_SUBQUERY = """
+        node%(pr_id)s: node(id: "%(pr_idb64)s") {
+            ...pullRequestState
+        }
+    """
+
+    # needed for `mergeStateStatus`
+    GRAPHQL_FETCH_PRS_STATE_ACCEPT = 'application/vnd.github.merge-info-preview+json'
+
+    def fetch_prs_state_with_graphql(self, gh, prs, nb_prs_by_query=50):
+        """
+        Fetch the state (merge status, head sha, number of commits...) of the
+        given PRs, with one GraphQL query for `nb_prs_by_query` PRs.
+        Return a dict with the data of each PR, by pk. PRs that could not be
+        fetched (no token for GraphQL, errors...) are not in this dict.
+        """
+        gh = Token.ensure_graphql_gh_for_repository(gh, self.pk, 'pull' if self.private else None)
+        if not gh:
+            return {}
+
+        prs = [pr for pr in prs if pr.github_pr_id]
+        result = {}
+
+        while prs:
+            current_prs, prs = prs[:nb_prs_by_query], prs[nb_prs_by_query:]
+
+            prs_by_id = {pr.github_pr_id: pr for pr in current_prs}
+
+            subqueries = [
+                self.GRAPHQL_FETCH_PRS_STATE_PR_SUBQUERY % {
+                    'pr_id': pr.github_pr_id,
+                    'pr_idb64': encode_graphql_id_for_object(pr),
+                }
+                for pr in prs_by_id.values()
+            ]
+
+            query = reindent(self.GRAPHQL_FETCH_PRS_STATE % '\n'.join(subqueries))
+
+            try:
+                data = fetch_graphql(gh, query, {}, 'RepositoryPullRequestsState', {
+                    'repository': self.full_name,
+                    'prs_left': len(prs) + len(current_prs),
+                }, request_headers={'Accept': self.GRAPHQL_FETCH_PRS_STATE_ACCEPT})
+            except GraphQLComplexityError as e:
+                # reset list to restart with a lower nb of prs by query
+                nb_prs_by_query = max(1, e.complexity[1] / max(1, e.complexity[0] / nb_prs_by_query))
+                prs = current_prs + prs
+                continue
+            except GraphQLGithubInternalError:
+                # they will be fetched with the REST api
+                continue
+            except GraphQLError as e:
+                # some PRs may not exist anymore: keep the data of the other ones,
+                # the missing ones will be fetched with the REST api
+                data = convert_ids_from_graphql_result(e.response.json.get('data', None) or {})
+            except ApiError:
+                # we'll use the REST api for the rest
+                break
+
+            for node_key, node_data in data.iteritems():
+                if node_data:
+                    result[prs_by_id[int(node_key[4:])].pk] = node_data
+
+        return result
+
+    def _fetch_some_prs(self, filter, action, gh, limit=20, use_graphql=False):
         """
         Update some PRs, with filter and things to merge depending on the mode.
+        If `use_graphql` is True, the state of all the PRs is fetched first in
+        one GraphQL query (see `fetch_prs_state_with_graphql`), and passed to
+        `action` as `graphql_data` (None for PRs not fetched this way).
         """
         prs = list(filter.order_by('-updated_at')[:limit])
 
@@ -501,9 +602,14 @@ class Repository(GithubObjectWithId):
 
         if len(prs):
 
+            graphql_data = self.fetch_prs_state_with_graphql(gh, prs) if use_graphql else None
+
             for pr in prs:
                 try:
-                    action(gh, pr)
+                    if graphql_data is None:
+                        action(gh, pr)
+                    else:
+                        action(gh, pr, graphql_data.get(pr.pk))
                 except ApiNotFoundError:
                     # the PR doen't exist anymore !
                     pr.delete()
@@ -528,7 +634,12 @@ class Repository(GithubObjectWithId):
 
         count = errors = deleted = todo = 0
 
-        if len(commits):
+        if len(commits) and settings.GITHUB_BATCH_COMMITS:
+            count, deleted, errors = self.fetch_commits_by_sha(
+                gh, [commit.sha for commit in commits], force_fetch=True)
+            todo = qs.count()
+
+        elif len(commits):
 
             for commit in commits:
                 try:
@@ -548,6 +659,265 @@ class Repository(GithubObjectWithId):
 
         return count, deleted, errors, todo
 
+    GRAPHQL_FETCH_COMMITS = compose_query("""
+        query RepositoryCommits($repositoryOwnerLogin: String!, $repositoryName: String!) {
+            repository(owner:$repositoryOwnerLogin, name:$repositoryName) {
+                %s
+            }
+        }
+    """, 'commitBase')
+
+    GRAPHQL_FETCH_COMMITS_COMMENTS_COUNT = compose_query("""
+        query RepositoryCommitsCommentsCount($repositoryOwnerLogin: String!, $repositoryName: String!) {
+            repository(owner:$repositoryOwnerLogin, name:$repositoryName) {
+                %s
+            }
+        }
+    """, 'commitCommentsCount')
+
+    GRAPHQL_FETCH_COMMITS_SUBQUERY = """
+        commit%(sha)s: object(oid: "%(sha)s") {
+            ...%(fragment)s
+        }
+    """
+
+    def fetch_commits_with_graphql(self, gh, shas, nb_commits_by_query=50, only_comments_count=False):
+        """
+        Fetch the commits with the given shas, with one GraphQL query for
+        `nb_commits_by_query` commits.
+        Return a dict with the data of each commit by sha, or None for commits
+        that don't exist on github. Commits that could not be fetched (no token
+        for GraphQL, errors...) are not in this dict.
+        If `only_comments_count` is True, only the sha and the number of
+        comments of each commit are fetched.
+        """
+        if only_comments_count:
+            query_base, query_name, fragment = \
+                self.GRAPHQL_FETCH_COMMITS_COMMENTS_COUNT, 'RepositoryCommitsCommentsCount', 'commitCommentsCount'
+        else:
+            query_base, query_name, fragment = \
+                self.GRAPHQL_FETCH_COMMITS, 'RepositoryCommits', 'commitBase'
+
+        gh = Token.ensure_graphql_gh_for_repository(gh, self.pk, 'pull' if self.private else None)
+        if not gh:
+            return {}
+
+        shas = list(shas)
+        result = {}
+
+        variables = {
+            'repositoryOwnerLogin': self.owner.username,
+            'repositoryName': self.name,
+        }
+
+        while shas:
+            current_shas, shas = shas[:nb_commits_by_query], shas[nb_commits_by_query:]
+
+            subqueries = [self.GRAPHQL_FETCH_COMMITS_SUBQUERY % {'sha': sha, 'fragment': fragment}
+                          for sha in current_shas]
+
+            query = reindent(query_base % '\n'.join(subqueries))
+
+            try:
+                data = fetch_graphql(gh, query, variables, query_name, {
+                    'repository': self.full_name,
+                    'commits_left': len(shas) + len(current_shas),
+                })
+            except GraphQLComplexityError as e:
+                # reset list to restart with a lower nb of commits by query
+                nb_commits_by_query = max(1, e.complexity[1] / max(1, e.complexity[0] / nb_commits_by_query))
+                shas = current_shas + shas
+                continue
+            except GraphQLGithubInternalError:
+                # they will be fetched with the REST api
+                continue
+            except GraphQLError as e:
+                # keep the data we have, the other ones will be fetched with the REST api
+                data = convert_ids_from_graphql_result(e.response.json.get('data', None) or {})
+                if not data.get('repository'):
+                    continue
+                for sha in current_shas:
+                    if data['repository'].get('commit%s' % sha):
+                        result[sha] = data['repository']['commit%s' % sha]
+                continue
+            except ApiError:
+                # we'll use the REST api for the rest
+                break
+
+            if not data.get('repository'):
+                continue
+
+            for sha in current_shas:
+                # a commit that doesn't exist is returned as null
+                result[sha] = data['repository'].get('commit%s' % sha)
+
+        return result
+
+    @staticmethod
+    def get_commit_data_from_graphql(node):
+        """
+        Convert the data of a commit fetched by `fetch_commits_with_graphql` to
+        the format of the REST api
+        """
+        data = {
+            'sha': node['sha'],
+            'commit': {
+                'message': node.get('message'),
+                'tree': node['tree'],
+            },
+            'parents': (node.get('parents') or {}).get('nodes') or [],
+            'stats': {
+                'additions': node.get('additions'),
+                'deletions': node.get('deletions'),
+            },
+        }
+
+        for user_type, date_field in (('author', 'authored'), ('committer', 'committed')):
+            actor = node.get(user_type) or {}
+            data['commit'][user_type] = {
+                'name': actor.get('name'),
+                'email': actor.get('email'),
+                'date': node.get('%s_date' % date_field),
+            }
+            data[user_type] = actor.get('user')
+
+        return data
+
+    def fetch_commits_by_sha(self, gh, shas, with_files=True, with_comments=True, force_fetch=False):
+        """
+        Fetch the commits with the given shas, with their files and comments,
+        with as few requests as possible: all commits are first fetched with
+        GraphQL, and saved at once, then only the files (that are not available
+        with GraphQL) are fetched with the REST api, and comments only for the
+        commits having some.
+        If `with_files` is True, the commits are fetched with the REST api to
+        get their files, so only their number of comments is asked with
+        GraphQL, and nothing is saved from it.
+        Return the count of fetched commits, of deleted ones, and of errors.
+        """
+        from .commits import Commit
+
+        commits = {commit.sha: commit for commit in self.commits.filter(sha__in=shas)}
+
+        def is_fetched(commit):
+            return (commit.fetched_at
+                    and (not with_files or commit.files_fetched_at)
+                    and (not with_comments or commit.commit_comments_fetched_at))
+
+        shas = [
+            sha for sha in sorted(set(shas))
+            if force_fetch or sha not in commits or not is_fetched(commits[sha])
+        ]
+
+        count = deleted = errors = 0
+
+        if not shas:
+            return count, deleted, errors
+
+        graphql_data = self.fetch_commits_with_graphql(gh, shas, only_comments_count=with_files)
+
+        to_save = []
+        if not with_files:
+            # else they are fetched with the REST api just after
+            to_save = [
+                self.get_commit_data_from_graphql(node)
+                for sha, node in graphql_data.items()
+                if node and (force_fetch or sha not in commits or not commits[sha].fetched_at)
+            ]
+        if to_save:
+            # side effects of saved commits are done once for all
+            with sync_batch():
+                for commit in Commit.objects.create_or_update_from_list(
+                    to_save,
+                    defaults={
+                        'fk': {'repository': self},
+                        'related': {'*': {'fk': {'repository': self}}},
+                        'context': {'only_commits': True},
+                    },
+                    force_update=force_fetch,
+                    bulk=True,
+                ):
+                    commits[commit.sha] = commit
+
+        now = datetime.utcnow()
+
+        for sha in shas:
+            commit = commits.get(sha) or Commit(repository=self, sha=sha)
+            # GraphQL returns null for commits that don't exist
+            exists = graphql_data.get(sha, True) is not None
+
+            if exists:
+                try:
+                    if not commit.fetched_at or with_files and (force_fetch or not commit.files_fetched_at):
+                        # files are not available with GraphQL
+                        commit.fetch(gh, force_fetch=True, only_commits=True)
+
+                    if with_comments and (force_fetch or not commit.commit_comments_fetched_at):
+                        comments_count = ((graphql_data.get(sha) or {}).get('comments') or {}).get('total_count')
+                        if comments_count == 0:
+                            # no need to ask github for comments
+                            commit.comments_count = 0
+                            commit.commit_comments_fetched_at = now
+                            commit.save(update_fields=['comments_count', 'commit_comments_fetched_at'])
+                        else:
+                            commit.fetch_comments(gh, force_fetch=force_fetch)
+                except ApiNotFoundError:
+                    exists = False
+                except ApiError:
+                    errors += 1
+                    continue
+
+            if exists:
+                count += 1
+            else:
+                # the commit doesn't exist anymore !
+                if commit.pk:
+                    commit.fetched_at = now
+                    commit.deleted = True
+                    commit.save(update_fields=['fetched_at', 'deleted'])
+                deleted += 1
+
+        return count, deleted, errors
+
+    PENDING_COMMITS_KEY = 'gim:repository:%s:pending-commits'
+
+    @classmethod
+    def add_pending_commits(cls, repository_id, shas):
+        """
+        Ask for the commits with the given shas to be fully fetched by a
+        `FetchPendingCommits` job, that fetches many commits at once (see
+        `fetch_commits_by_sha`). If a sync batch is active, it's done when the
+        batch is flushed.
+        """
+        batch = get_sync_batch()
+        if batch is not None:
+            key = ('add_pending_commits', repository_id)
+            previous = batch.get_deferred(key)
+            if previous:
+                shas = previous[1][1] + list(shas)
+            batch.defer(key, cls.add_pending_commits, repository_id, list(shas))
+            return
+
+        if not shas:
+            return
+
+        get_main_limpyd_database().connection.sadd(cls.PENDING_COMMITS_KEY % repository_id, *shas)
+
+        from gim.core.tasks.repository import FetchPendingCommits
+        FetchPendingCommits.add_job(repository_id)
+
+    def pop_pending_commits(self, count):
+        """
+        Return (and remove) at most `count` shas of commits waiting to be fetched
+        """
+        pipeline = get_main_limpyd_database().connection.pipeline()
+        for __ in range(count):
+            pipeline.spop(self.PENDING_COMMITS_KEY % self.pk)
+        return [sha for sha in pipeline.execute() if sha]
+
+    def count_pending_commits(self):
+        return get_main_limpyd_database().connection.scard(self.PENDING_COMMITS_KEY % self.pk)
+
     @property
     def github_callable_identifiers_for_issues_events(self):
         return self.github_callable_identifiers_for_issues + [
@@ -555,7 +925,7 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_issues_events(self, gh, force_fetch=False, parameters=None,
-                                                            max_pages=None):
+                                            max_pages=None, parallel_pages=None):
         count = self._fetch_many('issues_events', gh,
                                  defaults={
                                     'fk': {'repository': self},
@@ -563,7 +933,8 @@ class Repository(GithubObjectWithId):
                                 },
                                  parameters=parameters,
                                  force_fetch=force_fetch,
-                                 max_pages=max_pages)
+                                 max_pages=max_pages,
+                                 parallel_pages=parallel_pages)
 
         return count
 
@@ -580,7 +951,7 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_comments(self, gh, force_fetch=False, parameters=None,
-                                                                max_pages=None):
+                                            max_pages=None, parallel_pages=None):
         from .comments import IssueComment
 
         final_parameters = {
@@ -598,10 +969,11 @@ class Repository(GithubObjectWithId):
                                     },
                                     parameters=final_parameters,
                                     force_fetch=force_fetch,
-                                    max_pages=max_pages)
+                                    max_pages=max_pages,
+                                    parallel_pages=parallel_pages)
 
     def fetch_pr_comments(self, gh, force_fetch=False, parameters=None,
-                                                                max_pages=None):
+                                            max_pages=None, parallel_pages=None):
         from .comments import PullRequestComment
 
         final_parameters = {
@@ -619,7 +991,8 @@ class Repository(GithubObjectWithId):
                                     },
                                     parameters=final_parameters,
                                     force_fetch=force_fetch,
-                                    max_pages=max_pages)
+                                    max_pages=max_pages,
+                                    parallel_pages=parallel_pages)
 
     @property
     def github_callable_identifiers_for_commits(self):
@@ -634,7 +1007,7 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_commit_comments(self, gh, force_fetch=False, parameters=None,
-                                                                max_pages=None):
+                                            max_pages=None, parallel_pages=None):
         from .comments import CommitComment
 
         final_parameters = {
@@ -658,7 +1031,8 @@ class Repository(GithubObjectWithId):
                                 },
                                 parameters=final_parameters,
                                 force_fetch=force_fetch,
-                                max_pages=max_pages)
+                                max_pages=max_pages,
+                                parallel_pages=parallel_pages)
 
     @property
     def github_callable_identifiers_for_projects(self):
@@ -844,7 +1218,14 @@ class Repository(GithubObjectWithId):
             self.save(update_fields=['first_fetch_done'])
 
     def fetch_all_step2(self, gh, force_fetch=False, start_page=None,
-                        max_pages=None, to_ignore=None, issues_state=None):
+                        max_pages=None, to_ignore=None, issues_state=None,
+                        parallel_pages=None, parallel_lists=None):
+        """
+        Fetch the lists of issues, events and comments. `parallel_pages` is
+        passed to `_fetch_many` to fetch many pages at the same time.
+        If `parallel_lists` is set, the lists are fetched at the same time,
+        with at most this number of threads (see `fetch_lists_in_parallel`)
+        """
 
         # projects are fetched separately
 
@@ -856,28 +1237,64 @@ class Repository(GithubObjectWithId):
             parameters['page'] = start_page
 
         kwargs = {
-            'gh': gh,
             'force_fetch': force_fetch,
             'max_pages': max_pages,
             'parameters': parameters,
+            'parallel_pages': parallel_pages,
         }
 
-        counts = {}
+        lists = [
+            (name, method, extra_kwargs)
+            for name, method, extra_kwargs in (
+                ('issues', self.fetch_issues, {'parameters_prs': parameters, 'state': issues_state}),
+                ('issues_events', self.fetch_issues_events, {}),
+                ('comments', self.fetch_comments, {}),
+                ('pr_comments', self.fetch_pr_comments, {}),
+                ('commit_comments', self.fetch_commit_comments, {}),
+            )
+            if name not in to_ignore
+        ]
+
+        if parallel_lists and parallel_lists > 1 and len(lists) > 1:
+            return self.fetch_lists_in_parallel(gh, lists, kwargs, parallel_lists)
 
-        if 'issues' not in to_ignore:
-            counts['issues'] = self.fetch_issues(parameters_prs=parameters,
-                                                 state=issues_state, **kwargs)
-        if 'issues_events' not in to_ignore:
-            counts['issues_events'] = self.fetch_issues_events(**kwargs)
-        if 'comments' not in to_ignore:
-            counts['comments'] = self.fetch_comments(**kwargs)
-        if 'pr_comments' not in to_ignore:
-            counts['pr_comments'] = self.fetch_pr_comments(**kwargs)
-        if 'commit_comments' not in to_ignore:
-            counts['commit_comments'] = self.fetch_commit_comments(**kwargs)
+        counts = {}
+        for name, method, extra_kwargs in lists:
+            counts[name] = method(gh=gh, **dict(kwargs, **extra_kwargs))
 
         return counts
 
+    def fetch_lists_in_parallel(self, gh, lists, kwargs, parallel_lists):
+        """
+        Call the fetch method of each entry of `lists` (tuples with a name,
+        the method, and specific arguments to add to `kwargs`), with at most
+        `parallel_lists` threads, and return a dict with the count returned
+        by each one, by name.
+        Each thread uses its own database connection, and its own copy of the
+        connection of the token with the most remaining calls available for
+        this repository (or of `gh` if none), as connections are shared.
+        """
+        permission = 'pull' if self.private else None
+
+        @in_pool_thread
+        def fetch_list(method, method_kwargs):
+            token = Token.get_one_for_repository(self.pk, permission=permission)
+            return method(gh=(token.gh if token else gh).copy(), **method_kwargs)
+
+        pool = ThreadPool(min(parallel_lists, len(lists)))
+        try:
+            results = [
+                (name, pool.apply_async(fetch_list, (method, dict(
+                    kwargs, parameters=dict(kwargs['parameters']), **extra_kwargs))))
+                for name, method, extra_kwargs in lists
+            ]
+            # wait for all lists before raising the first error, if any
+            for name, result in results:
+                result.wait()
+            return {name: result.get() for name, result in results}
+        finally:
+            pool.terminate()
+
     @cached_property
     def has_some_projects(self):
         return self.has_projects and self.projects.exists()
@@ -91,6 +91,7 @@ class GithubUser(GithubObjectWithId, AbstractUser):
         'is_staff', 'is_active', 'date_joined', 'username', ) + ('following_url', 'events_url',
         'organizations_url', 'url', 'gists_url', 'html_url', 'subscriptions_url', 'repos_url',
         'received_events_url', 'gravatar_id', 'starred_url', 'site_admin', 'type', 'followers_url', )
+    use_identity_map = True
 
     class Meta:
         app_label = 'core'
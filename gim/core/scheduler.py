@@ -0,0 +1,97 @@
+"""
+Scheduling of the jobs refreshing repositories, depending on their activity.
+
+Each repository has an activity score, incremented by what we see happening on
+it (issues updated by `check_events`, webhook deliveries, objects updated by
+the sync jobs), and decaying over time: it's halved every
+`settings.REPOSITORY_ACTIVITY_HALF_LIFE` seconds.
+
+The delay before the next run of a job refreshing a repository is then taken
+between the bounds defined for its queue in `settings.REPOSITORY_REFRESH_DELAYS`:
+the more active the repository, the shorter the delay.
+"""
+
+import logging
+from random import uniform
+from time import time
+
+from django.conf import settings
+
+from gim.core import get_main_limpyd_database
+
+logger = logging.getLogger('gim.log')
+
+ACTIVITY_KEY = 'gim:repository-activity:%s'
+
+# decay the score and add the weight in one atomic step, to not lose concurrent
+# increments. KEYS: the activity key. ARGV: weight, now, half life, ttl
+RECORD_ACTIVITY_SCRIPT = """
+    local values = redis.call('HMGET', KEYS[1], 'score', 'updated_at')
+    local score = tonumber(values[1]) or 0
+    local now = tonumber(ARGV[2])
+    if score ~= 0 then
+        local elapsed = math.max(0, now - (tonumber(values[2]) or now))
+        score = score * math.pow(0.5, elapsed / tonumber(ARGV[3]))
+    end
+    score = score + tonumber(ARGV[1])
+    redis.call('HMSET', KEYS[1], 'score', tostring(score), 'updated_at', ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return tostring(score)
+"""
+
+
+def get_activity_score(repository_id, now=None):
+    """Return the current activity score of the given repository"""
+    if now is None:
+        now = time()
+    score, updated_at = get_main_limpyd_database().connection.hmget(
+        ACTIVITY_KEY % repository_id, 'score', 'updated_at')
+    if not score:
+        return 0.0
+    elapsed = max(0, now - float(updated_at))
+    return float(score) * 0.5 ** (elapsed / settings.REPOSITORY_ACTIVITY_HALF_LIFE)
+
+
+def record_activity(repository_id, weight=1):
+    """
+    Add `weight` to the activity score of the given repository. Errors are
+    only logged as the score is only used to schedule jobs.
+    """
+    if not weight or not settings.REPOSITORY_ADAPTIVE_REFRESH:
+        return
+    try:
+        get_main_limpyd_database().connection.eval(
+            RECORD_ACTIVITY_SCRIPT, 1, ACTIVITY_KEY % repository_id,
+            weight, repr(time()), settings.REPOSITORY_ACTIVITY_HALF_LIFE,
+            # not needed anymore when the score is near 0
+            settings.REPOSITORY_ACTIVITY_HALF_LIFE * 10,
+        )
+    except Exception:
+        logger.exception('Cannot record activity for repository #%s', repository_id)
+
+
+def get_delay(repository_id, queue_name, default):
+    """
+    Return the delay, in seconds, before the next run of the job of the given
+    queue for the given repository, depending on its activity, or `default`
+    if no bounds are defined for this queue (or if the adaptive mode is not
+    activated)
+    """
+    bounds = settings.REPOSITORY_REFRESH_DELAYS.get(queue_name) \
+        if settings.REPOSITORY_ADAPTIVE_REFRESH else None
+    if not bounds:
+        return default
+
+    try:
+        score = get_activity_score(repository_id)
+    except Exception:
+        logger.exception('Cannot get activity for repository #%s', repository_id)
+        return default
+
+    min_delay, max_delay = bounds
+    # 0 for an inactive repository, tending to 1 for very active ones
+    activity = score / (score + settings.REPOSITORY_ACTIVITY_SCORE_REFERENCE)
+    delay = max_delay - (max_delay - min_delay) * activity
+
+    # spread jobs for repositories with the same activity
+    return max(min_delay, int(delay * uniform(0.9, 1.1)))
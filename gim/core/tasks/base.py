@@ -150,7 +150,14 @@ class Worker(LimpydWorker):
         return fields
 
     def execute(self, job, queue):
-        """Delay job when github is not reachable."""
+        """
+        Delay job when github is not reachable.
+        Allow the job to reserve calls on its token while running, and release
+        the ones not consumed at the end, saving the number of calls done by
+        the job.
+        """
+        job.can_reserve_calls = True
+
         try:
             job_result = super(Worker, self).execute(job, queue)
         except (URLError, SSLError, ApiError, BadStatusLine) as exception:
@@ -167,6 +174,11 @@ class Worker(LimpydWorker):
             job.tries.hincrby(1)
             return None
 
+        finally:
+            reservation = job.release_calls()
+            if reservation:
+                job.record_calls(reservation.calls)
+
         return job_result
 
 
@@ -195,6 +207,11 @@ class Job(LimpydJob):
     clonable_fields = ()
     extra_args = fields.HashField()  # will store any kind of information depending on jobs
 
+    # set to True by the worker while the job is run, to reserve calls on the
+    # token used by the job (see `reserve_calls`)
+    can_reserve_calls = False
+    calls_reservation = None
+
     def run(self, queue):
         return None
 
@@ -226,6 +243,77 @@ class Job(LimpydJob):
 
         return super(Job, cls).add_job(*args, **kwargs)
 
+    @classmethod
+    def get_calls_stats_key(cls):
+        return cls.make_key(NAMESPACE, 'calls-per-job')
+
+    @classmethod
+    def get_estimated_calls(cls):
+        """
+        Return the number of github calls a job of this queue is expected to
+        do, based on the previous ones
+        """
+        average = cls.get_connection().hget(cls.get_calls_stats_key(), cls.queue_name)
+        return max(1, int(round(float(average)))) if average else 1
+
+    @classmethod
+    def record_calls(cls, count):
+        """
+        Update the moving average of the number of github calls done by the
+        jobs of this queue
+        """
+        connection = cls.get_connection()
+        average = connection.hget(cls.get_calls_stats_key(), cls.queue_name)
+        average = count if average is None else float(average) * 0.9 + count * 0.1
+        connection.hset(cls.get_calls_stats_key(), cls.queue_name, average)
+
+    def reserve_calls(self, token, for_graphql, permission):
+        """
+        Reserve on the given token the number of github calls the job is
+        expected to do, only once, and only while the job is run by a worker.
+        For jobs not forced to use the token of the user ("self" permission),
+        the reservation is refused if it would let less than the limit kept
+        for users actions.
+        Return a tuple like `Token.reserve_calls`
+        """
+        if not settings.GITHUB_TOKENS_RESERVATIONS or not self.can_reserve_calls or self.calls_reservation:
+            return True, 0
+
+        from gim.core.limpyd_models import CallsReservation
+
+        limit = token.GRAPHQL_LIMIT if for_graphql else token.LIMIT
+        count = min(self.get_estimated_calls(), limit)
+        reserved, delay = token.reserve_calls(count, for_graphql, min_remaining=0 if permission == 'self' else limit)
+        if reserved:
+            self.calls_reservation = CallsReservation(token, count, for_graphql)
+
+        return reserved, delay
+
+    def release_calls(self):
+        """
+        Release the calls reserved by `reserve_calls` not consumed by the calls
+        done by the job, and stop reserving.
+        Return the reservation, if any, with the number of calls done
+        """
+        reservation, self.calls_reservation = self.calls_reservation, None
+        self.can_reserve_calls = False
+
+        if reservation:
+            reservation.token.release_calls(reservation.take_remaining(), reservation.for_graphql)
+        return reservation
+
+    def get_gh_for_token(self, token):
+        """
+        Return the connection of the given token, consuming the calls reserved
+        on it by the job, if any
+        """
+        gh = token.gh
+        if self.calls_reservation and self.calls_reservation.token.pk.get() == token.pk.get():
+            # not the one in the pool, that may be used outside of the job
+            gh = gh.copy()
+            gh.calls_reservation = self.calls_reservation
+        return gh
+
     def _get_gh(self):
         """
         Return a Connection object based on arguments saved in the job, or by
@@ -278,7 +366,8 @@ class Job(LimpydJob):
                 if int(rate_limit_remaining_field.get() or 0):
                     # ensure the token is still valid for this repository
                     if permission == 'self' or not repository or not repository.private or token.is_available_for_repository(repository.pk, permission):
-                        return token.gh
+                        if self.reserve_calls(token, use_graphql, permission)[0]:
+                            return self.get_gh_for_token(token)
 
         # no token, try to get one...
 
@@ -334,12 +423,32 @@ class Job(LimpydJob):
 
             return None
 
+        # reserve the calls the job is expected to do, or delay the job until
+        # the rate limit is reset if there are not enough calls left
+        reserved, delay = self.reserve_calls(token, use_graphql, permission)
+        if not reserved and permission != 'self':
+            # many calls may already be reserved on this token, try another one
+            if repository:
+                other_token = Token.get_one_for_repository(repository.pk, permission, for_graphql=use_graphql)
+            else:
+                other_token = Token.get_one()
+            if other_token and other_token.pk.get() != token.pk.get():
+                reserved, other_delay = self.reserve_calls(other_token, use_graphql, permission)
+                if reserved:
+                    token = other_token
+                else:
+                    delay = min(delay, other_delay) if delay > 0 else other_delay
+        if not reserved:
+            self.status.hset(STATUSES.DELAYED)
+            self.delayed_until.hset(compute_delayed_until(delayed_for=delay if delay > 0 else 60))
+            return None
+
         # save it in the job, useful when cloning to avoid searching for a new
         # gh (will only happen if it is not available anymore)
         self.gh = token.gh
 
         # and ok, return it
-        return token.gh
+        return self.get_gh_for_token(token)
 
     def _set_gh(self, gh):
         """
@@ -5,6 +5,7 @@ __all__ = [
     'FetchPullRequestsCommitsParents',
     'FetchUpdatedReviews',
     'FetchUnmergedPullRequests',
+    'FetchPendingCommits',
     'FetchCollaborators',
     'FirstFetch',
     'FirstFetchStep2',
@@ -17,6 +18,8 @@ from dateutil.parser import parse
 from random import randint
 from threading import local
 
+from django.conf import settings
+
 from limpyd import fields
 from limpyd_jobs import STATUSES
 from async_messages import messages
@@ -25,6 +28,7 @@ from gim.core.managers import MODE_UPDATE
 from gim.core.models import Repository, GithubUser
 from gim.github import ApiNotFoundError
 from gim.core.limpyd_models import Token
+from gim.core.scheduler import get_delay, record_activity
 from gim.subscriptions.models import WaitingSubscription, WAITING_SUBSCRIPTION_STATES
 
 from .base import DjangoModelJob, Job
@@ -81,6 +85,7 @@ class FetchClosedIssuesWithNoClosedBy(RepositoryJob):
                                                     limit=int(self.limit.hget() or 20), gh=gh)
 
         self.hmset(count=count, errors=errors)
+        record_activity(self.repository.pk, count)
 
         return count, deleted, errors, todo
 
@@ -90,6 +95,7 @@ class FetchClosedIssuesWithNoClosedBy(RepositoryJob):
         """
         todo = result[3]
         if todo:
+            # some work is known to be waiting: not delayed by the activity
             self.clone(delayed_for=60)
 
     def success_message_addon(self, queue, result):
@@ -128,6 +134,7 @@ class FetchUpdatedPullRequests(RepositoryJob):
                                     limit=int(self.limit.hget() or 20), gh=gh)
 
         self.hmset(count=count, errors=errors)
+        record_activity(self.repository.pk, count)
 
         return count, deleted, errors, todo
 
@@ -137,6 +144,7 @@ class FetchUpdatedPullRequests(RepositoryJob):
         """
         todo = result[3]
         if todo:
+            # some work is known to be waiting: not delayed by the activity
             self.clone(delayed_for=60)
 
     def success_message_addon(self, queue, result):
@@ -200,13 +208,14 @@ class FetchUpdatedReviews(RepositoryJob):
         count, total = self.repository.fetch_updated_pr_reviews(gh, max_prs=int(self.limit.hget() or 10))
 
         self.count.hset(count)
+        record_activity(self.repository.pk, count)
 
         return count, total
 
     def on_success(self, queue, result):
         # replay this often
         if self.repository.pr_reviews_activated:
-            self.clone(delayed_for=60)
+            self.clone(delayed_for=get_delay(self.identifier.hget(), self.queue_name, default=60))
 
     def success_message_addon(self, queue, result):
         return ' [fetched=%s, total=%s]' % result
@@ -267,6 +276,60 @@ class FetchUnmergedPullRequests(RepositoryJob):
         return ' [fetched=%d, updated=%s, deleted=%s, errors=%s, todo=%s]' % result[:-1]
 
 
+class FetchPendingCommits(RepositoryJob):
+    """
+    Job that fetches many commits of a repository at once, the ones waiting to
+    be fully fetched (see `Repository.add_pending_commits`)
+    """
+    queue_name = 'fetch-pending-commits'
+
+    limit = fields.InstanceHashField()
+    count = fields.InstanceHashField()
+    errors = fields.InstanceHashField()
+
+    permission = 'read'
+    clonable_fields = ('limit', )
+
+    def run(self, queue):
+        """
+        Get some commits waiting to be fetched and fetch them, and save the
+        count of fetched commits in the job
+        """
+        super(FetchPendingCommits, self).run(queue)
+
+        gh = self.gh
+        if not gh:
+            return  # it's delayed !
+
+        repository = self.repository
+
+        shas = repository.pop_pending_commits(int(self.limit.hget() or 50))
+        try:
+            count, deleted, errors = repository.fetch_commits_by_sha(gh, shas)
+        except Exception:
+            # they will be fetched by the next job
+            Repository.add_pending_commits(repository.pk, shas)
+            raise
+
+        self.hmset(count=count, errors=errors)
+
+        return count, deleted, errors, repository.count_pending_commits()
+
+    def on_success(self, queue, result):
+        """
+        If there is still commits to fetch, add a new job
+        """
+        todo = result[3]
+        if todo:
+            self.clone()
+
+    def success_message_addon(self, queue, result):
+        """
+        Display the count of fetched commits
+        """
+        return ' [fetched=%d, deleted=%s, errors=%s, todo=%s]' % result
+
+
 class FetchCollaborators(RepositoryJob):
     """
     A job to fetch collaborators, as it has to be done by user with at least
@@ -459,7 +522,9 @@ class FirstFetchStep2(RepositoryJob):
         try:
             counts = self.repository.fetch_all_step2(gh=gh, force_fetch=True,
                             start_page=self._start_page, max_pages=self._max_pages,
-                            to_ignore=self._to_ignore, issues_state='closed')
+                            to_ignore=self._to_ignore, issues_state='closed',
+                            parallel_pages=settings.FIRST_FETCH_PARALLEL_PAGES,
+                            parallel_lists=settings.FIRST_FETCH_PARALLEL_LISTS)
 
             if self.repository.pr_reviews_activated and 'pr_reviews' not in self._to_ignore:
                 counts['pr_reviews'] = -1  # to indicate failure
@@ -552,7 +617,8 @@ class FetchForUpdate(RepositoryJob):
     needs to.
     When done:
     - spawn a job to fetch collaborators
-    - clone the job to be done again 15 min laters (+-2mn)
+    - clone the job to be done again 15 min laters (+-2mn), or depending on
+      the activity of the repository (see `gim.core.scheduler`)
     """
     queue_name = 'update-repo'
 
@@ -572,10 +638,12 @@ class FetchForUpdate(RepositoryJob):
 
     def on_success(self, queue, result):
         """
-        Fetch collaborators and go fetch again in 15 +- 2mn
+        Fetch collaborators and go fetch again in 15 +- 2mn (or depending on
+        the activity of the repository)
         """
         FetchCollaborators.add_job(self.object.id)
-        self.clone(delayed_for=60 * 13 + randint(0, 60 * 4))
+        self.clone(delayed_for=get_delay(self.identifier.hget(), self.queue_name,
+                                         default=60 * 13 + randint(0, 60 * 4)))
 
 
 class ManageDualRepository(Job):
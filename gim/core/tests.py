@@ -5,7 +5,32 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from contextlib import contextmanager
+from cStringIO import StringIO
+from datetime import datetime
+from mimetools import Message
+from threading import Lock, Thread
+from time import time
+import urllib2
+
+from mock import Mock, patch
+
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_save
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from gim.core import get_main_limpyd_database
+from gim.core.batch import add_job, get_sync_batch, sync_batch
+from gim.core.ghpool import Connection, ResponseCache
+from gim.core.identity_map import IdentityMap, identity_map
+from gim.core.limpyd_models import CallsReservation, Token
+from gim.core.scheduler import ACTIVITY_KEY, get_activity_score, record_activity
+from gim.core.tasks.repository import FetchClosedIssuesWithNoClosedBy, FetchUpdatedPullRequests
+from gim.core.models import GithubUser, Issue, Repository
+from gim.core.utils import PayloadDigests, SavedObjects
+from gim.github import ApiError, GitHub, JsonObject, _parse_json
 
 
 class SimpleTest(TestCase):
@@ -14,3 +39,755 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class ParseJsonTest(TestCase):
+
+    def test_objects_keys_are_unicode(self):
+        data = _parse_json('{"login": "foo", "user": {"id": 1}}')
+        self.assertIsInstance(data, JsonObject)
+        self.assertIsInstance(data.user, JsonObject)
+        self.assertEqual([type(key) for key in data], [unicode, unicode])
+        # they can be used as str
+        self.assertEqual(data['login'], 'foo')
+        self.assertEqual(data.user.id, 1)
+        self.assertEqual(dict(**data.user), {'id': 1})
+
+    def test_list_is_decoded_lazily(self):
+        data = _parse_json(' [ {"id": 1}, {"id": 2} , invalid ', stream=True)
+        self.assertEqual(next(data), {'id': 1})
+        self.assertEqual(next(data), {'id': 2})
+        with self.assertRaises(ValueError):
+            next(data)
+
+    def test_stream_of_empty_list_or_object(self):
+        self.assertEqual(list(_parse_json('[]', stream=True)), [])
+        self.assertEqual(_parse_json('{"id": 1}', stream=True), {'id': 1})
+
+
+class ConnectionTest(TestCase):
+
+    def test_copy_is_not_the_pooled_connection(self):
+        gh = Connection.get(username='foo', access_token='bar')
+        self.assertIs(Connection.get(username='foo', access_token='bar'), gh)
+        copy = gh.copy()
+        self.assertIsNot(copy, gh)
+        self.assertEqual(copy._authorization, gh._authorization)
+        # calls done in other threads consume the calls reserved by the job
+        copy.calls_reservation = Mock()
+        self.assertIs(copy.copy().calls_reservation, copy.calls_reservation)
+        self.assertIsNone(gh.calls_reservation)
+        self.assertEqual(copy._connection_args, gh._connection_args)
+        self.assertIs(Connection.get(username='foo', access_token='bar'), gh)
+        # the headers of the last response are not shared
+        copy.x_ratelimit_remaining = 10
+        self.assertEqual(gh.x_ratelimit_remaining, -1)
+
+
+class SyncBatchTest(TransactionTestCase):
+
+    def test_deferred_calls_are_run_once_when_leaving(self):
+        calls = []
+        with sync_batch():
+            get_sync_batch().defer('foo', calls.append, 1)
+            get_sync_batch().defer('foo', calls.append, 2)
+            get_sync_batch().defer('bar', calls.append, 3)
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, [2, 3])
+        self.assertIsNone(get_sync_batch())
+
+    def test_jobs_are_added_once_by_identifier(self):
+        job_model = Mock()
+        with sync_batch():
+            add_job(job_model, 1, force_fetch=0, foo=1)
+            add_job(job_model, 2)
+            add_job(job_model, 1, force_fetch=1)
+            self.assertFalse(job_model.add_job.called)
+        self.assertEqual(job_model.add_job.call_args_list, [
+            ((1, ), {'force_fetch': 1, 'foo': 1}),
+            ((2, ), {}),
+        ])
+
+        # without batch, the job is added now
+        add_job(job_model, 3)
+        self.assertEqual(job_model.add_job.call_args, ((3, ), {}))
+
+    def test_deferred_calls_are_run_in_the_flush_wrappers(self):
+        calls = []
+
+        @contextmanager
+        def wrapper():
+            calls.append('enter')
+            yield
+            calls.append('exit')
+
+        def fail():
+            raise ValueError
+
+        with sync_batch():
+            get_sync_batch().wrap_flush('wrapper', wrapper)
+            get_sync_batch().wrap_flush('wrapper', wrapper)
+            get_sync_batch().defer('fail', fail)
+            get_sync_batch().defer('foo', calls.append, 1)
+        # a failing call does not stop the other ones
+        self.assertEqual(calls, ['enter', 1, 'exit'])
+
+    def test_deferred_calls_are_run_when_leaving_with_an_exception(self):
+        # objects saved before the exception are committed, in autocommit mode
+        calls = []
+        with self.assertRaises(ValueError):
+            with sync_batch():
+                get_sync_batch().defer('foo', calls.append, 1)
+                raise ValueError
+        self.assertEqual(calls, [1])
+
+    def test_deferred_calls_wait_for_the_commit(self):
+        calls = []
+        with transaction.atomic():
+            with sync_batch():
+                get_sync_batch().defer('foo', calls.append, 1)
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, [1])
+
+    def test_deferred_calls_are_discarded_on_rollback(self):
+        calls = []
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                with sync_batch():
+                    get_sync_batch().defer('foo', calls.append, 1)
+                raise ValueError
+        self.assertEqual(calls, [])
+
+
+class AtomicCreateOrUpdateFromListTest(TransactionTestCase):
+
+    def test_all_objects_are_saved(self):
+        with sync_batch():
+            objs = GithubUser.objects.atomic_create_or_update_from_list([
+                {'id': 1, 'login': 'foo'},
+                {'id': 2, 'login': 'bar'},
+            ])
+        self.assertEqual([obj.username for obj in objs], ['foo', 'bar'])
+        self.assertEqual(GithubUser.objects.filter(github_id__in=[1, 2]).count(), 2)
+
+    def test_integrity_error_is_raised_after_saving_other_objects(self):
+        GithubUser.objects.create(username='foo', github_id=1)
+        calls = []
+        saved_objects = SavedObjects()
+
+        def create_or_update_from_dict(data, *args, **kwargs):
+            # defer a side effect for each object, that must be discarded on rollback
+            get_sync_batch().defer(data['login'], calls.append, data['login'])
+            return original(data, *args, **kwargs)
+
+        original = GithubUser.objects.create_or_update_from_dict
+        with patch.object(GithubUser.objects, 'create_or_update_from_dict',
+                          side_effect=create_or_update_from_dict), \
+                self.assertRaises(IntegrityError), sync_batch():
+            # a generator, as the entries of a page read from github
+            GithubUser.objects.atomic_create_or_update_from_list(iter([
+                {'id': 2, 'login': 'bar'},
+                # same username as the existing one, with another id
+                {'id': 3, 'login': 'foo'},
+                {'id': 4, 'login': 'baz'},
+            ]), saved_objects=saved_objects)
+
+        self.assertEqual(
+            sorted(GithubUser.objects.values_list('github_id', flat=True)),
+            [1, 2, 4]
+        )
+        self.assertEqual(sorted(calls), ['bar', 'baz'])
+        self.assertEqual(
+            sorted(obj.github_id for obj in saved_objects[GithubUser].values()),
+            [2, 4]
+        )
+
+
+@override_settings(GITHUB_PAYLOAD_DIGESTS=False)
+class BulkCreateOrUpdateFromListTest(TransactionTestCase):
+
+    # the second time, one object is updated, one is the same, one is new
+    REPOSITORIES_PAGES = [
+        [
+            {'id': 1, 'name': 'foo', 'description': 'Foo', 'owner': {'id': 10, 'login': 'alice'}},
+            {'id': 2, 'name': 'bar', 'private': True, 'owner': {'id': 11, 'login': 'bob'}},
+        ],
+        [
+            {'id': 1, 'name': 'foo', 'description': 'New foo', 'owner': {'id': 10, 'login': 'alice'}},
+            {'id': 2, 'name': 'bar', 'private': True, 'owner': {'id': 11, 'login': 'bob'}},
+            {'id': 3, 'name': 'baz', 'owner': {'id': 10, 'login': 'alice'}},
+        ],
+    ]
+
+    USERS_PAGES = [
+        [
+            {'id': 10, 'login': 'alice', 'avatar_url': 'http://example.com/alice'},
+            {'id': 11, 'login': 'bob'},
+        ],
+        [
+            {'id': 10, 'login': 'alice', 'avatar_url': 'http://example.com/alice2'},
+            {'id': 11, 'login': 'bob'},
+            {'id': 12, 'login': 'carol'},
+        ],
+    ]
+
+    IGNORED_FIELDS = {'id', 'owner_id', 'fetched_at', 'date_joined'}
+
+    def get_rows(self, model):
+        return sorted(
+            {name: value for name, value in row.items() if name not in self.IGNORED_FIELDS}
+            for row in model.objects.values()
+        )
+
+    def save_pages(self, model, pages, bulk):
+        """
+        Save all the pages with or without the bulk mode and return the saved
+        rows and the `post_save` signals received for each page (the bulk
+        path does not send them in the same order)
+        """
+        signals = []
+
+        def on_post_save(sender, instance, created, update_fields, **kwargs):
+            if sender in (GithubUser, Repository):
+                signals[-1].append((sender.__name__, instance.github_id, created,
+                                    sorted(update_fields or [])))
+
+        post_save.connect(on_post_save, weak=False, dispatch_uid='test-bulk')
+        try:
+            for page in pages:
+                signals.append([])
+                objs = model.objects.create_or_update_from_list(page, bulk=bulk)
+                self.assertEqual([obj.github_id for obj in objs], [entry['id'] for entry in page])
+                signals[-1].sort()
+        finally:
+            post_save.disconnect(dispatch_uid='test-bulk')
+
+        result = self.get_rows(GithubUser), self.get_rows(Repository), sorted(
+            (repository.name, repository.owner.username) for repository in Repository.objects.all())
+
+        Repository.objects.all().delete()
+        GithubUser.objects.all().delete()
+
+        return result, signals
+
+    def assert_same_results(self, model, pages):
+        self.assertTrue(model.objects.can_bulk_update())
+        rows, signals = self.save_pages(model, pages, bulk=False)
+        bulk_rows, bulk_signals = self.save_pages(model, pages, bulk=True)
+        self.assertEqual(bulk_rows, rows)
+        self.assertEqual(bulk_signals, signals)
+
+    def test_bulk_saved_model(self):
+        self.assertTrue(Repository.objects.can_bulk_save())
+        self.assert_same_results(Repository, self.REPOSITORIES_PAGES)
+
+    def test_model_with_save_method(self):
+        self.assertFalse(GithubUser.objects.can_bulk_save())
+        self.assert_same_results(GithubUser, self.USERS_PAGES)
+
+    def count_queries(self, page, bulk):
+        with CaptureQueriesContext(connection) as context:
+            Repository.objects.create_or_update_from_list(page, bulk=bulk)
+        return len(context)
+
+    def test_number_of_queries(self):
+        # 50 repositories of 5 owners, created then updated
+        page = [
+            {'id': number, 'name': 'repo-%s' % number,
+             'owner': {'id': 1000 + number % 5, 'login': 'user-%s' % (number % 5)}}
+            for number in range(50)
+        ]
+        updated_page = [dict(entry, description='updated') for entry in page]
+
+        counts = {}
+        for bulk in (False, True):
+            counts[bulk] = self.count_queries(page, bulk), self.count_queries(updated_page, bulk)
+            Repository.objects.all().delete()
+            GithubUser.objects.all().delete()
+
+        # one query or more by object without the bulk mode
+        # at least 3 queries by repository without the bulk mode (170 and 160)
+        self.assertGreater(min(counts[False]), 150)
+        # with it, a few queries by page whatever the number of repositories,
+        # plus some for each owner that has its own `save` method (19 and 11)
+        self.assertLess(max(counts[True]), 25)
+
+
+@override_settings(GITHUB_PAYLOAD_DIGESTS=True)
+class PayloadDigestsTest(TransactionTestCase):
+
+    PAGE = [
+        {'id': 1, 'name': 'foo', 'owner': {'id': 10, 'login': 'alice'}},
+        {'id': 2, 'name': 'bar', 'owner': {'id': 10, 'login': 'alice'}},
+    ]
+
+    def setUp(self):
+        self.digests = PayloadDigests(Repository)
+        keys = self.digests.redis.keys('%s:*' % PayloadDigests.KEY_PREFIX)
+        if keys:
+            self.digests.redis.delete(*keys)
+
+    def test_unchanged_objects_are_skipped(self):
+        Repository.objects.create_or_update_from_list(self.PAGE, bulk=True)
+        repositories = list(Repository.objects.order_by('github_id'))
+        stored = self.digests.get_many(repository.pk for repository in repositories)
+        self.assertEqual(len(stored), 2)
+        key = self.digests.key % repositories[0].pk
+        self.assertGreater(self.digests.redis.ttl(key), 0)
+
+        signals = []
+        post_save.connect(lambda sender, **kwargs: signals.append(sender),
+                          sender=Repository, weak=False, dispatch_uid='test-digests')
+        try:
+            Repository.objects.create_or_update_from_list(self.PAGE, bulk=True)
+        finally:
+            post_save.disconnect(sender=Repository, dispatch_uid='test-digests')
+        self.assertEqual(signals, [])
+
+    def test_digest_is_removed_when_saved_or_deleted(self):
+        page = [{'id': 10, 'login': 'alice'}, {'id': 11, 'login': 'bob'}]
+        digests = PayloadDigests(GithubUser)
+        GithubUser.objects.create_or_update_from_list(page, bulk=True)
+        alice, bob = GithubUser.objects.order_by('github_id')
+        self.assertEqual(len(digests.get_many([alice.pk, bob.pk])), 2)
+
+        # saved outside of the bulk path: may not match the payload anymore
+        alice.full_name = 'Alice'
+        alice.save()
+        self.assertEqual(digests.get_many([alice.pk, bob.pk]).keys(), [bob.pk])
+
+        bob.delete()
+        self.assertEqual(digests.get_many([alice.pk, bob.pk]), {})
+
+        # so they are saved again from the payload, with a new digest
+        GithubUser.objects.create_or_update_from_list(page, bulk=True)
+        alice, bob = GithubUser.objects.order_by('github_id')
+        self.assertEqual(len(digests.get_many([alice.pk, bob.pk])), 2)
+
+
+class IdentityMapTest(TransactionTestCase):
+
+    def setUp(self):
+        identity_map.clear()
+
+    def test_objects_updated_in_bulk_are_invalidated(self):
+        GithubUser.objects.create(username='alice', github_id=10)
+        filters = {'github_id': 10}
+        user = GithubUser.objects.get_from_identifiers({'simple': {'github_id': 10}})[0]
+        self.assertEqual(identity_map.get(GithubUser, filters).pk, user.pk)
+
+        # only the `organizations_fetched_at` field is updated, without signal
+        GithubUser.bulk_update_related_field('organizations', [(user, [])])
+        self.assertIsNone(identity_map.get(GithubUser, filters))
+        self.assertIsNotNone(GithubUser.objects.get(pk=user.pk).organizations_fetched_at)
+
+    def test_objects_loaded_in_a_transaction_are_not_stored(self):
+        GithubUser.objects.create(username='alice', github_id=10)
+        with transaction.atomic():
+            GithubUser.objects.get_from_identifiers({'simple': {'github_id': 10}})
+        self.assertIsNone(identity_map.get(GithubUser, {'github_id': 10}))
+
+    def test_invalidations_are_published_on_commit(self):
+        users = [GithubUser.objects.create(username=name, github_id=10 + index)
+                 for index, name in enumerate(['alice', 'bob', 'carol'])]
+        pipeline = Mock()
+        with patch.object(IdentityMap, 'redis', Mock(**{'pipeline.return_value': pipeline})):
+            with transaction.atomic():
+                GithubUser.objects.invalidate_identity_map(users)
+                self.assertFalse(pipeline.publish.called)
+            # one message for all the objects
+            pipeline.publish.assert_called_once_with(IdentityMap.CHANNEL, '%s|core.GithubUser|%s' % (
+                identity_map.token, ','.join(str(user.pk) for user in users)))
+            self.assertEqual(pipeline.execute.call_count, 1)
+
+            # nothing sent on rollback
+            pipeline.reset_mock()
+            with self.assertRaises(ValueError), transaction.atomic():
+                users[0].save()
+                raise ValueError
+            self.assertFalse(pipeline.publish.called)
+
+
+@override_settings(REPOSITORY_ADAPTIVE_REFRESH=True, REPOSITORY_ACTIVITY_HALF_LIFE=3600)
+class ActivityScoreTest(TestCase):
+
+    def setUp(self):
+        self.redis = get_main_limpyd_database().connection
+        self.redis.delete(ACTIVITY_KEY % 1)
+
+    def test_score_decays(self):
+        record_activity(1, 4)
+        self.assertAlmostEqual(get_activity_score(1), 4, places=2)
+        self.assertAlmostEqual(get_activity_score(1, time() + 3600), 2, places=2)
+        self.assertGreater(self.redis.ttl(ACTIVITY_KEY % 1), 0)
+
+        # an hour later, the new weight is added to the decayed score
+        self.redis.hset(ACTIVITY_KEY % 1, 'updated_at', time() - 3600)
+        record_activity(1, 1)
+        self.assertAlmostEqual(get_activity_score(1), 3, places=2)
+
+    def test_concurrent_increments_are_not_lost(self):
+        def record():
+            for __ in range(20):
+                record_activity(1)
+
+        threads = [Thread(target=record) for __ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # a few seconds of decay at most
+        self.assertAlmostEqual(get_activity_score(1), 200, delta=0.5)
+
+    def test_waiting_work_is_not_delayed(self):
+        for job_class in (FetchClosedIssuesWithNoClosedBy, FetchUpdatedPullRequests):
+            job = Mock(queue_name=job_class.queue_name)
+            job_class.on_success.im_func(job, None, (20, 0, 0, 5))
+            job.clone.assert_called_once_with(delayed_for=60)
+
+
+class FrozenDatetime(datetime):
+
+    @classmethod
+    def utcnow(cls):
+        return cls(2020, 1, 1, 12, 0, 0)
+
+
+@override_settings(GITHUB_TOKENS_SCORE_INDEX=True)
+class TokensUpdateScriptTest(TestCase):
+    """Check that the lua script does the same as `Token.update_from_gh`"""
+
+    def setUp(self):
+        self.redis = Token.get_connection()
+        self.clear_tokens()
+
+    def tearDown(self):
+        self.clear_tokens()
+
+    def clear_tokens(self):
+        keys = self.redis.keys(Token.make_key(Token._name, '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+    def create_tokens(self):
+        Token(username='alice', token='aaa', can_access_graphql_api=1)
+        Token(username='alice', token='bbb')
+        Token(username='bob', token='ccc')
+
+    @staticmethod
+    def get_gh(access_token, scopes, remaining, reset=-1):
+        return Mock(_connection_args={'access_token': access_token, 'username': 'alice'},
+                    _tokens_pks_cache=None, calls_reservation=None, x_oauth_scopes=scopes,
+                    x_ratelimit_remaining=remaining, x_ratelimit_limit=5000, x_ratelimit_reset=reset)
+
+    def run_calls(self, use_script):
+        error = Mock(code=500, response=Mock(json={'message': 'Server error'}))
+        calls = [
+            (self.get_gh('aaa', ['repo', 'user'], 4000), None, '/user'),
+            (self.get_gh('bbb', ['user'], 4000), None, '/user'),
+            # too few calls remaining, and an error: logged
+            (self.get_gh('aaa', ['repo'], 30), error, '/repos/foo/bar'),
+            (self.get_gh('aaa', None, 150), None, '/graphql'),
+            (self.get_gh('bbb', [], -1), None, '/user'),
+        ]
+        with override_settings(GITHUB_TOKENS_UPDATE_SCRIPT=use_script), \
+                patch('gim.core.limpyd_models.datetime', FrozenDatetime), \
+                patch('gim.core.limpyd_models.randint', return_value=10):
+            for gh, api_error, path in calls:
+                Token.update_tokens_from_gh(gh, api_error, 'GET', path, {}, {'foo': 'bar'}, {})
+
+    def get_state(self):
+        """Return the content of all the keys of the tokens"""
+        def number(value):
+            # scores are not written with the same precision by python and lua
+            return round(float(value), 6)
+
+        state = {}
+        for key in self.redis.keys(Token.make_key(Token._name, '*')):
+            key_type = self.redis.type(key)
+            if key_type == 'hash':
+                value = {field: number(val) if field.endswith('score') else val
+                         for field, val in self.redis.hgetall(key).items()}
+            elif key_type == 'string':
+                value = self.redis.get(key)
+            elif key_type == 'set':
+                value = self.redis.smembers(key)
+            else:
+                value = [(member, number(score)) for member, score
+                         in self.redis.zrange(key, 0, -1, withscores=True)]
+            state[key] = (key_type, value, self.redis.ttl(key) > 0)
+        return state
+
+    def get_filters(self):
+        """Return the pks of the tokens matching the indexes used in the code"""
+        filters = [
+            {'username': 'alice'}, {'username': 'bob'},
+            {'scopes': 'repo'}, {'scopes': 'user'},
+            {'valid_scopes': 1}, {'valid_scopes': 0},
+            {'available': 1}, {'available': 0},
+            {'graphql_available': 1}, {'graphql_available': 0},
+            {'valid_scopes': 1, 'available': 1},
+        ]
+        return [set(Token.collection(**f)) for f in filters]
+
+    def test_script_and_python_give_same_keys(self):
+        self.create_tokens()
+        self.run_calls(use_script=False)
+        python_state, python_filters = self.get_state(), self.get_filters()
+
+        self.clear_tokens()
+        self.create_tokens()
+        self.run_calls(use_script=True)
+
+        self.assertEqual(self.get_state(), python_state)
+        self.assertEqual(self.get_filters(), python_filters)
+
+    def test_filters_match_values(self):
+        self.create_tokens()
+        self.run_calls(use_script=True)
+
+        alice_pks = set(Token.collection(username='alice'))
+        self.assertEqual(len(alice_pks), 2)
+        for pk in Token.collection().sort():
+            token = Token.get(pk)
+            self.assertEqual(pk in alice_pks, token.username.hget() == 'alice')
+            self.assertEqual(pk in set(Token.collection(available=1)), token.available.hget() == '1')
+            self.assertEqual(pk in set(Token.collection(valid_scopes=1)), token.valid_scopes.hget() == '1')
+            for scope in ('repo', 'user'):
+                self.assertEqual(pk in set(Token.collection(scopes=scope)), token.scopes.sismember(scope))
+
+        # the last call, without scopes, removed all the scopes of the tokens of alice
+        aaa, bbb = Token.get(token='aaa'), Token.get(token='bbb')
+        self.assertEqual(aaa.scopes.smembers(), set())
+        self.assertEqual(set(Token.collection(scopes='repo')), set())
+        self.assertEqual(set(Token.collection(valid_scopes=0)), alice_pks)
+        self.assertEqual(set(Token.collection(graphql_available=1)), alice_pks)
+        # errors are only logged for the token used for the call
+        self.assertEqual(aaa.errors.zcard(), 1)
+        self.assertEqual(bbb.errors.zcard(), 0)
+
+    def test_calls_consume_the_reservation(self):
+        for use_script in (False, True):
+            self.create_tokens()
+            token = Token.get(token='aaa')
+            token.rate_limit_remaining.set(4000)
+            token.reserve_calls(5)
+            reservation = CallsReservation(token, 5)
+            gh = self.get_gh('aaa', ['repo'], 3999)
+            gh.calls_reservation = reservation
+
+            with override_settings(GITHUB_TOKENS_UPDATE_SCRIPT=use_script):
+                for path in ('/user', '/user', '/graphql'):
+                    Token.update_tokens_from_gh(gh, None, 'GET', path, {}, {}, {})
+                # no call done
+                gh.x_ratelimit_remaining = -1
+                Token.update_tokens_from_gh(gh, None, 'GET', '/user', {}, {}, {})
+
+            self.assertEqual(reservation.calls, 2)
+            self.assertEqual(token.rate_limit_reserved.get(), '3')
+            self.assertEqual(reservation.take_remaining(), 3)
+            self.assertEqual(reservation.take_remaining(), 0)
+            self.clear_tokens()
+
+    def count_commands(self, use_script):
+        """
+        Return the number of redis calls, and of commands run by the redis
+        server, for one github call
+        """
+        self.create_tokens()
+        gh = self.get_gh('aaa', ['repo', 'user'], 4000)
+        # load the script and the pks of the tokens of the user
+        self.run_calls(use_script)
+        Token.get_tokens_pks_for_gh(gh)
+
+        def get_server_count():
+            return sum(stats['calls'] for stats in self.redis.info('commandstats').values())
+
+        server_count = get_server_count()
+        with patch.object(self.redis, 'execute_command', wraps=self.redis.execute_command) as execute_command, \
+                override_settings(GITHUB_TOKENS_UPDATE_SCRIPT=use_script):
+            Token.update_tokens_from_gh(gh, None, 'GET', '/user', {}, {}, {})
+        # minus the first INFO command, counted after its call
+        server_count = get_server_count() - server_count - 1
+
+        self.clear_tokens()
+        return execute_command.call_count, server_count
+
+    def test_number_of_redis_commands(self):
+        python_calls, python_commands = self.count_commands(use_script=False)
+        script_calls, script_commands = self.count_commands(use_script=True)
+
+        # with 2 tokens for the user: 85 calls to redis, running 145 commands,
+        # with python, and 1 call running 62 commands with the script
+        self.assertGreater(python_calls, 50)
+        self.assertEqual(script_calls, 1)
+        self.assertLess(script_commands, python_commands)
+
+
+class ResponseCacheTest(TestCase):
+
+    def test_content_is_stored_compressed(self):
+        cache = ResponseCache(ttl=60)
+        key = cache.get_key('token aaa', 'https://api.github.com/foo')
+        content = '{"foo": "%s"}' % ('bar' * 100)
+        cache.set(key, {'etag': '"abc"', 'content-type': 'application/json', 'x-foo': 'bar'}, content)
+        entry = cache.get(key)
+        cache.redis.delete(key)
+        self.assertEqual(entry['etag'], '"abc"')
+        self.assertEqual(entry['headers'], {'etag': '"abc"', 'content-type': 'application/json'})
+        self.assertEqual(entry['content'], content)
+
+    def test_pages_of_lists_are_not_cached(self):
+        cache = ResponseCache(ttl=60)
+        key = cache.get_key('token aaa', 'https://api.github.com/foo?page=2')
+        self.assertFalse(cache.set(key, {'etag': '"abc"', 'link': '<https://api.github.com/foo?page=3>; rel="next"'},
+                                   '[]'))
+        self.assertIsNone(cache.get(key))
+
+
+class CoalescedRequestsTest(TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(ttl=60, coalesce_wait=5)
+        self.gh = GitHub(access_token='aaa')
+        self.gh.response_cache = self.cache
+        self.key = self.cache.get_key(self.gh._authorization, 'https://api.github.com/foo')
+        self.cache.redis.delete(self.key, '%s:lock' % self.key)
+
+    def tearDown(self):
+        self.cache.redis.delete(self.key, '%s:lock' % self.key)
+
+    def fetch(self, headers, content='{"foo": "bar"}'):
+        """Call `/foo` with the given headers (and content) as response"""
+        response = Mock(code=200, headers=Message(StringIO(headers + '\r\n')))
+        response.read.side_effect = [content, '']
+        opener = Mock()
+
+        def open_url(request, timeout):
+            # the waiting callers must see the lock while fetching
+            self.assertIsNone(self.cache.acquire_fetch_lock(self.key))
+            return response
+
+        opener.open.side_effect = open_url
+        with patch.object(self.gh, '_build_opener', return_value=opener):
+            return self.gh._http('GET', '/foo')
+
+    def test_waiting_callers_use_the_response(self):
+        result = self.fetch('Content-Type: application/json\r\nETag: "abc"\r\n')
+        self.assertEqual(result, {'foo': 'bar'})
+        self.assertIsNone(self.cache.redis.get('%s:lock' % self.key))
+        self.assertEqual(self.cache.get(self.key)['content'], '{"foo": "bar"}')
+
+    def test_failed_fetch_does_not_make_callers_wait(self):
+        # no etag: the response is not saved
+        self.fetch('Content-Type: application/json\r\n')
+        self.assertEqual(self.cache.redis.get('%s:lock' % self.key), ResponseCache.FETCH_FAILED)
+        self.assertIsNone(self.cache.get(self.key))
+
+        started = time()
+        self.assertIsNone(self.cache.acquire_fetch_lock(self.key))
+        self.assertIsNone(self.cache.wait_for_fetch(self.key))
+        self.assertLess(time() - started, 1)
+
+    def test_callers_waiting_for_a_failed_fetch_stop_waiting(self):
+        lock = self.cache.acquire_fetch_lock(self.key)
+
+        def fail():
+            self.cache.release_fetch_lock(self.key, lock, failed=True)
+
+        Thread(target=fail).start()
+        started = time()
+        self.assertIsNone(self.cache.wait_for_fetch(self.key))
+        self.assertLess(time() - started, 1)
+
+    def test_error_is_marked_as_failed(self):
+        opener = Mock()
+        opener.open.side_effect = urllib2.HTTPError('https://api.github.com/foo', 500, 'Error',
+                                                    Message(StringIO('\r\n')), StringIO(''))
+        with patch.object(self.gh, '_build_opener', return_value=opener):
+            with self.assertRaises(ApiError):
+                self.gh._http('GET', '/foo')
+        self.assertEqual(self.cache.redis.get('%s:lock' % self.key), ResponseCache.FETCH_FAILED)
+
+    def test_coalesced_response_resets_headers(self):
+        self.fetch('Content-Type: application/json\r\nETag: "abc"\r\n'
+                   'X-RateLimit-Remaining: 100\r\nX-OAuth-Scopes: repo, user\r\n')
+        self.assertEqual(self.gh.x_ratelimit_remaining, 100)
+        self.assertEqual(self.gh.x_oauth_scopes, ['repo', 'user'])
+
+        entry = self.cache.get(self.key)
+        request = urllib2.Request('https://api.github.com/foo')
+        result = self.gh._use_coalesced_response(entry, request, 'GET', request.get_full_url(), {}, {}, False)
+        self.assertEqual(result, {'foo': 'bar'})
+        # the call was not done: nothing to say about the rate limit and scopes
+        self.assertEqual(self.gh.x_ratelimit_remaining, -1)
+        self.assertIsNone(self.gh.x_oauth_scopes)
+
+    def test_entries_are_by_token(self):
+        url = 'https://api.github.com/user'
+        self.assertNotEqual(self.cache.get_key('token aaa', url), self.cache.get_key('token bbb', url))
+        self.assertIsNone(self.cache.get_key(None, url))
+
+    def test_no_cache_nor_coalescing_without_credentials(self):
+        gh = GitHub()
+        gh.response_cache = self.cache
+        response = Mock(code=200, headers=Message(StringIO('Content-Type: application/json\r\nETag: "abc"\r\n\r\n')))
+        response.read.side_effect = ['{"foo": "bar"}', '']
+        with patch.object(gh, '_build_opener', return_value=Mock(**{'open.return_value': response})), \
+                patch.object(self.cache, 'acquire_fetch_lock') as acquire_fetch_lock, \
+                patch.object(self.cache, 'set') as cache_set:
+            self.assertEqual(gh._http('GET', '/foo'), {'foo': 'bar'})
+        self.assertFalse(acquire_fetch_lock.called)
+        self.assertFalse(cache_set.called)
+
+
+class IssueParallelFetchTest(TransactionTestCase):
+
+    def setUp(self):
+        owner = GithubUser.objects.create(username='alice', github_id=10)
+        repository = Repository.objects.create(owner=owner, name='foo', github_id=20)
+        now = datetime.utcnow()
+        self.issue = Issue.objects.create(repository=repository, user=owner, number=1, github_id=30,
+                                          title='foo', created_at=now, updated_at=now,
+                                          is_pull_request=True)
+
+    def test_commits_are_fetched_before_the_pull_request(self):
+        calls = []
+        lock = Lock()
+
+        def recorder(name):
+            def record(issue, *args, **kwargs):
+                with lock:
+                    calls.append((name, issue, kwargs))
+                if name == 'fetch_pr':
+                    # saved by the thread fetching the pull request
+                    issue.pr_fetched_at = datetime.utcnow()
+                    issue.save(update_fields=['pr_fetched_at'])
+            return record
+
+        names = ['fetch_events', 'fetch_comments', 'fetch_commits', 'fetch_files',
+                 'fetch_pr', 'fetch_pr_comments', 'fetch_head_commit_statuses']
+        patches = [patch.object(Issue, name, autospec=True, side_effect=recorder(name)) for name in names]
+        for patcher in patches:
+            patcher.start()
+        try:
+            self.issue.fetch_all_related_in_parallel(Mock(), False, 4)
+        finally:
+            for patcher in patches:
+                patcher.stop()
+
+        called = [name for name, issue, kwargs in calls]
+        self.assertEqual(sorted(called), sorted(names))
+        for name in ('fetch_pr', 'fetch_comments', 'fetch_pr_comments'):
+            self.assertGreater(called.index(name), called.index('fetch_commits'))
+        self.assertGreater(called.index('fetch_head_commit_statuses'), called.index('fetch_pr'))
+        self.assertTrue(calls[called.index('fetch_head_commit_statuses')][2]['force_head_commit'])
+
+        # each thread has its own copy of the issue, reloaded at the end
+        issues = {name: issue for name, issue, kwargs in calls}
+        self.assertEqual(len({id(issue) for issue in issues.values()}), 6)
+        self.assertIs(issues['fetch_head_commit_statuses'], issues['fetch_pr'])
+        issues = {id(issue) for issue in issues.values()}
+        self.assertNotIn(id(self.issue), issues)
+        self.assertIsNotNone(self.issue.pr_fetched_at)
@@ -1,11 +1,14 @@
 import gc
+import json
 import signal
 from collections import defaultdict
 from contextlib import contextmanager
 from functools import wraps
+from hashlib import sha1
 
+from django.conf import settings
 from django.contrib.postgres import fields
-from django.db import models
+from django.db import connection, models
 
 
 class JSONField(fields.JSONField):
@@ -151,6 +154,29 @@ def cached_method(func):
     return wrapper
 
 
+def in_pool_thread(func):
+    """
+    Decorator for a function to be run in a thread of a pool: the thread will
+    use the publishing context (`skip_publish`) of the thread creating the
+    decorated function, and its database connection will be closed at the end.
+    """
+    from gim.front.publish import thread_data
+
+    skip_publish = getattr(thread_data, 'skip_publish', False)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        thread_data.skip_publish = skip_publish
+        try:
+            return func(*args, **kwargs)
+        finally:
+            thread_data.skip_publish = False
+            # each thread has its own connection, that would be left open
+            connection.close()
+
+    return wrapper
+
+
 class SavedObjects(dict):
     """
     A simple dict with two helpers to get/set saved objects during a fetch, to
@@ -167,6 +193,76 @@ class SavedObjects(dict):
     def set_object(self, model, filters, obj, saved=False):
         self.setdefault(model, {})[tuple(sorted(filters.items()))] = obj
 
+    def backup(self):
+        return {model: dict(objects) for model, objects in self.items()}
+
+    def restore(self, backup):
+        self.clear()
+        self.update({model: dict(objects) for model, objects in backup.items()})
+
+
+class PayloadDigests(object):
+    """
+    Store in redis, in a key by object with a ttl, a digest of the json
+    payload used to create/update each object the last time, to be able to
+    skip objects that didn't change on the github side.
+    Digests are removed when objects are saved or deleted (see
+    `invalidate_payload_digest`), and saved again after a bulk update.
+    """
+    KEY_PREFIX = 'gim:payload-digest'
+
+    def __init__(self, model):
+        self.key = '%s:%s.%s:%%s' % (self.KEY_PREFIX, model._meta.app_label, model._meta.model_name)
+
+    @property
+    def redis(self):
+        from gim.core import get_main_limpyd_database
+        return get_main_limpyd_database().connection
+
+    @staticmethod
+    def serialize(value):
+        """Return a stable json representation of the given value"""
+        return json.dumps(value, sort_keys=True, separators=(',', ':'),
+                          default=lambda obj: '%s:%s' % (obj.__class__.__name__, getattr(obj, 'pk', obj)))
+
+    @classmethod
+    def compute(cls, payload, extra=''):
+        """Return the digest of the given payload. `extra` is a string to include in it"""
+        return sha1(extra + cls.serialize(payload)).hexdigest()
+
+    def get_many(self, pks):
+        """Return a dict with the stored digest, if any, for each given pk"""
+        pks = list(pks)
+        if not pks:
+            return {}
+        digests = self.redis.mget([self.key % pk for pk in pks])
+        return {pk: digest for pk, digest in zip(pks, digests) if digest}
+
+    def set_many(self, digests):
+        """Store the digests given as a dict with pks as keys"""
+        if digests:
+            pipeline = self.redis.pipeline(transaction=False)
+            for pk, digest in digests.iteritems():
+                pipeline.set(self.key % pk, digest, ex=settings.GITHUB_PAYLOAD_DIGESTS_TTL)
+            pipeline.execute()
+
+    def delete_many(self, pks):
+        """Remove the digests of the given pks"""
+        pks = list(pks)
+        if pks:
+            self.redis.delete(*[self.key % pk for pk in pks])
+
+
+def invalidate_payload_digest(sender, instance, **kwargs):
+    """
+    Signal receiver to remove the payload digest of saved/deleted objects: the
+    object may now be different from the payload. When saved by
+    `bulk_create_or_update_from_list`, the new digest is saved after that.
+    """
+    from gim.core.models.base import GithubObject
+    if settings.GITHUB_PAYLOAD_DIGESTS and instance.pk and issubclass(sender, GithubObject):
+        PayloadDigests(sender).delete_many([instance.pk])
+
 
 def graph_from_edges(edges):
     # copied from digraphtools (without casting values into list)
@@ -124,6 +124,7 @@ class ConfirmView(BaseGithubAuthView):
         token_object.scopes.delete()
         token_object.scopes.sadd(*scopes)
         token_object.valid_scopes.hset(1)
+        token_object.update_score_indexes()
 
         # remove other tokens for this username that are not valid anymore
         new_user = True
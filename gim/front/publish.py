@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from operator import itemgetter
 from threading import local
 
@@ -57,14 +58,43 @@ def send_unified_messages(store):
             messages.extend(store['__instances__'][model][pk].values())
     messages.extend(store.get('__others__', {}).values())
 
-    for container in sorted(messages, key=itemgetter('order')):
-        message = container['message']
-        publisher.publish(
-            topic=message['topic'],
-            repository_id=message['kwargs'].pop('repository_id', None),
-            *message['args'],
-            **message['kwargs']
+    publisher.publish_many([
+        (
+            container['message']['topic'],
+            container['message']['kwargs'].pop('repository_id', None),
+            container['message']['args'],
+            container['message']['kwargs'],
         )
+        for container in sorted(messages, key=itemgetter('order'))
+    ])
+
+
+@contextmanager
+def unified_publishing():
+    """Keep only the last message for each topic/instance published inside
+    this context manager, and send them all at the end"""
+
+    if getattr(thread_data, 'messages_store', None) is not None:
+        # already unifying messages
+        yield
+        return
+
+    store = thread_data.messages_store = {}
+    try:
+        yield
+    finally:
+        thread_data.messages_store = None
+        send_unified_messages(store)
+
+
+def publish(topic, repository_id=None, *args, **kwargs):
+    """Publish the message now, or store it if we are unifying messages"""
+
+    store = getattr(thread_data, 'messages_store', None)
+    if store is not None:
+        unify_messages(store, topic, repository_id=repository_id, *args, **kwargs)
+    else:
+        publisher.publish(topic, repository_id, *args, **kwargs)
 
 
 PUBLISHABLE = {
@@ -261,7 +291,7 @@ def publish_update(instance, message_type, extra_data=None):
 
         topic = topic_with_repo if message_repository_id else topic_without_repo
 
-        publisher.publish(
+        publish(
             topic=topic % dict(
                 message_type=message_type, repository_id=message_repository_id, **data),
             repository_id=message_repository_id,
@@ -4,8 +4,9 @@ from logging import getLogger
 logger = getLogger('gim.log')
 
 from gim.core import models as core_models
+from gim.core.batch import add_job, get_sync_batch
 
-from .publish import PUBLISHABLE, PUBLISHABLE_MODELS, publish_update, thread_data
+from .publish import PUBLISHABLE, PUBLISHABLE_MODELS, publish_update, thread_data, unified_publishing
 
 PUBLISHABLE_MAX_AGE = timedelta(hours=1)
 
@@ -42,6 +43,21 @@ def can_instance_be_published(instance, take_age_into_account=True):
 def publish_github_updated(sender, instance, created, **kwargs):
     """Publish a message each time a github object is created/updated."""
 
+    batch = get_sync_batch()
+    if batch is not None and isinstance(instance, PUBLISHABLE_MODELS) and instance.pk:
+        # In a sync batch, publish only once for each instance, when the batch is flushed
+        key = ('publish_github_updated', sender, instance.pk)
+        update_fields = kwargs.get('update_fields')
+        previous = batch.get_deferred(key)
+        if previous:
+            created = created or previous[1][2]
+            previous_update_fields = previous[2].get('update_fields')
+            update_fields = set(update_fields).union(previous_update_fields) \
+                if update_fields and previous_update_fields else None
+        batch.defer(key, publish_github_updated, sender, instance, created, update_fields=update_fields)
+        batch.wrap_flush('unified_publishing', unified_publishing)
+        return
+
     if not can_instance_be_published(instance):
         return
 
@@ -119,6 +135,16 @@ def hash_check(sender, instance, created, **kwargs):
                       )):
         return
 
+    batch = get_sync_batch()
+    if batch is not None and instance.pk:
+        # In a sync batch, check only once for each instance, when the batch is flushed
+        key = ('hash_check', sender, instance.pk)
+        previous = batch.get_deferred(key)
+        if previous:
+            created = created or previous[1][2]
+        batch.defer(key, hash_check, sender, instance, created)
+        return
+
     # Only if the data is fresh from github
     if hasattr(instance, 'github_status') and instance.github_status != instance.GITHUB_STATUS_CHOICES.FETCHED:
         return
@@ -149,8 +175,8 @@ def hash_check(sender, instance, created, **kwargs):
 
     if isinstance(instance, core_models.Issue):
         # if an issue, add a job to update its template
-        UpdateIssueCacheTemplate.add_job(issue_ids[0])
+        add_job(UpdateIssueCacheTemplate, issue_ids[0])
     else:
         # if not an issue, add a job to update the templates of all related issues
         for issue_id in issue_ids:
-            UpdateIssueCacheTemplate.add_job(issue_id, force_regenerate=1)
+            add_job(UpdateIssueCacheTemplate, issue_id, force_regenerate=1)
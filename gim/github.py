@@ -47,6 +47,7 @@ import base64
 import re
 import urllib
 import urllib2
+import zlib
 
 import logging
 from pprint import pformat
@@ -72,6 +73,7 @@ except ImportError:
     import simplejson as json
 
 TIMEOUT = 60
+READ_CHUNK_SIZE = 64 * 1024
 
 _URL = 'https://api.github.com'
 _METHOD_MAP = dict(
@@ -92,8 +94,16 @@ class GitHub(object):
     GitHub client.
     '''
 
+    # object to store the content of responses with an etag, to make GET
+    # requests conditional, and to coalesce them (see `_http` and
+    # `gim.core.ghpool.ResponseCache`)
+    response_cache = None
+
     def __init__(self, username=None, password=None, access_token=None, client_id=None, client_secret=None, redirect_uri=None, scope=None):
         self._reset_headers()
+        # number of bytes received (maybe compressed) and decoded, for all calls
+        self.total_raw_size = 0
+        self.total_decoded_size = 0
         self._authorization = None
         if username and password:
             self._authorization = 'Basic %s' % base64.b64encode('%s:%s' % (username, password))
@@ -110,6 +120,8 @@ class GitHub(object):
         self.x_ratelimit_reset = -1
         self.x_oauth_scopes = None
         self.x_accepted_oauth_scopes = None
+        self.raw_size = 0
+        self.decoded_size = 0
 
     def authorize_url(self, state=None):
         '''
@@ -156,7 +168,13 @@ class GitHub(object):
     def __getattr__(self, attr):
         return _Callable(self, '/%s' % attr)
 
-    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}):
+    def _build_opener(self):
+        '''
+        Return the opener used to make the api calls. Override to use other handlers.
+        '''
+        return urllib2.build_opener(urllib2.HTTPSHandler)
+
+    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}, json_stream=False):
         data = None
         if method == 'GET' and kw:
             path = '%s?%s' % (path, _encode_params(kw))
@@ -170,33 +188,77 @@ class GitHub(object):
             logger.info('REQUEST %s %s %s', method, url, request_headers)
         else:
             logger.info('%s REQUEST %s %s %s', '*' * 10, method, url, pformat(request_headers))
-        opener = urllib2.build_opener(urllib2.HTTPSHandler)
+        opener = self._build_opener()
         request = urllib2.Request(url, data=data, headers=request_headers or {})
         request.get_method = _METHOD_MAP[method]
         if self._authorization:
             request.add_header('Authorization', self._authorization)
+        if not request.has_header('Accept-encoding'):
+            request.add_header('Accept-Encoding', 'gzip, deflate')
         if method in ('POST', 'PUT', 'PATCH'):
             request.add_header('Content-Type', 'application/x-www-form-urlencoded')
+        cache_key = cached = fetch_lock = None
+        # if the response was saved (or touched) for the callers waiting for it
+        shared = False
+        if self.response_cache is not None and method == 'GET':
+            # None without credentials: responses are not shared between users
+            cache_key = self.response_cache.get_key(self._authorization, url, request.get_header('Accept'))
+        if cache_key:
+            if self.response_cache.coalesce_wait:
+                # only one caller at a time fetches an url, the other ones
+                # wait for its response and use it
+                fetch_lock = self.response_cache.acquire_fetch_lock(cache_key)
+                if not fetch_lock:
+                    coalesced = self.response_cache.wait_for_fetch(cache_key)
+                    if coalesced:
+                        return self._use_coalesced_response(coalesced, request, method, url,
+                                                            request_headers, response_headers, json_stream)
+            # use the cached content only if the caller did not ask for a
+            # conditional request itself, because it then expects to get a 304
+            if not request.has_header('If-none-match') and not request.has_header('If-modified-since'):
+                cached = self.response_cache.get(cache_key)
+                if cached:
+                    request.add_header('If-None-Match', cached['etag'])
         try:
             response = opener.open(request, timeout=timeout or TIMEOUT)
             is_json = self._process_resp(response.headers)
+            if fetch_lock and not self.response_cache.can_cache(response.headers.dict):
+                # don't let the waiting callers wait for the whole content
+                self.response_cache.release_fetch_lock(cache_key, fetch_lock, failed=True)
+                fetch_lock = None
             if isinstance(response_headers, dict):
                 response_headers.update(response.headers.dict.copy())
             if logger.level > logging.DEBUG:
                 logger.info('==> %s', 200)
             else:
                 logger.debug('=========> RESPONSE %s %s', 200, pformat(response_headers))
-            content = response.read()
+            content = self._read_content(response)
+            if cache_key and response.code == 200:
+                shared = self.response_cache.set(cache_key, response.headers.dict, content)
             # if logger.level <= logging.DEBUG:
             #     logger.debug('CONTENT\n' + '=' * 40)
             #     logger.debug('%s', pformat(_parse_json(content) if is_json else content))
             #     logger.debug('\n' + '=' * 40)
             if is_json:
-                return _parse_json(content)
+                return _parse_json(content, json_stream)
             else:
                 return content
         except urllib2.HTTPError, e:
             is_json = self._process_resp(e.headers)
+            if e.code == 304 and cached:
+                # not modified since we cached it: we can use the cached content
+                if fetch_lock:
+                    # still fresh for the callers waiting for this response
+                    self.response_cache.touch(cache_key)
+                    shared = True
+                if isinstance(response_headers, dict):
+                    response_headers.update(cached['headers'])
+                    response_headers.update(e.headers.dict)
+                logger.info('==> %s (cached content)', e.code)
+                if cached['headers'].get('content-type', '').startswith('application/json'):
+                    return _parse_json(cached['content'], json_stream)
+                else:
+                    return cached['content']
             if isinstance(response_headers, dict):
                 response_headers.update(e.headers.dict)
             if isinstance(request_headers, dict):
@@ -206,7 +268,7 @@ class GitHub(object):
             else:
                 logger.debug('=========> RESPONSE %s %s', e.code, pformat(response_headers))
             if is_json:
-                _json = _parse_json(e.read())
+                _json = _parse_json(self._read_content(e))
             else:
                 _json = None
             req = JsonObject(method=method, url=url)
@@ -214,6 +276,61 @@ class GitHub(object):
             if resp.code == 404:
                 raise ApiNotFoundError(url, req, resp, request_headers, response_headers)
             raise ApiError(url, req, resp, request_headers, response_headers)
+        finally:
+            if fetch_lock:
+                self.response_cache.release_fetch_lock(cache_key, fetch_lock, failed=not shared)
+
+    def _use_coalesced_response(self, entry, request, method, url, request_headers, response_headers, json_stream):
+        '''
+        Use the response fetched by another caller for the same url: return its
+        content, or raise like github would do with a 304 if the caller asked
+        for the same etag.
+        The headers of the response are used as the ones of the current call,
+        so the rate-limit and scopes ones of the previous call are not kept
+        (the call was not done so nothing was used).
+        '''
+        is_json = self._process_resp(entry['headers'])
+        if isinstance(response_headers, dict):
+            response_headers.update(entry['headers'])
+        if request.get_header('If-none-match') == entry['etag']:
+            logger.info('==> 304 (coalesced)')
+            req = JsonObject(method=method, url=url)
+            resp = JsonObject(code=304, json=None)
+            raise ApiError(url, req, resp, request_headers, response_headers)
+        logger.info('==> 200 (coalesced)')
+        if is_json:
+            return _parse_json(entry['content'], json_stream)
+        return entry['content']
+
+    def _read_content(self, response):
+        '''
+        Read the content of the response by chunks, decompressing them on the
+        fly if the content is gzip/deflate encoded, and save the raw and decoded
+        sizes.
+        '''
+        decompressor = None
+        encoding = ((response.headers or {}).get('content-encoding') or '').strip().lower()
+        if encoding in ('gzip', 'deflate'):
+            # 32: automatic detection of the gzip or zlib header
+            decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        chunks = []
+        raw_size = 0
+        while True:
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            raw_size += len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            chunks.append(chunk)
+        if decompressor:
+            chunks.append(decompressor.flush())
+        content = ''.join(chunks)
+        self.raw_size = raw_size
+        self.decoded_size = len(content)
+        self.total_raw_size += raw_size
+        self.total_decoded_size += self.decoded_size
+        return content
 
     def _process_resp(self, headers):
         is_json = False
@@ -243,8 +360,8 @@ class _Executable(object):
         self._method = method
         self._path = path
 
-    def __call__(self, request_headers=None, response_headers=None, json_post=True, timeout=None, **kw):
-        return self._gh._http(self._method, self._path, request_headers, response_headers, json_post, timeout, kw)
+    def __call__(self, request_headers=None, response_headers=None, json_post=True, timeout=None, json_stream=False, **kw):
+        return self._gh._http(self._method, self._path, request_headers, response_headers, json_post, timeout, kw, json_stream)
 
     def __str__(self):
         return '_Executable (%s %s)' % (self._method, self._path)
@@ -310,13 +427,44 @@ def _encode_json(obj):
     return json.dumps(obj, default=_dump_obj)
 
 
-def _parse_json(jsonstr):
-    def _obj_hook(pairs):
-        o = JsonObject()
-        for k, v in pairs.iteritems():
-            o[str(k)] = v
-        return o
-    return json.loads(jsonstr, object_hook=_obj_hook)
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _parse_json(jsonstr, stream=False):
+    '''
+    Decode the json string, using JsonObject for objects.
+    Keys of objects are `unicode` strings, as returned by the json module (they
+    were converted to `str` before): they are equal to, and have the same hash
+    as, the `str` version of ascii keys, so they can be used the same way to
+    get values, as attributes, or as keyword arguments.
+    If stream is True and the json is a list, return a generator yielding the
+    entries of the list one by one, decoding each one only when asked for.
+    '''
+    if stream:
+        start = _JSON_WHITESPACE.match(jsonstr).end()
+        if jsonstr[start:start + 1] == '[':
+            return _iter_json_list(jsonstr, start + 1)
+    return _JSON_DECODER.decode(jsonstr)
+
+
+def _iter_json_list(jsonstr, idx):
+    '''
+    Yield the entries of the json list in jsonstr, starting at idx (just after
+    the opening bracket)
+    '''
+    idx = _JSON_WHITESPACE.match(jsonstr, idx).end()
+    if jsonstr[idx:idx + 1] == ']':
+        return
+    while True:
+        obj, idx = _JSON_DECODER.raw_decode(jsonstr, idx)
+        yield obj
+        idx = _JSON_WHITESPACE.match(jsonstr, idx).end()
+        char = jsonstr[idx:idx + 1]
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError('Expecting , delimiter: char %d' % idx)
+        idx = _JSON_WHITESPACE.match(jsonstr, idx + 1).end()
 
 
 class ApiError(Exception):
@@ -360,6 +508,10 @@ class JsonObject(dict):
     def __setstate__(self, state):
         self.update(state)
 
+
+# objects are directly created from the list of (key, value) pairs
+_JSON_DECODER = json.JSONDecoder(object_pairs_hook=JsonObject)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
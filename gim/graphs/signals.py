@@ -1,5 +1,6 @@
 from datetime import timedelta
 
+from gim.core.batch import add_job
 from gim.core.models import Issue
 
 
@@ -7,4 +8,4 @@ def update_graphs_data(sender, instance, created, **kwargs):
     if not isinstance(instance, Issue):
         return
     from gim.graphs.tasks import UpdateGraphsData
-    UpdateGraphsData.add_job(instance.repository_id, delayed_for=timedelta(minutes=15))
+    add_job(UpdateGraphsData, instance.repository_id, delayed_for=timedelta(minutes=15))
@@ -7,6 +7,7 @@ from django.conf import settings
 from django.db import models
 
 from gim.core import models as core_models
+from gim.core.batch import sync_batch
 from gim.core.ghpool import prepare_fetch_headers, ApiError, Connection
 from gim.core.limpyd_models import Token
 from gim.core.managers import MODE_ALL
@@ -155,7 +156,7 @@ class _Repository(models.Model):
             messages_store = {}
             intercepted_publish = partial(unify_messages, messages_store)
             try:
-                with patch.object(publisher, 'publish', side_effect=intercepted_publish):
+                with patch.object(publisher, 'publish', side_effect=intercepted_publish), sync_batch():
 
                     # fetch events in the reverse order (oldest first) to let use create
                     # our own events in the correct order
@@ -7,6 +7,7 @@ from random import randint
 
 from limpyd_jobs import STATUSES
 
+from gim.core.scheduler import get_delay, record_activity
 from gim.core.tasks.repository import RepositoryJob
 
 
@@ -40,15 +41,19 @@ class CheckRepositoryEvents(RepositoryJob):
 
         updated_issues_count, delay = repository.check_events(gh)
 
+        record_activity(repository.pk, updated_issues_count)
+
         return updated_issues_count, delay or 60
 
     def on_success(self, queue, result):
         """
         Go check events again in the minimal delay given by gtthub, but only if
         the hook is not set on this repository
-        This delay is passed as the result argument.
+        This delay is passed as the result argument. It may be longer for
+        repositories with few activity (see `gim.core.scheduler`)
         """
         updated_issues_count, delay = result
+        delay = max(delay, get_delay(self.identifier.hget(), self.queue_name, default=delay))
         self.clone(delayed_for=delay + randint(0, 10))
 
     def success_message_addon(self, queue, result):
@@ -7,6 +7,8 @@ from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+from gim.core.scheduler import record_activity
+
 from . import EVENTS
 from .models import EventManager
 
@@ -46,6 +48,8 @@ class GithubWebHook(View):
 
             result = method(payload)
 
+            record_activity(repository.pk)
+
         except Exception as e:
             from pprint import pformat
             log_string = 'DeliveryId: %s\nRepository: %s\nEvent: %s\nPayload:\n%s\n%s\n\n' % (
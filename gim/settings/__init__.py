@@ -316,6 +316,111 @@ GITHUB_CLIENT_SECRET = get_env_variable('GITHUB_CLIENT_SECRET')
 
 GITHUB_HOOK_URL = get_env_variable('GITHUB_HOOK_URL', default=None)
 
+# Content of github responses with an etag are kept in redis to make next calls
+# conditional, except pages of paginated lists. Set the ttl to 0 to deactivate.
+# Max size is in bytes.
+GITHUB_RESPONSE_CACHE_TTL = int(get_env_variable('GITHUB_RESPONSE_CACHE_TTL', default=3600 * 24))
+GITHUB_RESPONSE_CACHE_MAX_SIZE = int(get_env_variable('GITHUB_RESPONSE_CACHE_MAX_SIZE', default=1024 * 1024))
+
+# Only one GET request at a time is done for the same url (for a user), the
+# other callers wait, at most this number of seconds, to use its response
+# (needs the response cache; 0 to deactivate, the default)
+GITHUB_COALESCE_REQUESTS_WAIT = int(get_env_variable('GITHUB_COALESCE_REQUESTS_WAIT', default=0))
+
+# Connection objects are kept in a pool by token (or username), limited to this
+# size, and dropped when not used for this number of seconds (0 for no limit)
+GITHUB_CONNECTIONS_POOL_MAX_SIZE = int(get_env_variable('GITHUB_CONNECTIONS_POOL_MAX_SIZE', default=1000))
+GITHUB_CONNECTIONS_POOL_IDLE_TIMEOUT = int(get_env_variable('GITHUB_CONNECTIONS_POOL_IDLE_TIMEOUT', default=3600))
+
+# Number of pages of a list fetched at the same time during the second step of
+# the first fetch of a repository (0, the default, to fetch them one after the
+# other)
+FIRST_FETCH_PARALLEL_PAGES = int(get_env_variable('FIRST_FETCH_PARALLEL_PAGES', default=0))
+
+# Number of lists (issues, events, comments...) to fetch at the same time during
+# the first fetch of a repository, each one in its own thread (0, the default,
+# to deactivate)
+# The pools of threads have a fixed size, not depending on the tokens: with both
+# settings, up to PAGES x LISTS requests are done at the same time for a job,
+# maybe with the same token, which the secondary rate limits of github punish.
+FIRST_FETCH_PARALLEL_LISTS = int(get_env_variable('FIRST_FETCH_PARALLEL_LISTS', default=0))
+
+# Number of lists (commits, events, comments, files...) of an issue fetched at
+# the same time when fetching the whole issue (0 to fetch them one after the other)
+ISSUE_FETCH_PARALLEL_REQUESTS = int(get_env_variable('ISSUE_FETCH_PARALLEL_REQUESTS', default=4))
+
+# Fetch the state (merge status, head...) of the pull requests to update with
+# one GraphQL query for many of them, and only fetch with the REST api the ones
+# that changed more than their merge status (set to 0 to deactivate)
+GITHUB_GRAPHQL_PRS_STATE = bool(int(get_env_variable('GITHUB_GRAPHQL_PRS_STATE', default=1)))
+
+# Fetch commits waiting to be fully fetched (for example after a force-push on
+# a pull request) many at once, with GraphQL for their data and comments count,
+# instead of one job by commit (set to 0 to deactivate)
+GITHUB_BATCH_COMMITS = bool(int(get_env_variable('GITHUB_BATCH_COMMITS', default=1)))
+
+# Update the rate-limit information of all the tokens of a user after each
+# github call in one redis call (using a lua script), instead of many
+GITHUB_TOKENS_UPDATE_SCRIPT = bool(int(get_env_variable('GITHUB_TOKENS_UPDATE_SCRIPT', default=1)))
+
+# Keep sorted sets of the tokens by score, to select the best ones without
+# sorting all the tokens each time one is needed
+GITHUB_TOKENS_SCORE_INDEX = bool(int(get_env_variable('GITHUB_TOKENS_SCORE_INDEX', default=1)))
+
+# Make jobs reserve, on their token, the number of github calls they are
+# expected to do (based on the previous jobs of the same queue), and delay
+# them until the rate limit is reset if not enough calls are left
+GITHUB_TOKENS_RESERVATIONS = bool(int(get_env_variable('GITHUB_TOKENS_RESERVATIONS', default=1)))
+
+# Adapt the delay between two periodic runs of the jobs refreshing a repository
+# to its activity, between the bounds (in seconds) defined for their queues in
+# REPOSITORY_REFRESH_DELAYS (set to 0 to keep the fixed delays). Jobs run again
+# because some work is still waiting are not concerned.
+# The activity score of a repository is halved every
+# REPOSITORY_ACTIVITY_HALF_LIFE seconds, and a repository with a score of
+# REPOSITORY_ACTIVITY_SCORE_REFERENCE is refreshed at the middle of the bounds.
+REPOSITORY_ADAPTIVE_REFRESH = bool(int(get_env_variable('REPOSITORY_ADAPTIVE_REFRESH', default=1)))
+REPOSITORY_ACTIVITY_HALF_LIFE = int(get_env_variable('REPOSITORY_ACTIVITY_HALF_LIFE', default=3600))
+REPOSITORY_ACTIVITY_SCORE_REFERENCE = float(get_env_variable('REPOSITORY_ACTIVITY_SCORE_REFERENCE', default=10))
+REPOSITORY_REFRESH_DELAYS = {
+    'update-repo': (60 * 5, 60 * 60),
+    'check-repo-events': (60, 60 * 10),
+    'update-pr-reviews': (60, 60 * 15),
+}
+
+# Save the objects of each page of a list fetched from github with a few bulk
+# queries instead of a few queries by object (set to 0 to deactivate)
+GITHUB_BULK_SAVE = bool(int(get_env_variable('GITHUB_BULK_SAVE', default=1)))
+
+# Keep a digest of the payload used to save each object from a list, to skip
+# the ones that didn't change the next time (set to 1 to activate). Each digest
+# is kept for the given number of seconds.
+GITHUB_PAYLOAD_DIGESTS = bool(int(get_env_variable('GITHUB_PAYLOAD_DIGESTS', default=0)))
+GITHUB_PAYLOAD_DIGESTS_TTL = int(get_env_variable('GITHUB_PAYLOAD_DIGESTS_TTL', default=3600 * 24 * 7))
+
+# Save all the objects of each page of a list fetched from github in only one
+# transaction (set to 0 to deactivate)
+GITHUB_ATOMIC_PAGES = bool(int(get_env_variable('GITHUB_ATOMIC_PAGES', default=1)))
+
+# Keep objects often referenced in github payloads (users, labels, milestones)
+# in a per-process identity map, to avoid loading them again and again
+# (set one of these to 0 to deactivate). The ttl is in seconds.
+IDENTITY_MAP_MAX_SIZE = int(get_env_variable('IDENTITY_MAP_MAX_SIZE', default=10000))
+IDENTITY_MAP_TTL = int(get_env_variable('IDENTITY_MAP_TTL', default=300))
+
+# During the first fetch of a repository, when the pages of a list cannot be
+# fetched in parallel (github doesn't give the last page), fetch the next pages
+# in a thread while the previous ones are saved (set to 1 to activate), with at
+# most GITHUB_PIPELINE_QUEUE_SIZE pages fetched in advance.
+# It's one more thread for each list: with FIRST_FETCH_PARALLEL_LISTS lists
+# fetched at the same time, each one using at most FIRST_FETCH_PARALLEL_PAGES
+# threads, or one for this pipeline, a job can do up to
+# FIRST_FETCH_PARALLEL_LISTS * max(FIRST_FETCH_PARALLEL_PAGES, 1) requests at
+# the same time. Not used when fetching an issue (ISSUE_FETCH_PARALLEL_REQUESTS
+# lists at the same time, with their pages fetched one after the other).
+GITHUB_PIPELINED_FETCH = bool(int(get_env_variable('GITHUB_PIPELINED_FETCH', default=0)))
+GITHUB_PIPELINE_QUEUE_SIZE = int(get_env_variable('GITHUB_PIPELINE_QUEUE_SIZE', default=2))
+
 DATABASES = {  # default to a postgresql db named "gim"
     'default': {
         'ENGINE': get_env_variable('DB_ENGINE', default='django.db.backends.postgresql'),
@@ -478,6 +478,30 @@ class Publisher(HistoryMixin, lmodel.RedisModel):
 
         return msg_id
 
+    def publish_many(self, messages):
+        """Publish many messages, given as (topic, repository_id, args, kwargs) tuples,
+        locking only once"""
+
+        if not messages:
+            return []
+
+        with self.lock_publishing():
+
+            # Sent unsent messages if any
+            self.send_unsent_messages()
+
+            # Prepare messages to send
+            to_send = []
+            for topic, repository_id, args, kwargs in messages:
+                topic = normalize_topic(topic)
+                msg_id = self.save_message(topic, repository_id, *args, **kwargs)
+                to_send.append((msg_id, topic, repository_id, args, kwargs))
+
+            # We can now send our messages
+            self.send_messages(to_send)
+
+        return [msg_id for msg_id, topic, repository_id, args, kwargs in to_send]
+
     def get_unsent_bounds(self):
         last_msg_id = self.get_last_msg_id()
         last_msg_id_sent = self.get_last_msg_id_sent()